@@ -44,16 +44,106 @@ INSTALLED_APPS = [
 # Путь к ASGI-приложению для запуска Channels
 ASGI_APPLICATION = 'Product_Screen_Server.asgi.application'
 
-# Настройка слоя каналов через Redis (для обмена сообщениями)
+# Настройка слоя каналов (для обмена сообщениями).
+# Гибридный слой: сообщения внутри процесса доставляются напрямую, через Redis —
+# только процессам, у которых есть участники группы (см. Screen_Server/channel_layer.py)
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'BACKEND': 'Screen_Server.channel_layer.HybridChannelLayer',
         'CONFIG': {
             'hosts': [('localhost', 6379)],
         }
     }
 }
 
+# UDP-порты транспортных модулей: порт → имя модуля.
+# Модуль выбирается по первой корректной датаграмме на одном из этих портов.
+MODULE_PORTS = {
+    29789: 'moscow',
+}
+
+# Сервис приёма датаграмм модуля Moscow (см. Screen_Server/ingest.py).
+# Политика переполнения очередей: 'drop_oldest' — вытеснять самый старый пакет,
+# 'latest' — заменять ожидающий пакет того же типа от того же поезда.
+MOSCOW_INGEST = {
+    'RECEIVE_QUEUE_SIZE': 1024,
+    'BROADCAST_QUEUE_SIZE': 256,
+    'DEFAULT_OVERFLOW_POLICY': 'drop_oldest',
+    'OVERFLOW_POLICY': {
+        'OperationalData': 'latest',
+        'AdditionalOperationalData': 'latest',
+    },
+    # Телеметрия объединяется по поезду и типу и рассылается не чаще COALESCE_HZ раз в секунду
+    'COALESCE_HZ': 15,
+    'COALESCE_TYPES': ['OperationalData', 'AdditionalOperationalData'],
+    # Экранам, подключённым с ?delta=1, для этих типов рассылаются только изменившиеся поля
+    'DELTA_TYPES': ['OperationalData', 'AdditionalOperationalData'],
+    # Повторы пакетов (совпадающая полезная нагрузка или ID+CRC в окне) отбрасываются до разбора
+    'DEDUP': True,
+    'RETRANSMIT_WINDOW': 64,
+    # Число процессов приёма и способ распределения ('reuseport' — SO_REUSEPORT,
+    # 'dispatch' — диспетчер по IP отправителя); маршрут на сервере один (см. ingest_workers.py)
+    'WORKERS': 1,
+    'SHARDING': 'reuseport',
+}
+
+# Исходящие очереди WebSocket-соединений экранов (см. Screen_Server/outbound.py):
+# телеметрия заменяется последним значением, остальные кадры не теряются,
+# а соединение, не принимающее данные SLOW_CLIENT_TIMEOUT секунд, закрывается.
+# Экран держит не больше MAX_IN_FLIGHT кадров без подтверждения ответом pong
+MOSCOW_OUTBOUND = {
+    'QUEUE_SIZE': 32,
+    'MAX_PENDING': 256,
+    'MAX_IN_FLIGHT': 64,
+    'SLOW_CLIENT_TIMEOUT': 10.0,
+}
+
+# Начальные кадры экранов и ограничение скорости подключений (см. Screen_Server/bootstrap.py):
+# при одновременном переподключении всех экранов кадр собирается один раз,
+# а подключения пропускаются не быстрее ADMISSION_RATE в секунду
+SCREEN_BOOTSTRAP = {
+    'TTL': 1.0,
+    'ADMISSION_RATE': 200.0,
+    'ADMISSION_BURST': 100,
+}
+
+# Проверка живости соединений экранов (см. Screen_Server/heartbeat.py): ping раз в INTERVAL
+# секунд; соединение, от которого нет сообщений TIMEOUT секунд, удаляется из реестра
+# и групп рассылки и закрывается
+SCREEN_HEARTBEAT = {
+    'INTERVAL': 15.0,
+    'TIMEOUT': 45.0,
+}
+
+# Состояние маршрута и телеметрии в памяти процесса (см. Screen_Server/state.py):
+# изменения пишутся в Redis пакетом не чаще раза в FLUSH_INTERVAL секунд
+SCREEN_STATE = {
+    'FLUSH_INTERVAL': 0.05,
+}
+
+# Снимок состояния в локальном файле (см. Screen_Server/snapshot.py): после перезапуска
+# маршрут и последняя телеметрия восстанавливаются из него сразу, не дожидаясь RouteData.
+# Снимок пишется раз в INTERVAL секунд при изменениях; старше MAX_AGE секунд — отбрасывается
+# Пишет только процесс, который ведёт состояние (при WORKERS > 1 — процесс приёма, получивший маршрут).
+# Каталог var/ создаётся при первой записи и не хранится в git
+SCREEN_SNAPSHOT = {
+    'PATH': BASE_DIR / 'var' / 'state.snapshot',
+    'INTERVAL': 5.0,
+    'MAX_AGE': 86400.0,
+}
+
+# История телеметрии в кольцевых буферах фиксированного размера (см. Screen_Server/telemetry.py):
+# строк OperationalData и строк вагонов на поезд, число поездов в истории
+SCREEN_TELEMETRY = {
+    'CAPACITY': 36000,
+    'WAGON_CAPACITY': 72000,
+    'MAX_STREAMS': 8,
+}
+
+# Двоичные кадры msgpack для клиентов, запросивших подпротокол 'msgpack'
+# (изображения передаются байтами, а не base64; см. Screen_Server/broadcast.py)
+WS_BINARY_FRAMES = True
+
 # Middleware-цепочка — обработчики запросов/ответов
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
@@ -132,13 +222,20 @@ MEDIA_ROOT = BASE_DIR / 'media'
 # Автоматическая генерация ID для моделей
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
-# Настройка кэша через Redis
+# Настройка кэша через Redis.
+# Двухуровневый кэш (см. Screen_Server/cache_backend.py): локальная LRU-копия в каждом
+# процессе (LOCAL_MAX_ENTRIES записей, не дольше LOCAL_TTL секунд) перед django_redis;
+# изменённые ключи удаляются из копий других процессов через pub/sub INVALIDATION_CHANNEL
 CACHES = {
     'default': {
-        'BACKEND': 'django_redis.cache.RedisCache',
+        'BACKEND': 'Screen_Server.cache_backend.TwoTierCache',
         'LOCATION': 'redis://127.0.0.1:6379/1',
         'OPTIONS': {
+            'REMOTE_BACKEND': 'django_redis.cache.RedisCache',
             'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            'LOCAL_MAX_ENTRIES': 1024,
+            'LOCAL_TTL': 5.0,
+            'INVALIDATION_CHANNEL': 'screen_server.cache_invalidate',
         }
     }
 }
@@ -1,5 +1,4 @@
 import logging
-import threading
 
 from django.apps import AppConfig
 
@@ -9,7 +8,7 @@ class ScreenServerConfig(AppConfig):
     Конфигурация приложения Django для модуля `Screen_Server`.
 
     При запуске проекта автоматически запускается фоновый поток, который
-    инициализирует сетевой сниффер (на базе Scapy) для прослушивания UDP-пакетов.
+    слушает UDP-порты модулей и определяет активный модуль по первой датаграмме.
     Это позволяет серверу принимать данные от железнодорожных устройств в реальном времени.
     """
     default_auto_field = 'django.db.models.BigAutoField'
@@ -18,10 +17,20 @@ class ScreenServerConfig(AppConfig):
     def ready(self):
         """
         Метод, вызываемый Django при запуске приложения.
-        Здесь запускается фоновый поток с `start_sniffing_thread`, который начинает
-        прослушивание UDP-портов. Поток отмечен как daemon, чтобы не мешать завершению работы сервера.
+        Здесь из снимка восстанавливается состояние маршрута (см. snapshot.py) и запускается
+        `start_detection_thread`, который начинает прослушивание UDP-портов.
+        Поток отмечен как daemon, чтобы не мешать завершению работы сервера.
+
+        В рабочих процессах приёма (см. ingest_workers) ничего не запускается:
+        порт и состояние принадлежат основному процессу.
         """
-        from .views import start_sniffing_thread
-        logging.info("🚀 Запускаем фоновый сниффер при старте сервера...")
-        sniff_thread = threading.Thread(target=start_sniffing_thread, daemon=True)
-        sniff_thread.start()
+        from .ingest import get_ingest_config
+        from .ingest_workers import ingest_worker_index
+        from .snapshot import restore_snapshot
+        from .views import start_detection_thread
+        if ingest_worker_index() is not None:
+            return
+        # При нескольких процессах приёма состояние ведут они, а этот процесс только читает
+        restore_snapshot(owner=get_ingest_config()['WORKERS'] == 1)
+        logging.info("🚀 Запускаем определение модуля при старте сервера...")
+        start_detection_thread()
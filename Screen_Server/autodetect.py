@@ -0,0 +1,104 @@
+"""
+Определение активного транспортного модуля по входящим UDP-датаграммам.
+
+Вместо захвата трафика через Scapy слушает набор сконфигурированных портов
+обычными неблокирующими сокетами. Модуль выбирается по первой датаграмме,
+прошедшей проверку формата для этого порта. После выбора все сокеты, кроме
+выбранного, закрываются, а выбранный передаётся клиенту модуля вместе с первой
+датаграммой, чтобы не потерять её.
+"""
+
+
+import logging
+import selectors
+import socket
+import threading
+
+from typing import Callable, Dict, Optional, Tuple
+
+
+Datagram = Tuple[bytes, Tuple[str, int]]
+DetectCallback = Callable[[str, socket.socket, Datagram], None]
+
+MAX_DATAGRAM_SIZE = 65535  # Максимальный размер UDP-датаграммы
+
+
+class ModuleDetector:
+    """
+    Слушает UDP-порты и определяет модуль по первой корректной датаграмме.
+
+    Атрибуты:
+        ports (Dict[int, str]): Соответствие порт → имя модуля.
+        validators (Dict[str, Callable[[bytes], bool]]): Проверка формата датаграммы для модуля.
+        on_detect (DetectCallback): Вызывается один раз с именем модуля, сокетом и первой датаграммой.
+    """
+    def __init__(self, ports: Dict[int, str], validators: Dict[str, Callable[[bytes], bool]],
+                 on_detect: DetectCallback, host: str = '0.0.0.0'):
+        self.ports = ports
+        self.validators = validators
+        self.on_detect = on_detect
+        self.host = host
+        self.module: Optional[str] = None
+        self._selector = selectors.DefaultSelector()
+        self._stop = threading.Event()
+
+    def _open_sockets(self):
+        for port, module in self.ports.items():
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                sock.bind((self.host, port))
+            except OSError as e:
+                logging.error(f'Не удалось открыть порт {port} для модуля {module}: {e}')
+                sock.close()
+                continue
+            sock.setblocking(False)
+            self._selector.register(sock, selectors.EVENT_READ, (port, module))
+            logging.info(f'Ожидаем датаграммы модуля {module} на порту {port}')
+
+    def _close_sockets(self, keep: Optional[socket.socket] = None):
+        for key in list(self._selector.get_map().values()):
+            self._selector.unregister(key.fileobj)
+            if key.fileobj is not keep:
+                key.fileobj.close()
+        self._selector.close()
+
+    def _check(self, sock: socket.socket, port: int, module: str) -> Optional[Datagram]:
+        try:
+            data, addr = sock.recvfrom(MAX_DATAGRAM_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return None
+        validator = self.validators.get(module)
+        if validator is not None and not validator(data):
+            logging.info(f'Пропущена некорректная датаграмма на порту {port} от {addr[0]}')
+            return None
+        return data, addr
+
+    def run(self, poll_interval: float = 1.0):
+        """
+        Блокирующий цикл ожидания. Завершается после выбора модуля или вызова stop().
+        """
+        self._open_sockets()
+        chosen = None
+        try:
+            while not self._stop.is_set() and chosen is None:
+                for key, _ in self._selector.select(timeout=poll_interval):
+                    port, module = key.data
+                    datagram = self._check(key.fileobj, port, module)
+                    if datagram is not None:
+                        chosen = module, key.fileobj, datagram
+                        break
+        finally:
+            self._close_sockets(keep=chosen[1] if chosen else None)
+
+        if chosen is not None:
+            module, sock, datagram = chosen
+            self.module = module
+            logging.info(f'Определён модуль {module} по датаграмме от {datagram[1][0]}')
+            self.on_detect(module, sock, datagram)
+
+    def stop(self):
+        """
+        Прерывает ожидание без выбора модуля.
+        """
+        self._stop.set()
@@ -0,0 +1,230 @@
+"""
+Начальные кадры экранов при подключении и ограничение скорости подключений.
+
+После перезапуска сервера все экраны поезда переподключаются одновременно.
+Раньше каждое подключение само собирало начальный кадр: MoscowConsumer делал
+два обращения к кэшу (Redis) через sync_to_async, BNTConsumer вызывал
+get_BNT_data — разбор XML маршрута и base64-кодирование всех PNG вагонов.
+
+Теперь начальные кадры собираются один раз и переиспользуются:
+- BootstrapCache хранит готовые кадры по ключу (модуль; для БНТ — сторона и
+  вагон). Одновременные подключения с одним ключом ждут одну сборку;
+  текст JSON и msgpack кодируются один раз, при первом запросе;
+- кадр помнит ключи состояния, из которых собран (sources), и сбрасывается
+  только при изменении одного из них: invalidate(keys) из moscow.cache_set
+  в процессе, который ведёт состояние, и по сообщениям об изменении ключей
+  из других процессов (cache_backend.add_invalidation_listener, канал
+  INVALIDATION_CHANNEL). Кадры БНТ собираются из файла маршрута и ключей
+  состояния не имеют. Кадры из общего кэша ещё и устаревают через TTL
+  секунд — на случай, если сообщение об изменении не дошло;
+- AdmissionGate пропускает подключения с ограниченной скоростью (маркерная
+  корзина ADMISSION_RATE в секунду с запасом ADMISSION_BURST): всплеск
+  подключений растягивается во времени, а не нагружает процессор разом.
+"""
+
+
+import asyncio
+import time
+
+from typing import Any, Awaitable, Callable, Dict, FrozenSet, Hashable, Iterable, Optional, Tuple
+
+from django.conf import settings
+
+from .broadcast import encode_binary, encode_frame
+from .cache_backend import add_invalidation_listener
+
+
+DEFAULT_BOOTSTRAP = {
+    'TTL': 1.0,  # Сек жизни кадра, собранного из общего кэша
+    'ADMISSION_RATE': 200.0,  # Подключений в секунду
+    'ADMISSION_BURST': 100,  # Подключений, пропускаемых без ожидания
+}
+
+
+def get_bootstrap_config() -> Dict[str, Any]:
+    config = dict(DEFAULT_BOOTSTRAP)
+    config.update(getattr(settings, 'SCREEN_BOOTSTRAP', {}))
+    return config
+
+
+class PreparedFrame:
+    """
+    Собранный кадр с лениво закодированными вариантами JSON и msgpack.
+    """
+    __slots__ = ('frame', '_text', '_binary')
+
+    def __init__(self, frame: Any):
+        self.frame = frame
+        self._text = None
+        self._binary = None
+
+    def encoded(self, binary: bool = False) -> Tuple[Optional[str], Optional[bytes]]:
+        """
+        Кадр для отправки: (текст, None) или (None, байты msgpack).
+        """
+        if binary:
+            if self._binary is None:
+                self._binary = encode_binary(self.frame)
+            return None, self._binary
+        if self._text is None:
+            self._text = encode_frame(self.frame)
+        return self._text, None
+
+
+class BootstrapCache:
+    """
+    Готовые начальные кадры по ключу с однократной сборкой.
+
+    Атрибуты:
+        version (int): Номер поколения; invalidate() всех кадров увеличивает его.
+        builds (int): Сколько раз кадры собирались.
+        hits (int): Сколько подключений получили готовый или собираемый кадр.
+        invalidated (int): Кадров сброшено.
+    """
+    def __init__(self):
+        self.version = 0
+        self.builds = 0
+        self.hits = 0
+        self.invalidated = 0
+        self._entries: Dict[Hashable, Tuple[FrozenSet[str], float, PreparedFrame]] = {}
+        self._pending: Dict[Hashable, asyncio.Future] = {}
+        self._generations: Dict[str, int] = {}  # ключ состояния → число его изменений
+
+    async def get(self, key: Hashable, build: Callable[[], Awaitable[Any]], ttl: float = None,
+                  sources: Iterable[str] = ()) -> PreparedFrame:
+        """
+        Возвращает кадр по ключу, собирая его через build() не чаще одного раза.
+
+        Аргументы:
+            key: Ключ кадра.
+            build: Корутина-функция, возвращающая кадр.
+            ttl (float | None): Срок жизни кадра (сек); None — до invalidate().
+            sources: Ключи состояния, из которых собирается кадр.
+        """
+        entry = self._entries.get(key)
+        if entry is not None and (ttl is None or time.monotonic() - entry[1] < ttl):
+            self.hits += 1
+            return entry[2]
+
+        pending = self._pending.get(key)
+        if pending is not None:
+            self.hits += 1
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        sources = frozenset(sources)
+        for source in sources:
+            self._generations.setdefault(source, 0)
+        generation = self._generation(sources)
+        try:
+            prepared = PreparedFrame(await build())
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Ошибка передаётся ожидающим; сборщик получает её ниже
+            raise
+        finally:
+            self._pending.pop(key, None)
+        self.builds += 1
+        # Если во время сборки ключи кадра менялись, собранный мог устареть
+        if generation == self._generation(sources):
+            self._entries[key] = (sources, time.monotonic(), prepared)
+        future.set_result(prepared)
+        return prepared
+
+    def _generation(self, sources: FrozenSet[str]) -> Tuple[int, ...]:
+        return (self.version, *(self._generations[source] for source in sorted(sources)))
+
+    def invalidate(self, keys: Optional[Iterable[str]] = None):
+        """
+        Сбрасывает кадры, собранные из изменившихся ключей состояния (None — все).
+        Можно вызывать из любого потока.
+        """
+        if keys is None:
+            self.version += 1
+            self.invalidated += len(self._entries)
+            self._entries = {}
+            return
+        keys = {key for key in keys if key in self._generations}
+        if not keys:
+            return
+        for key in keys:
+            self._generations[key] += 1
+        entries = list(self._entries.items())
+        kept = {key: entry for key, entry in entries if not entry[0] & keys}
+        if len(kept) != len(entries):
+            self.invalidated += len(entries) - len(kept)
+            self._entries = kept
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'version': self.version,
+            'frames': len(self._entries),
+            'builds': self.builds,
+            'hits': self.hits,
+            'invalidated': self.invalidated,
+        }
+
+
+class AdmissionGate:
+    """
+    Маркерная корзина для подключений: не более rate в секунду после запаса burst.
+
+    Ожидающие подключения резервируют маркеры заранее и пропускаются в порядке прихода.
+
+    Атрибуты:
+        admitted (int): Пропущено подключений.
+        delayed (int): Из них ждали маркер.
+        max_wait (float): Наибольшее ожидание (сек).
+    """
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self.admitted = 0
+        self.delayed = 0
+        self.max_wait = 0.0
+
+    async def acquire(self) -> float:
+        """
+        Ждёт очереди на подключение; возвращает время ожидания (сек).
+        """
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= 1
+        self.admitted += 1
+        if self._tokens >= 0:
+            return 0.0
+        wait = -self._tokens / self.rate
+        self.delayed += 1
+        self.max_wait = max(self.max_wait, wait)
+        await asyncio.sleep(wait)
+        return wait
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'rate': self.rate,
+            'burst': self.burst,
+            'admitted': self.admitted,
+            'delayed': self.delayed,
+            'max_wait': self.max_wait,
+        }
+
+
+_config = get_bootstrap_config()
+bootstrap_cache = BootstrapCache()
+add_invalidation_listener(bootstrap_cache.invalidate)
+admission = AdmissionGate(_config['ADMISSION_RATE'], _config['ADMISSION_BURST'])
+
+
+def bootstrap_ttl() -> float:
+    return _config['TTL']
+
+
+def bootstrap_stats() -> Dict[str, Any]:
+    return {'frames': bootstrap_cache.stats(), 'admission': admission.stats()}
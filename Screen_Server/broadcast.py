@@ -0,0 +1,175 @@
+"""
+Рассылка в WebSocket-группы с однократной сериализацией кадра.
+
+Раньше в событие группы клался словарь, и каждый консьюмер группы сам вызывал
+json.dumps для своего сокета — одинаковое кодирование повторялось по числу
+экранов. Теперь кадр кодируется один раз при отправке в группу, а в событии
+передаётся готовый текст ('text') или байты ('bytes'). Строка/байты одинаково
+дёшево проходят через слой каналов: Redis (msgpack одной строки) и
+InMemoryChannelLayer (deepcopy неизменяемого объекта не копирует его).
+
+Консьюмеры, наследующие `EncodedFrameMixin`, отправляют готовый кадр как есть
+и по-прежнему понимают события старого вида со словарём 'message'.
+
+Двоичный протокол: клиент, запросивший при подключении подпротокол 'msgpack'
+(new WebSocket(url, ['msgpack'])), получает те же кадры двоичными сообщениями
+msgpack. Изображения (поля BINARY_IMAGE_FIELDS, в JSON — строки base64)
+передаются в них сырыми байтами. Вариант msgpack тоже кодируется один раз на
+рассылку и кладётся в событие рядом с текстом ('msgpack', для дельт —
+'delta_msgpack'); отключается настройкой WS_BINARY_FRAMES = False.
+"""
+
+
+import base64
+import json
+
+from typing import Any, Dict, Optional, Tuple
+
+from django.conf import settings
+
+try:
+    import msgpack
+except ImportError:  # msgpack устанавливается вместе с channels_redis
+    msgpack = None
+
+
+MSGPACK_SUBPROTOCOL = 'msgpack'
+BINARY_IMAGE_FIELDS = frozenset({'current_png', 'encoded_string'})  # Поля с PNG в base64
+
+
+def encode_frame(frame: Dict[str, Any]) -> str:
+    """
+    Кодирует кадр WebSocket так же, как это делали консьюмеры (json.dumps по умолчанию).
+    """
+    return json.dumps(frame)
+
+
+def binary_images(value: Any) -> Any:
+    """
+    Копия кадра, в которой base64-строки полей BINARY_IMAGE_FIELDS заменены байтами.
+    """
+    if isinstance(value, dict):
+        return {
+            key: base64.b64decode(item) if key in BINARY_IMAGE_FIELDS and isinstance(item, str) else binary_images(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [binary_images(item) for item in value]
+    return value
+
+
+def encode_binary(frame: Dict[str, Any]) -> bytes:
+    """
+    Кодирует кадр для клиентов подпротокола 'msgpack' (изображения — сырыми байтами).
+    """
+    return msgpack.packb(binary_images(frame), use_bin_type=True)
+
+
+def binary_enabled() -> bool:
+    """
+    Кладётся ли в события группы вариант кадра msgpack.
+    """
+    return msgpack is not None and getattr(settings, 'WS_BINARY_FRAMES', True)
+
+
+def frame_event(handler: str, frame: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Событие группы с заранее закодированным кадром.
+
+    Аргументы:
+        handler (str): Имя обработчика консьюмера (поле 'type' события).
+        frame (dict): Кадр, который получит клиент.
+    """
+    event = {'type': handler, 'text': encode_frame(frame)}
+    if binary_enabled():
+        event['msgpack'] = encode_binary(frame)
+    return event
+
+
+async def group_send_frame(channel_layer, group: str, handler: str, frame: Dict[str, Any],
+                           **fields) -> Dict[str, Any]:
+    """
+    Отправляет в группу кадр, закодированный один раз для всех её участников.
+
+    Аргументы:
+        fields: Дополнительные поля события (например, дельта-кадр, см. ingest.py).
+
+    Возвращает:
+        dict: Отправленное событие.
+    """
+    event = frame_event(handler, frame)
+    event.update(fields)
+    await channel_layer.group_send(group, event)
+    return event
+
+
+def event_frame(event: Dict[str, Any], frame_type: str, key: str = 'message',
+                binary: bool = False) -> Tuple[Optional[str], Optional[bytes]]:
+    """
+    Готовый кадр события (текст или байты); для событий старого вида собирает
+    кадр {'type': frame_type, key: event[key]}.
+
+    Для клиента подпротокола 'msgpack' (binary=True) возвращает вариант msgpack;
+    если отправитель его не положил, кадр кодируется здесь.
+    """
+    if 'bytes' in event:
+        return None, event['bytes']
+    if binary:
+        data = event.get('msgpack')
+        if data is None:
+            text = event.get('text')
+            data = encode_binary(json.loads(text) if text is not None else {'type': frame_type, key: event[key]})
+        return None, data
+    text = event.get('text')
+    if text is None:
+        text = encode_frame({'type': frame_type, key: event[key]})
+    return text, None
+
+
+def event_delta(event: Dict[str, Any], binary: bool = False) -> Tuple[Optional[str], Optional[bytes]]:
+    """
+    Дельта-кадр события (см. delta.py) в текстовом или двоичном виде.
+    """
+    if not binary:
+        return event['delta'], None
+    data = event.get('delta_msgpack')
+    if data is None:
+        data = encode_binary(json.loads(event['delta']))
+    return None, data
+
+
+class EncodedFrameMixin:
+    """
+    Отправка клиенту кадра из события группы без повторной сериализации.
+
+    Атрибуты:
+        binary (bool): Клиент согласовал подпротокол 'msgpack'.
+    """
+    binary = False
+
+    def negotiate_subprotocol(self) -> Optional[str]:
+        """
+        Выбирает подпротокол из запрошенных клиентом; результат передаётся в accept().
+        """
+        if msgpack is not None and MSGPACK_SUBPROTOCOL in self.scope.get('subprotocols', ()):
+            self.binary = True
+            return MSGPACK_SUBPROTOCOL
+        return None
+
+    def client_frame(self, frame: Dict[str, Any]) -> Tuple[Optional[str], Optional[bytes]]:
+        """
+        Кодирует кадр для этого соединения: JSON или msgpack.
+        """
+        if self.binary:
+            return None, encode_binary(frame)
+        return encode_frame(frame), None
+
+    async def send_frame(self, event: Dict[str, Any], frame_type: str, key: str = 'message'):
+        text, data = event_frame(event, frame_type, key, self.binary)
+        await self.deliver(text, data, event)
+
+    async def deliver(self, text: Optional[str], data: Optional[bytes], event: Dict[str, Any] = None):
+        """
+        Передаёт кадр в сокет. Переопределяется для буферизованной отправки (outbound.py).
+        """
+        await self.send(text_data=text, bytes_data=data)
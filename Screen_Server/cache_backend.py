@@ -0,0 +1,410 @@
+"""
+Двухуровневый кэш Django: локальная LRU-копия в процессе перед Redis.
+
+Ключи маршрута (cached_STOPS, cached_CURRENT_NEXT_INDEX, current_station_index)
+читаются на каждое подключение экрана и из процессов, которые сами состояние
+не ведут (см. state.py). С django_redis каждое чтение — обращение к Redis по
+сети и распаковка pickle.
+
+TwoTierCache — бэкенд кэша Django с тем же API:
+- чтение сначала ищет значение в локальном уровне процесса (не больше
+  LOCAL_MAX_ENTRIES записей, вытеснение по LRU, срок LOCAL_TTL секунд), затем
+  в удалённом бэкенде (REMOTE_BACKEND, по умолчанию django_redis) и сохраняет
+  результат локально — в том числе отсутствие ключа;
+- запись идёт в удалённый бэкенд и локальный уровень, а затем в канал Redis
+  pub/sub INVALIDATION_CHANNEL публикуется список изменённых ключей;
+- каждый процесс подписан на этот канал и удаляет у себя изменённые другими
+  процессами ключи. Пока подписка не установлена (запуск, обрыв соединения),
+  локальный уровень не используется, а после (пере)подключения очищается:
+  пропущенные сообщения не оставляют устаревших копий. LOCAL_TTL ограничивает
+  устаревание, если сообщение всё же потеряется.
+
+Django создаёт экземпляр бэкенда в каждом потоке, поэтому локальный уровень и
+подписка общие для всех экземпляров процесса с одинаковыми LOCATION и каналом
+(get_local_tier). Значения из локального уровня не копируются: все читатели
+процесса получают один и тот же объект, изменять его нельзя (только заменять
+через set).
+
+Без INVALIDATION_CHANNEL (один процесс) локальный уровень работает только по
+сроку LOCAL_TTL.
+
+Сообщение об изменении содержит и имена ключей, переданные в set/set_many;
+по ним другие кэши процесса, собранные из этих ключей (например, начальные
+кадры экранов, bootstrap.py), узнают об изменениях через
+add_invalidation_listener.
+
+Пример настройки:
+    CACHES = {
+        'default': {
+            'BACKEND': 'Screen_Server.cache_backend.TwoTierCache',
+            'LOCATION': 'redis://127.0.0.1:6379/1',
+            'OPTIONS': {
+                'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+                'LOCAL_MAX_ENTRIES': 1024,
+                'LOCAL_TTL': 5.0,
+                'INVALIDATION_CHANNEL': 'screen_server.cache_invalidate',
+            },
+        }
+    }
+"""
+
+
+import json
+import logging
+import threading
+import time
+import uuid
+
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.utils.module_loading import import_string
+
+
+TWO_TIER_OPTIONS = ('REMOTE_BACKEND', 'LOCAL_MAX_ENTRIES', 'LOCAL_TTL', 'INVALIDATION_CHANNEL')
+RESUBSCRIBE_DELAY = 1.0  # Сек между попытками восстановить подписку
+
+_MISSING = object()
+_MISSING_REMOTE = object()  # Ключа нет и в удалённом бэкенде (отрицательная запись)
+
+# Обработчики изменений ключей другими процессами (add_invalidation_listener)
+_invalidation_listeners: List[Callable[[Optional[List[str]]], None]] = []
+
+
+class LocalTier:
+    """
+    Локальный уровень процесса: словарь, ограниченный числом записей (вытеснение
+    по LRU) и сроком жизни, и подписка на изменения ключей в других процессах.
+
+    Атрибуты:
+        generation (int): Номер изменения; растёт при каждом удалении ключей.
+        subscribed (bool): Подписка действует — локальным копиям можно доверять.
+        hits (int): Чтений, обслуженных локальным уровнем.
+        misses (int): Чтений, ушедших в удалённый бэкенд.
+        evictions (int): Записей вытеснено по LRU.
+        invalidations (int): Ключей, удалённых по сообщениям других процессов.
+    """
+    def __init__(self, max_entries: int, ttl: float, channel: Optional[str] = None,
+                 connect: Callable[[], Any] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.channel = channel
+        self.connect = connect
+        self.node_id = uuid.uuid4().hex
+        self.generation = 0
+        self.subscribed = channel is None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries: 'OrderedDict[str, Tuple[float, Any]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._publisher = None
+        self._listener: Optional[threading.Thread] = None
+
+    # Записи
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return _MISSING
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return _MISSING
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: str, value: Any, timeout: Optional[float] = None, generation: int = None):
+        """
+        Сохраняет значение на min(ttl, timeout) секунд.
+
+        generation — номер, полученный до чтения из удалённого бэкенда: если с тех
+        пор ключи удалялись, прочитанное значение могло устареть и не сохраняется.
+        """
+        ttl = self.ttl if timeout is None else min(self.ttl, timeout)
+        if ttl <= 0 or not self.subscribed:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, keys: Iterable[str]):
+        with self._lock:
+            self.generation += 1
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    # Подписка на изменения
+
+    def enabled(self) -> bool:
+        """
+        Можно ли читать из локального уровня (подписка действует); запускает подписку.
+        """
+        if self.channel is not None and (self._listener is None or not self._listener.is_alive()):
+            with self._lock:
+                if self._listener is None or not self._listener.is_alive():
+                    self._listener = threading.Thread(target=self._listen, name='cache-invalidation', daemon=True)
+                    self._listener.start()
+        return self.subscribed
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.connect().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                # Сообщения, пропущенные без подписки, не дошли: копии могли устареть
+                self.clear()
+                notify_invalidation(None)
+                self.subscribed = True
+                logging.info(f"Кэш: подписка на {self.channel} установлена")
+                for message in pubsub.listen():
+                    if message.get('type') == 'message':
+                        self.on_message(message['data'])
+            except Exception as e:
+                logging.warning(f"Кэш: подписка на {self.channel} прервана: {e}")
+            self.subscribed = False
+            self.clear()
+            time.sleep(RESUBSCRIBE_DELAY)
+
+    def on_message(self, data: Any):
+        try:
+            message = json.loads(data)
+        except (TypeError, ValueError):
+            return
+        if message.get('node') == self.node_id:
+            return
+        keys = message.get('keys')
+        if keys is None:
+            self.clear()
+        else:
+            self.discard(keys)
+            self.invalidations += len(keys)
+        notify_invalidation(None if keys is None else message.get('names'))
+
+    def publish(self, keys: Optional[List[str]], names: Optional[List[str]] = None):
+        """
+        Сообщает другим процессам об изменённых ключах (None — очищен весь кэш);
+        names — те же ключи в том виде, в каком их передали в кэш.
+        """
+        if self.channel is None:
+            return
+        try:
+            if self._publisher is None:
+                self._publisher = self.connect()
+            self._publisher.publish(self.channel, json.dumps({'node': self.node_id, 'keys': keys, 'names': names}))
+        except Exception as e:
+            self._publisher = None
+            logging.error(f"Кэш: не удалось опубликовать изменение ключей: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'local_entries': len(self._entries),
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'subscribed': self.subscribed,
+        }
+
+
+def add_invalidation_listener(callback: Callable[[Optional[List[str]]], None]):
+    """
+    Регистрирует функцию, которую поток подписки вызывает с именами ключей,
+    изменённых другими процессами (None — могло измениться всё).
+    """
+    _invalidation_listeners.append(callback)
+
+
+def notify_invalidation(names: Optional[List[str]]):
+    for callback in list(_invalidation_listeners):
+        try:
+            callback(names)
+        except Exception as e:
+            logging.error(f"Кэш: ошибка обработчика изменения ключей: {e}")
+
+
+_tiers: Dict[Tuple, LocalTier] = {}
+_tiers_lock = threading.Lock()
+
+
+def redis_connector(location) -> Callable[[], Any]:
+    """
+    Фабрика клиентов redis-py для адреса LOCATION (первого, если их несколько).
+    """
+    if isinstance(location, (list, tuple)):
+        location = location[0]
+    location = location.split(',')[0]
+
+    def connect():
+        import redis
+
+        return redis.Redis.from_url(location)
+    return connect
+
+
+def get_local_tier(location, channel: Optional[str], max_entries: int, ttl: float) -> LocalTier:
+    """
+    Общий локальный уровень процесса для адреса и канала.
+    """
+    key = (str(location), channel, max_entries, ttl)
+    with _tiers_lock:
+        tier = _tiers.get(key)
+        if tier is None:
+            tier = _tiers[key] = LocalTier(max_entries, ttl, channel, redis_connector(location))
+        return tier
+
+
+class TwoTierCache(BaseCache):
+    """
+    Бэкенд кэша Django: локальный уровень (LocalTier) перед удалённым бэкендом.
+
+    Атрибуты:
+        remote (BaseCache): Удалённый бэкенд (Redis).
+        local (LocalTier): Локальный уровень процесса.
+    """
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = dict(params.get('OPTIONS', {}))
+        local_options = {name: options.pop(name) for name in TWO_TIER_OPTIONS if name in options}
+
+        remote_params = dict(params, OPTIONS=options)
+        remote_params.pop('BACKEND', None)
+        backend = local_options.get('REMOTE_BACKEND', 'django_redis.cache.RedisCache')
+        self.remote = import_string(backend)(location, remote_params)
+        self.local = get_local_tier(
+            location,
+            local_options.get('INVALIDATION_CHANNEL'),
+            local_options.get('LOCAL_MAX_ENTRIES', 1024),
+            local_options.get('LOCAL_TTL', 5.0),
+        )
+
+    def _local_timeout(self, timeout) -> Optional[float]:
+        timeout = self.get_backend_timeout(timeout)
+        return None if timeout is None else max(0.0, timeout - time.time())
+
+    # Чтение
+
+    def get(self, key, default=None, version=None):
+        local = self.local
+        local_key = self.make_and_validate_key(key, version)
+        if local.enabled():
+            value = local.get(local_key)
+            if value is not _MISSING:
+                local.hits += 1
+                return default if value is _MISSING_REMOTE else value
+        local.misses += 1
+        generation = local.generation
+        value = self.remote.get(key, _MISSING, version)
+        local.put(local_key, _MISSING_REMOTE if value is _MISSING else value, generation=generation)
+        return default if value is _MISSING else value
+
+    def get_many(self, keys, version=None):
+        local = self.local
+        found = {}
+        remote_keys = []
+        enabled = local.enabled()
+        for key in keys:
+            value = local.get(self.make_and_validate_key(key, version)) if enabled else _MISSING
+            if value is _MISSING:
+                remote_keys.append(key)
+                continue
+            local.hits += 1
+            if value is not _MISSING_REMOTE:
+                found[key] = value
+        if not remote_keys:
+            return found
+        local.misses += len(remote_keys)
+        generation = local.generation
+        values = self.remote.get_many(remote_keys, version)
+        found.update(values)
+        for key in remote_keys:
+            local.put(self.make_key(key, version), values.get(key, _MISSING_REMOTE), generation=generation)
+        return found
+
+    def has_key(self, key, version=None):
+        return self.get(key, _MISSING, version) is not _MISSING
+
+    # Запись
+
+    def _changed(self, local_keys: List[str], keys: List[str]):
+        self.local.discard(local_keys)
+        self.local.publish(local_keys, [str(key) for key in keys])
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        local_key = self.make_and_validate_key(key, version)
+        self.remote.set(key, value, timeout, version)
+        self._changed([local_key], [key])
+        self.local.put(local_key, value, self._local_timeout(timeout))
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        added = self.remote.add(key, value, timeout, version)
+        if added:
+            self._changed([self.make_and_validate_key(key, version)], [key])
+        return added
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        failed = self.remote.set_many(data, timeout, version) or []
+        local_keys = {self.make_and_validate_key(key, version): key for key in data}
+        self._changed(list(local_keys), list(local_keys.values()))
+        local_timeout = self._local_timeout(timeout)
+        for local_key, key in local_keys.items():
+            if key not in failed:
+                self.local.put(local_key, data[key], local_timeout)
+        return failed
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        return self.remote.touch(key, timeout, version)
+
+    def delete(self, key, version=None):
+        deleted = self.remote.delete(key, version)
+        self._changed([self.make_and_validate_key(key, version)], [key])
+        return deleted
+
+    def delete_many(self, keys, version=None):
+        keys = list(keys)
+        result = self.remote.delete_many(keys, version)
+        self._changed([self.make_and_validate_key(key, version) for key in keys], keys)
+        return result
+
+    def incr(self, key, delta=1, version=None):
+        value = self.remote.incr(key, delta, version)
+        self._changed([self.make_and_validate_key(key, version)], [key])
+        return value
+
+    def decr(self, key, delta=1, version=None):
+        value = self.remote.decr(key, delta, version)
+        self._changed([self.make_and_validate_key(key, version)], [key])
+        return value
+
+    def clear(self):
+        self.remote.clear()
+        self.local.clear()
+        self.local.publish(None)
+
+    def close(self, **kwargs):
+        self.remote.close(**kwargs)
+
+    def __getattr__(self, name):
+        # Остальные методы удалённого бэкенда (например, ttl и keys у django_redis)
+        remote = self.__dict__.get('remote')
+        if remote is None:
+            raise AttributeError(name)
+        return getattr(remote, name)
+
+    def stats(self) -> Dict[str, Any]:
+        return self.local.stats()
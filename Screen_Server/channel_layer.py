@@ -0,0 +1,383 @@
+"""
+Гибридный слой каналов: доставка внутри процесса напрямую, Redis — только между процессами.
+
+В однопроцессном развёртывании (Daphne + сервис приёма в потоке того же процесса)
+каждое сообщение группы при channels_redis проходило сериализацию msgpack и
+обращение к Redis, хотя отправитель и получатели находятся в одном процессе.
+`HybridChannelLayer` сохраняет API слоя каналов (send/receive/new_channel,
+group_add/group_discard/group_send, flush) и работает так:
+
+- каналы, созданные в процессе (new_channel), — это asyncio.Queue в цикле
+  событий консьюмера; сообщение кладётся в очередь напрямую, из другого потока
+  (например, из сервиса приёма) — через loop.call_soon_threadsafe. Сообщение не
+  копируется: один и тот же словарь получают все локальные участники группы;
+- если задан CONFIG['hosts'], процесс заводит в Redis один канал-посредник и
+  вносит в группы Redis только его (по одному на процесс, а не на соединение);
+  посредник получателя раздаёт сообщение своим локальным участникам;
+- send() в канал другого процесса уходит через его посредника.
+
+Какие группы есть у других процессов, слой узнаёт из реестра участников:
+посредники состоят в группе Redis MEMBERSHIP_GROUP и рассылают в неё список
+своих групп — при появлении и исчезновении группы в процессе, раз в
+membership_interval секунд и в ответ на запрос нового процесса. Запись
+процесса, не обновлённая за MEMBERSHIP_TTL интервалов, считается устаревшей.
+Посредник и обновление реестра работают в цикле событий консьюмеров, даже
+если первым group_send вызвал поток сервиса приёма.
+group_send отправляет сообщение в Redis, только если группа есть в реестре
+у другого процесса; первые MEMBERSHIP_WARMUP секунд после запуска посредника,
+пока реестр собирается, — всегда. Тем же периодическим обновлением посредник
+заново вносится в свои группы Redis, чтобы членство не истекало по
+group_expiry channels_redis (membership_interval должен быть меньше него).
+
+Без 'hosts' слой работает только внутри процесса.
+
+Пример настройки:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'Screen_Server.channel_layer.HybridChannelLayer',
+            'CONFIG': {'hosts': [('localhost', 6379)], 'capacity': 100},
+        }
+    }
+"""
+
+
+import asyncio
+import logging
+import time
+import uuid
+
+from typing import Any, Dict, FrozenSet, Optional, Set, Tuple
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+
+TARGET_KEY = '__hybrid_target'   # Канал-получатель сообщения, пришедшего через посредника
+GROUP_KEY = '__hybrid_group'     # Группа сообщения, пришедшего через посредника
+ORIGIN_KEY = '__hybrid_origin'   # Посредник процесса-отправителя
+
+MEMBERSHIP_GROUP = 'hybrid.membership'  # Группа Redis реестра участников
+MEMBERSHIP_TYPE = 'hybrid.membership'   # Сообщение реестра: группы процесса-отправителя
+MEMBERSHIP_TTL = 3                      # Интервалов без обновления до устаревания записи
+MEMBERSHIP_WARMUP = 2.0                 # Сек после запуска посредника, пока реестр собирается
+
+
+class HybridChannelLayer(BaseChannelLayer):
+    """
+    Слой каналов с прямой доставкой внутри процесса и Redis для остальных.
+
+    Атрибуты:
+        proxy_channel (str): Канал-посредник процесса в Redis (префикс локальных каналов).
+        remote (RedisChannelLayer | None): Слой Redis, если заданы hosts.
+        membership_interval (float): Период публикации групп процесса в реестре (сек).
+        local_delivered (int): Сообщений доставлено напрямую.
+        remote_sent (int): Сообщений отправлено через Redis.
+        dropped (int): Сообщений отброшено из-за переполнения локальной очереди.
+    """
+    extensions = ['groups', 'flush']
+
+    def __init__(self, hosts=None, expiry=60, capacity=100, channel_capacity=None,
+                 membership_interval=30.0, **redis_config):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity)
+        self.channel_capacity = self.compile_capacities(self.channel_capacity)
+        self.proxy_channel = f'hybrid.{uuid.uuid4().hex}'
+        self.remote = None
+        if hosts:
+            from channels_redis.core import RedisChannelLayer
+            self.remote = RedisChannelLayer(hosts=hosts, expiry=expiry, capacity=capacity, **redis_config)
+        self.membership_interval = membership_interval
+
+        # канал → (очередь, цикл событий получателя)
+        self._channels: Dict[str, Tuple[asyncio.Queue, asyncio.AbstractEventLoop]] = {}
+        self._groups: Dict[str, Set[str]] = {}
+        self._foreign_groups: Dict[str, int] = {}  # группа → каналы не из процесса, внесённые отсюда
+        self._peers: Dict[str, Tuple[float, FrozenSet[str]]] = {}  # посредник → (срок записи, группы)
+        self._warm_until = 0.0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None  # цикл консьюмеров: в нём работает посредник
+        self._proxy_task: Optional[asyncio.Task] = None
+        self._membership_task: Optional[asyncio.Task] = None
+        self._reply_task: Optional[asyncio.Task] = None
+        self.local_delivered = 0
+        self.remote_sent = 0
+        self.dropped = 0
+
+    # Локальная доставка
+
+    def _is_local(self, channel: str) -> bool:
+        return channel in self._channels
+
+    def _deliver(self, channel: str, message: Dict[str, Any], raise_full: bool = False):
+        record = self._channels.get(channel)
+        if record is None:
+            return
+        queue, loop = record
+        if loop is self._running_loop():
+            if queue.full():
+                self.dropped += 1
+                if raise_full:
+                    raise ChannelFull(channel)
+                return
+            queue.put_nowait(message)
+            self.local_delivered += 1
+            return
+        try:
+            loop.call_soon_threadsafe(self._put_threadsafe, queue, message)
+        except RuntimeError:
+            # Цикл получателя закрыт — канал больше не читается
+            self._forget_channel(channel)
+
+    def _put_threadsafe(self, queue: asyncio.Queue, message: Dict[str, Any]):
+        if queue.full():
+            self.dropped += 1
+            return
+        queue.put_nowait(message)
+        self.local_delivered += 1
+
+    def _fanout(self, group: str, message: Dict[str, Any]):
+        for channel in list(self._groups.get(group, ())):
+            self._deliver(channel, message)
+
+    def _forget_channel(self, channel: str):
+        self._channels.pop(channel, None)
+        for group, members in list(self._groups.items()):
+            members.discard(channel)
+
+    # API слоя каналов
+
+    async def new_channel(self, prefix: str = 'specific') -> str:
+        channel = f'{self.proxy_channel}!{prefix}.{uuid.uuid4().hex}'
+        loop = asyncio.get_running_loop()
+        self._channels[channel] = (asyncio.Queue(self.get_capacity(channel)), loop)
+        if self._loop is None or self._loop.is_closed():
+            self._loop = loop
+        if self.remote is not None:
+            self._ensure_proxy()
+        return channel
+
+    async def send(self, channel: str, message: Dict[str, Any]):
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        if self._is_local(channel):
+            self._deliver(channel, message, raise_full=True)
+            return
+        if self.remote is None:
+            return
+        self.remote_sent += 1
+        if channel.startswith('hybrid.') and '!' in channel:
+            # Канал другого гибридного процесса: через его посредника
+            proxy = channel.split('!', 1)[0]
+            await self.remote.send(proxy, dict(message, **{TARGET_KEY: channel}))
+        else:
+            await self.remote.send(channel, message)
+
+    async def receive(self, channel: str) -> Dict[str, Any]:
+        record = self._channels.get(channel)
+        if record is None:
+            if self.remote is None:
+                raise ValueError(f'Канал {channel} не принадлежит процессу')
+            return await self.remote.receive(channel)
+        try:
+            return await record[0].get()
+        except asyncio.CancelledError:
+            # Чтение отменяется, когда консьюмер завершён: канал больше не нужен
+            self._forget_channel(channel)
+            raise
+
+    async def group_add(self, group: str, channel: str):
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        if not self._is_local(channel):
+            if self.remote is not None:
+                await self.remote.group_add(group, channel)
+                self._foreign_groups[group] = self._foreign_groups.get(group, 0) + 1
+            return
+        members = self._groups.setdefault(group, set())
+        first = not members
+        members.add(channel)
+        if self.remote is not None:
+            # Обновляет и срок жизни членства посредника в группе Redis
+            await self.remote.group_add(group, self.proxy_channel)
+            if first:
+                await self._announce()
+
+    async def group_discard(self, group: str, channel: str):
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        if not self._is_local(channel):
+            if self.remote is not None:
+                await self.remote.group_discard(group, channel)
+                if group in self._foreign_groups:
+                    self._foreign_groups[group] -= 1
+                    if self._foreign_groups[group] <= 0:
+                        del self._foreign_groups[group]
+            return
+        members = self._groups.get(group)
+        if members is not None:
+            members.discard(channel)
+            if not members:
+                del self._groups[group]
+                if self.remote is not None:
+                    await self.remote.group_discard(group, self.proxy_channel)
+                    await self._announce()
+
+    async def group_send(self, group: str, message: Dict[str, Any]):
+        assert isinstance(message, dict), 'Message is not a dict'
+        assert self.valid_group_name(group), 'Group name not valid'
+        self._fanout(group, message)
+        if self.remote is not None and self._has_remote_members(group):
+            self.remote_sent += 1
+            await self.remote.group_send(group, dict(message, **{GROUP_KEY: group, ORIGIN_KEY: self.proxy_channel}))
+
+    async def flush(self):
+        self._channels.clear()
+        self._groups.clear()
+        self._foreign_groups.clear()
+        self._peers.clear()
+        if self.remote is not None:
+            await self.remote.flush()
+
+    async def close_pools(self):
+        self._cancel_proxy()
+        if self.remote is not None:
+            await self.remote.close_pools()
+
+    # Межпроцессная доставка
+
+    def _has_remote_members(self, group: str) -> bool:
+        """
+        Есть ли в группе участники других процессов (по реестру, без обращения к Redis).
+        """
+        self._ensure_proxy()
+        now = time.monotonic()
+        if now < self._warm_until or group in self._foreign_groups:
+            return True
+        return any(expires > now and group in groups for expires, groups in list(self._peers.values()))
+
+    def _ensure_proxy(self):
+        """
+        Запускает посредника и обновление реестра в цикле событий консьюмеров.
+
+        group_send вызывается и из других циклов — потока сервиса приёма или
+        временного цикла async_to_sync; задачи, созданные там, остались бы
+        навсегда в ожидании после остановки цикла. Поэтому задачи создаются в
+        цикле, где заведены каналы процесса (new_channel), а пока каналов нет —
+        в текущем цикле; задачи в закрытом или чужом цикле создаются заново.
+        """
+        running = self._running_loop()
+        loop = self._loop if self._loop is not None and not self._loop.is_closed() else running
+        if loop is None:
+            return
+        task = self._proxy_task
+        if task is not None and not task.done() and task.get_loop() is loop:
+            return
+        self._warm_until = time.monotonic() + MEMBERSHIP_WARMUP
+        if loop is not running:
+            try:
+                loop.call_soon_threadsafe(self._ensure_proxy)
+            except RuntimeError:
+                pass
+            return
+        self._cancel_proxy()
+        self._proxy_task = loop.create_task(self._run_proxy())
+        self._membership_task = loop.create_task(self._refresh_membership())
+
+    @staticmethod
+    def _running_loop() -> Optional[asyncio.AbstractEventLoop]:
+        try:
+            return asyncio.get_running_loop()
+        except RuntimeError:
+            return None
+
+    def _cancel_proxy(self):
+        for task in (self._proxy_task, self._membership_task):
+            if task is None or task.done():
+                continue
+            loop = task.get_loop()
+            if loop.is_closed():
+                continue
+            if loop is self._running_loop():
+                task.cancel()
+                continue
+            try:
+                loop.call_soon_threadsafe(task.cancel)
+            except RuntimeError:
+                pass
+        self._proxy_task = self._membership_task = None
+
+    async def _announce(self, query: bool = False):
+        """
+        Публикует в реестре группы процесса; query=True просит остальных ответить тем же.
+        """
+        try:
+            await self.remote.group_send(MEMBERSHIP_GROUP, {
+                'type': MEMBERSHIP_TYPE,
+                'origin': self.proxy_channel,
+                'groups': list(self._groups),
+                'query': query,
+            })
+        except Exception as e:
+            logging.error(f"Не удалось опубликовать группы посредника {self.proxy_channel}: {e}")
+
+    def _on_membership(self, message: Dict[str, Any]):
+        origin = message.get('origin')
+        if origin is None or origin == self.proxy_channel:
+            return
+        groups = frozenset(message.get('groups') or ())
+        self._peers[origin] = (time.monotonic() + self.membership_interval * MEMBERSHIP_TTL, groups)
+        if message.get('query'):
+            self._reply_task = asyncio.get_running_loop().create_task(self._announce())
+
+    async def _refresh_membership(self):
+        """
+        Периодически обновляет членство посредника в группах Redis и запись в реестре.
+        """
+        query = True
+        while True:
+            try:
+                for group in [MEMBERSHIP_GROUP, *self._groups]:
+                    await self.remote.group_add(group, self.proxy_channel)
+            except Exception as e:
+                logging.error(f"Не удалось обновить группы посредника {self.proxy_channel}: {e}")
+            await self._announce(query)
+            query = False
+            now = time.monotonic()
+            for origin, (expires, _) in list(self._peers.items()):
+                if expires <= now:
+                    self._peers.pop(origin, None)
+            await asyncio.sleep(self.membership_interval)
+
+    async def _run_proxy(self):
+        """
+        Посредник процесса: принимает из Redis сообщения групп и каналов процесса.
+        """
+        while True:
+            try:
+                message = await self.remote.receive(self.proxy_channel)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Ошибка приёма из Redis посредником {self.proxy_channel}: {e}")
+                await asyncio.sleep(1.0)
+                continue
+            if message.get('type') == MEMBERSHIP_TYPE:
+                self._on_membership(message)
+                continue
+            target = message.pop(TARGET_KEY, None)
+            group = message.pop(GROUP_KEY, None)
+            origin = message.pop(ORIGIN_KEY, None)
+            if target is not None:
+                self._deliver(target, message)
+            elif group is not None and origin != self.proxy_channel:
+                self._fanout(group, message)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'proxy_channel': self.proxy_channel,
+            'remote': self.remote is not None,
+            'channels': len(self._channels),
+            'groups': {group: len(members) for group, members in list(self._groups.items())},
+            'peers': {origin: sorted(groups) for origin, (_, groups) in list(self._peers.items())},
+            'local_delivered': self.local_delivered,
+            'remote_sent': self.remote_sent,
+            'dropped': self.dropped,
+        }
@@ -1,84 +1,260 @@
-import threading
+"""
+Реестр подключённых WebSocket-клиентов с вторичными индексами.
+
+Записи добавляются и удаляются консьюмерами в цикле событий Daphne, а читаются
+и из него, и из других потоков (разбор ConfigureData в сервисе приёма). Реестр
+работает по принципу копирования при записи: register/unregister собирают новое
+состояние (словарь клиентов и затронутые индексы) и подменяют его одной ссылкой.
+Чтение не берёт блокировок и не копирует данные — читатель всегда видит целое
+состояние, поэтому консьюмеры вызывают реестр напрямую, без sync_to_async.
+Подключения и отключения редки по сравнению с чтением на каждом пакете.
+
+Индексы: (ip, port) → клиент; IP; (поезд, вагон); (поезд, сторона); IP коммутатора.
+"""
+
+
 import logging
+import time
+
+from types import MappingProxyType
+from typing import Any, Dict, FrozenSet, Iterable, List, Mapping, NamedTuple, Optional, Tuple
+
+from .groups import ScreenAddress
+
+
+Key = Tuple[str, int]
+
+
+class ClientEntry:
+    """
+    Подключённый клиент.
+
+    Атрибуты:
+        ip (str): IP-адрес клиента.
+        port (int): Порт клиента.
+        channel_name (str): Имя WebSocket-канала клиента.
+        address (ScreenAddress | None): Положение экрана в поезде (см. groups.py).
+        switch (str | None): IP коммутатора, через который подключён экран.
+        connected_at (float): Время подключения (time.time()).
+    """
+    __slots__ = ('ip', 'port', 'channel_name', 'address', 'switch', 'connected_at')
+
+    def __init__(self, ip: str, port: int, channel_name: str, address: ScreenAddress = None, switch: str = None):
+        self.ip = ip
+        self.port = port
+        self.channel_name = channel_name
+        self.address = address
+        self.switch = switch
+        self.connected_at = time.time()
+
+    @property
+    def key(self) -> Key:
+        return self.ip, self.port
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {'ip': self.ip, 'port': self.port, 'channel': self.channel_name}
+
+    def __repr__(self):
+        return f'ClientEntry({self.ip}:{self.port} → {self.channel_name})'
 
-from typing import Dict, Tuple
+
+class _State(NamedTuple):
+    clients: Mapping[Key, ClientEntry]
+    by_ip: Mapping[str, FrozenSet[Key]]
+    by_wagon: Mapping[Tuple[Optional[int], int], FrozenSet[Key]]
+    by_side: Mapping[Tuple[Optional[int], str], FrozenSet[Key]]
+    by_switch: Mapping[str, FrozenSet[Key]]
+
+
+_EMPTY: FrozenSet[Key] = frozenset()
+
+
+def _index_keys(entry: ClientEntry) -> Dict[str, Any]:
+    """
+    Ключи записи во вторичных индексах (None — запись в индекс не входит).
+    """
+    address = entry.address
+    wagon = side = None
+    if address is not None:
+        if address.wagon is not None:
+            wagon = (address.train, address.wagon)
+        if address.side is not None:
+            side = (address.train, address.side)
+    return {'by_ip': entry.ip, 'by_wagon': wagon, 'by_side': side, 'by_switch': entry.switch}
+
+
+def _with(index: Mapping, value, key: Key, add: bool) -> Mapping:
+    """
+    Копия индекса, в которой ключ клиента добавлен в группу value или удалён из неё.
+    """
+    if value is None:
+        return index
+    changed = dict(index)
+    members = index.get(value, _EMPTY)
+    members = members | {key} if add else members - {key}
+    if members:
+        changed[value] = members
+    else:
+        changed.pop(value, None)
+    return MappingProxyType(changed)
 
 
 class ClientRegistry:
     """
-    Потокобезопасный реестр подключённых WebSocket-клиентов.
-    Сопоставляет IP-адрес и порт клиента с именем его канала (channel_name).
-    Используется для отслеживания подключений и маршрутизации сообщений.
+    Реестр подключённых клиентов: копирование при записи, чтение без блокировок.
 
-    Формат ключей: (ip: str, port: int) → channel_name: str
+    Изменять реестр следует из одного цикла событий (консьюмеры); читать — откуда угодно.
+
+    Формат основного ключа: (ip: str, port: int) → ClientEntry.
     """
     def __init__(self):
-        """
-        Инициализирует пустой словарь клиентов и объект блокировки для обеспечения потокобезопасности.
-        """
-        self._clients: Dict[Tuple[str, int], str] = {}
-        self._lock = threading.Lock()
+        empty = MappingProxyType({})
+        self._state = _State(empty, empty, empty, empty, empty)
+
+    # Запись
 
-    def register(self, ip: str, port: int, channel_name: str):
+    def register(self, ip: str, port: int, channel_name: str,
+                 address: ScreenAddress = None, switch: str = None) -> ClientEntry:
         """
-        Регистрирует нового клиента по его IP, порту и имени канала.
+        Регистрирует клиента; повторная регистрация того же (ip, port) заменяет запись.
 
         Аргументы:
             ip (str): IP-адрес клиента.
             port (int): Порт клиента.
             channel_name (str): Имя WebSocket-канала клиента.
+            address (ScreenAddress): Положение экрана в поезде.
+            switch (str): IP коммутатора экрана (для ConfigureData.map_devices).
         """
-        with self._lock:
-            self._clients[(ip, port)] = channel_name
-            logging.info(f'Client registered {self._clients[(ip, port)]}')
+        entry = ClientEntry(ip, port, channel_name, address, switch)
+        state = self._state
+        previous = state.clients.get(entry.key)
+        if previous is not None:
+            state = self._without(state, previous)
+        self._state = self._with_entry(state, entry)
+        logging.info(f'Client registered {ip}:{port} {channel_name}')
+        return entry
 
-    def unregister(self, ip: str, port: int):
+    def unregister(self, ip: str, port: int) -> Optional[ClientEntry]:
         """
         Удаляет клиента из реестра по IP и порту.
 
-        Аргументы:
-            ip (str): IP-адрес клиента.
-            port (int): Порт клиента.
+        Возвращает:
+            ClientEntry | None: Удалённая запись или None, если клиента не было.
         """
-        with self._lock:
-            self._clients.pop((ip, port), None)
-            logging.info(f'Client unregistered {self._clients[(ip, port)]}')
+        entry = self._state.clients.get((ip, port))
+        if entry is None:
+            return None
+        self._state = self._without(self._state, entry)
+        logging.info(f'Client unregistered {ip}:{port} {entry.channel_name}')
+        return entry
 
-    def get_channel_name(self, ip: str, port: int) -> str:
+    def update(self, ip: str, port: int, channel_name: str):
+        """
+        Обновляет канал существующего клиента или регистрирует нового.
         """
-        Возвращает имя канала клиента по IP и порту.
+        entry = self._state.clients.get((ip, port))
+        if entry is None:
+            self.register(ip, port, channel_name)
+        else:
+            self.register(ip, port, channel_name, entry.address, entry.switch)
 
-        Аргументы:
-            ip (str): IP-адрес клиента.
-            port (int): Порт клиента.
+    @staticmethod
+    def _with_entry(state: _State, entry: ClientEntry) -> _State:
+        clients = dict(state.clients)
+        clients[entry.key] = entry
+        keys = _index_keys(entry)
+        return _State(
+            MappingProxyType(clients),
+            *(_with(getattr(state, name), keys[name], entry.key, True) for name in _State._fields[1:])
+        )
 
-        Возвращает:
-            str: channel_name клиента, если найден; иначе None.
+    @staticmethod
+    def _without(state: _State, entry: ClientEntry) -> _State:
+        clients = dict(state.clients)
+        del clients[entry.key]
+        keys = _index_keys(entry)
+        return _State(
+            MappingProxyType(clients),
+            *(_with(getattr(state, name), keys[name], entry.key, False) for name in _State._fields[1:])
+        )
+
+    # Чтение
+
+    def get(self, ip: str, port: int) -> Optional[ClientEntry]:
+        return self._state.clients.get((ip, port))
+
+    def get_channel_name(self, ip: str, port: int) -> Optional[str]:
+        """
+        Возвращает имя канала клиента по IP и порту или None, если клиент не найден.
         """
-        with self._lock:
-            logging.info(f'Get channel name {self._clients[(ip, port)]}')
-            return self._clients.get((ip, port))
+        entry = self._state.clients.get((ip, port))
+        return entry.channel_name if entry is not None else None
 
-    def get_all_clients(self) -> Dict[Tuple[str, int], str]:
+    def get_all_clients(self) -> Mapping[Key, str]:
         """
-        Возвращает копию текущего реестра клиентов.
+        Текущие клиенты и их каналы: (ip, port) → channel_name.
+        """
+        return {key: entry.channel_name for key, entry in self._state.clients.items()}
 
-        Возвращает:
-            Dict[Tuple[str, int], str]: Словарь всех клиентов и их каналов.
+    def entries(self) -> Iterable[ClientEntry]:
         """
-        with self._lock:
-            logging.info(f'All clients {dict(self._clients)}')
-            return dict(self._clients)
+        Все записи текущего состояния (без копирования).
+        """
+        return self._state.clients.values()
 
-    def update(self, ip: str, port: int, channel_name: str):
+    def by_ip(self, ip: str) -> List[ClientEntry]:
+        state = self._state
+        return [state.clients[key] for key in state.by_ip.get(ip, _EMPTY)]
+
+    def has_ip(self, ip: str) -> bool:
+        return ip in self._state.by_ip
+
+    def by_wagon(self, wagon: int, train: int = None) -> List[ClientEntry]:
+        state = self._state
+        return [state.clients[key] for key in state.by_wagon.get((train, wagon), _EMPTY)]
+
+    def by_side(self, side: str, train: int = None) -> List[ClientEntry]:
+        state = self._state
+        return [state.clients[key] for key in state.by_side.get((train, side), _EMPTY)]
+
+    def by_switch(self, switch_ip: str) -> Dict[int, ClientEntry]:
         """
-        Обновляет канал существующего клиента или регистрирует нового.
+        Клиенты коммутатора: порт → запись.
+        """
+        state = self._state
+        return {key[1]: state.clients[key] for key in state.by_switch.get(switch_ip, _EMPTY)}
 
-        Аргументы:
-            ip (str): IP-адрес клиента.
-            port (int): Порт клиента.
-            channel_name (str): Новое имя канала клиента.
+    def switches(self) -> List[str]:
         """
-        with self._lock:
-            self._clients[(ip, port)] = channel_name
-            logging.info(f'Update {self._clients[(ip, port)]}')
+        IP коммутаторов, за которыми есть подключённые экраны.
+        """
+        return list(self._state.by_switch)
+
+    def outside_switches(self, switch_ips) -> List[ClientEntry]:
+        """
+        Клиенты, не подключённые ни к одному из перечисленных коммутаторов
+        (проход по всем клиентам — только для диагностики).
+        """
+        state = self._state
+        attached = set()
+        for switch_ip in switch_ips:
+            attached |= state.by_switch.get(switch_ip, _EMPTY)
+        if not attached:
+            return list(state.clients.values())
+        return [entry for key, entry in state.clients.items() if key not in attached]
+
+    def __len__(self):
+        return len(self._state.clients)
+
+    def stats(self) -> Dict[str, Any]:
+        state = self._state
+        return {
+            'clients': len(state.clients),
+            'ips': len(state.by_ip),
+            'wagons': len(state.by_wagon),
+            'switches': len(state.by_switch),
+        }
+
+
+# Единый реестр процесса: экраны Moscow и БНТ
+registry = ClientRegistry()
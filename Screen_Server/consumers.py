@@ -2,65 +2,98 @@ import asyncio
 import json
 
 from asgiref.sync import sync_to_async
-from torch.distributed.autograd import context
 
-from .views import get_BNT_data, CLIENTS_IP
+from .bootstrap import admission, bootstrap_cache
+from .client_registry import registry
+from .groups import BNT_GROUP, ScreenAddress
+from .heartbeat import HeartbeatMixin
+from .metro import Client
+from .outbound import BufferedSendMixin
+from .views import get_BNT_data
 
 from channels.generic.websocket import AsyncWebsocketConsumer
 
 
-class BNTConsumer(AsyncWebsocketConsumer):
+def connection_data(ip_address):
+    return {
+        'type': 'connection_data',
+        'data': get_BNT_data(ip_address)
+    }
+
+
+class BNTConsumer(HeartbeatMixin, BufferedSendMixin, AsyncWebsocketConsumer):
     """
     WebSocket consumer, обрабатывающий подключение клиентских экранов БНТ.
     После подключения отправляет начальные данные и подписывается на обновления маршрута.
+    Молчащие соединения снимаются по тайм-ауту ping/pong (см. heartbeat.py).
+    Ответы pong подтверждают доставку кадров исходящей очереди (см. outbound.py).
     """
+    heartbeat_module = 'bnt'
+    delivery_acks = True
+
     async def connect(self):
         """
         Обрабатывает подключение клиента:
-        - Сохраняет IP в глобальном списке CLIENTS_IP (если ещё не сохранён),
+        - Ждёт очереди на подключение (bootstrap.admission),
+        - Регистрирует клиента в реестре (client_registry.registry) с вагоном и стороной,
         - Подключает клиента к группе 'route_updates',
-        - Отправляет клиенту контекст маршрута (информация о линии, станциях и вагонах).
+        - Отправляет клиенту контекст маршрута (информация о линии, станциях и вагонах);
+          клиенту подпротокола 'msgpack' — двоичным кадром с изображениями в байтах.
+          Контекст зависит только от стороны и вагона, поэтому собирается и кодируется
+          один раз на пару (сторона, вагон) до смены маршрута (см. bootstrap.py).
         """
-        ip_address = self.scope['client'][0]
-        if ip_address not in CLIENTS_IP:
-            CLIENTS_IP.append(ip_address)
+        await admission.acquire()
+        ip_address, port = self.scope['client'][0], self.scope['client'][1]
+        client = Client(ip_address)
 
-        await self.accept()
+        await self.accept(subprotocol=self.negotiate_subprotocol())
+        self.start_outbound()
 
-        await self.channel_layer.group_add(
-            'route_updates',
-            self.channel_name
-        )
+        self.address = ScreenAddress.from_client(BNT_GROUP, client)
+        await self.channel_layer.group_add(BNT_GROUP, self.channel_name)
+        registry.register(ip_address, port, self.channel_name, self.address)
+        self.start_heartbeat()
 
-        context = await sync_to_async(get_BNT_data)(ip_address)
-        await self.send(text_data=json.dumps({
-            'type': 'connection_data',
-            'data': context
-        }))
+        prepared = await bootstrap_cache.get(
+            ('bnt', client.side, client.wagon_number),
+            lambda: sync_to_async(connection_data)(ip_address),
+        )
+        await self.enqueue_frame(*prepared.encoded(self.binary))
 
     async def disconnect(self, code):
         """
-        Обрабатывает отключение клиента:
-        - Удаляет IP клиента из CLIENTS_IP,
-        - Удаляет клиента из группы 'route_updates'.
+        Обрабатывает отключение клиента.
 
         Аргументы:
             code (int): Код закрытия соединения.
         """
-        ip_address = self.scope['client'][0]
-        if ip_address in CLIENTS_IP:
-            CLIENTS_IP.remove(ip_address)
-        await self.channel_layer.group_discard(
-            'route_updates',
-            self.channel_name
-        )
+        await self.release_connection()
+
+    async def release_connection(self):
+        """
+        Освобождает ресурсы соединения (повторный вызов ничего не делает):
+        - Останавливает ping и исходящую очередь,
+        - Удаляет клиента из реестра,
+        - Удаляет клиента из группы 'route_updates'.
+        """
+        if getattr(self, '_released', False) or not hasattr(self, 'address'):
+            return
+        self._released = True
+        await self.stop_heartbeat()
+        await self.stop_outbound()
+        registry.unregister(self.scope['client'][0], self.scope['client'][1])
+        await self.channel_layer.group_discard(BNT_GROUP, self.channel_name)
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """
         Обработчик входящих сообщений от клиента.
-        Пока не реализован (pass).
+        Любое сообщение подтверждает живость соединения; других команд экран БНТ не шлёт.
         """
-        pass
+        try:
+            message = json.loads(text_data) if text_data else None
+        except json.JSONDecodeError:
+            message = None
+        self.heartbeat_received(message)
 
     async def update_station(self, event):
         """
@@ -68,11 +101,6 @@ class BNTConsumer(AsyncWebsocketConsumer):
         Пересылает клиенту обновлённые данные о текущей и следующей станции.
 
         Аргументы:
-            event (dict): Должен содержать ключ 'message' с актуальной информацией о станции.
+            event (dict): Готовый кадр в ключе 'text' или ключ 'message' с актуальной информацией о станции.
         """
-        station_data = event['message']
-
-        await self.send(text_data=json.dumps({
-            'type': 'update_station',
-            'message': station_data
-        }))
+        await self.send_frame(event, 'update_station')
@@ -1,16 +1,48 @@
-import asyncio
 import json
 import logging
 
+from urllib.parse import parse_qs
+
 from channels.generic.websocket import AsyncWebsocketConsumer
-from django.core.cache import cache
-from asgiref.sync import sync_to_async, async_to_sync
-from .client_registry import ClientRegistry
+from asgiref.sync import async_to_sync
+from .client_registry import registry
+from .bootstrap import admission, bootstrap_cache, bootstrap_ttl
+from .broadcast import event_delta
+from .delta import load_keyframes
+from .groups import MOSCOW_GROUP, SWITCH_SIDES_KEY, ScreenAddress
+from .heartbeat import HeartbeatMixin
+from .outbound import BufferedSendMixin
+from .state import read_state, state_store
+from .rpc import RPC_TIMEOUT, RpcServerMixin, discover_devices
+
+
+def load_switch_sides():
+    return state_store.read(SWITCH_SIDES_KEY)
+
 
+KEYFRAME_SOURCES = ("cached_STOPS", "cached_CURRENT_NEXT_INDEX")  # Ключи состояния начального кадра
 
-registry = ClientRegistry()
 
-class MoscowConsumer(AsyncWebsocketConsumer):
+def collect_keyframe(delta_mode: bool):
+    """
+    Начальный кадр экрана Moscow: остановки и индексы станций из состояния
+    процесса (state.py; если его ведёт другой процесс — одним запросом к кэшу),
+    в дельта-режиме — с состоянием потоков телеметрии.
+    """
+    values = state_store.read_many(KEYFRAME_SOURCES)
+    indices = values.get("cached_CURRENT_NEXT_INDEX") or {'current': 0, 'next': 1}
+    frame = {
+        'start_stops': values.get("cached_STOPS"),
+        'currentStationIndex': indices['current'],
+        'nextStationIndex': indices['next'],
+    }
+    if delta_mode:
+        frame['type'] = 'keyframe'
+        frame['streams'] = load_keyframes()
+    return frame
+
+
+class MoscowConsumer(HeartbeatMixin, RpcServerMixin, BufferedSendMixin, AsyncWebsocketConsumer):
     """
     WebSocket-консьюмер для модуля Moscow.
 
@@ -18,112 +50,159 @@ class MoscowConsumer(AsyncWebsocketConsumer):
     - регистрацию клиентов при подключении;
     - рассылку данных маршрута и состояния станций;
     - обработку обновлений через группу 'moscow_module_updates';
-    - возможность опрашивать подключённые коммутаторы.
+    - положение экрана в поезде для реестра (см. groups.py);
+    - запросы к экрану с ответом (rpc.py): одновременный опрос экранов коммутаторов;
+    - по запросу (ws/moscow_module/?delta=1) — дельта-протокол: опорный кадр
+      при подключении и по {"action": "resync"}, далее только изменения (см. delta.py);
+    - двоичные кадры msgpack для клиентов подпротокола 'msgpack' (см. broadcast.py);
+    - отправку через ограниченную очередь соединения с подтверждением доставки
+      ответами pong (см. outbound.py);
+    - готовый начальный кадр и ограничение скорости подключений (см. bootstrap.py);
+    - ping/pong и снятие молчащих соединений (см. heartbeat.py).
 
     Атрибуты:
         client_ip (str): IP клиента WebSocket-соединения.
         client_port (int): Порт клиента WebSocket-соединения.
         room_group_name (str): Название группы для рассылки обновлений.
+        address (ScreenAddress): Положение экрана (поезд, вагон, сторона, устройство).
+        delta_mode (bool): Клиент принимает дельта-кадры.
     """
+    heartbeat_module = 'moscow'
+    delivery_acks = True
+
     async def connect(self):
         """
         Вызывается при установке WebSocket-соединения.
 
-        - Регистрирует клиента в `ClientRegistry`.
-        - Подключает к группе `moscow_module_updates`.
-        - Отправляет клиенту текущее состояние маршрута (станции + индексы).
+        - Ждёт очереди на подключение (bootstrap.admission).
+        - Регистрирует клиента в реестре (client_registry.registry) с положением экрана.
+        - Определяет положение экрана (поезд, вагон, сторона, тип устройства по IP
+          и порту коммутатора) и подключает к группе `moscow_module_updates`.
+        - Отправляет клиенту текущее состояние маршрута (станции + индексы),
+          в дельта-режиме — опорный кадр с состоянием потоков телеметрии.
         """
+        await admission.acquire()
         self.client_ip = self.scope['client'][0]
         self.client_port = self.scope['client'][1]
-        self.room_group_name = 'moscow_module_updates'
-
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
+        self.room_group_name = MOSCOW_GROUP
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        self.delta_mode = query.get('delta', ['0'])[0] == '1'
+
+        switch_sides = await bootstrap_cache.get(
+            SWITCH_SIDES_KEY, lambda: read_state(load_switch_sides), bootstrap_ttl(), sources=[SWITCH_SIDES_KEY])
+        self.address = ScreenAddress.from_switch(MOSCOW_GROUP, self.client_ip, self.client_port, switch_sides.frame)
+        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+
+        await self.accept(subprotocol=self.negotiate_subprotocol())
+        self.start_outbound()
+        self.start_heartbeat()
+        registry.register(
+            self.client_ip, self.client_port, self.channel_name, self.address,
+            switch=self.client_ip if self.address.train is not None else None,
         )
+        await self.send_keyframe()
 
-        await self.accept()
-        await sync_to_async(registry.register)(self.client_ip, self.client_port, self.channel_name)
-        stops = await sync_to_async(cache.get)("cached_STOPS")
-        indices = await sync_to_async(cache.get)("cached_CURRENT_NEXT_INDEX") or {'current': 0, 'next': 1}
-        await self.send(text_data=json.dumps({
-            'start_stops': stops,
-            'currentStationIndex': indices['current'],
-            'nextStationIndex': indices['next'],
-        }))
+    async def send_keyframe(self, fresh: bool = False):
+        """
+        Отправляет текущее состояние маршрута; в дельта-режиме добавляет
+        состояние потоков телеметрии (epoch, seq и последние пакеты).
+
+        Кадр собирается один раз для всех подключающихся экранов (bootstrap.py):
+        состояние маршрута переиспользуется TTL секунд или до смены маршрута,
+        опорный кадр дельт — только одновременными подключениями, чтобы номера
+        потоков не отставали. fresh=True (запрос resync) собирает кадр заново.
+
+        Аргументы:
+            fresh (bool): Не использовать готовый кадр.
+        """
+        if fresh:
+            frame = await read_state(collect_keyframe, self.delta_mode)
+            await self.enqueue_frame(*self.client_frame(frame))
+            return
+        prepared = await bootstrap_cache.get(
+            ('moscow', self.delta_mode),
+            lambda: read_state(collect_keyframe, self.delta_mode),
+            0.0 if self.delta_mode else bootstrap_ttl(),
+            sources=KEYFRAME_SOURCES,
+        )
+        await self.enqueue_frame(*prepared.encoded(self.binary))
 
     async def disconnect(self, code):
         """
         Вызывается при отключении WebSocket-клиента.
+        """
+        await self.release_connection()
 
-        - Удаляет клиента из `ClientRegistry`.
-        - Удаляет канал из группы рассылки.
+    async def release_connection(self):
         """
-        await sync_to_async(registry.unregister)(self.client_ip, self.client_port)
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
-        )
+        Освобождает ресурсы соединения; повторный вызов ничего не делает
+        (соединение, снятое по тайм-ауту heartbeat, затем получает disconnect).
 
-    async def receive(self, text_data):
+        - Останавливает ping и исходящую очередь.
+        - Отвечает ошибкой на неотвеченные запросы к экрану (rpc.py).
+        - Удаляет клиента из реестра.
+        - Удаляет канал из группы рассылки.
+        """
+        if getattr(self, '_released', False) or not hasattr(self, 'address'):
+            return
+        self._released = True
+        await self.stop_heartbeat()
+        await self.stop_outbound()
+        await self.fail_rpc()
+        registry.unregister(self.client_ip, self.client_port)
+        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None):
         """
         Метод вызывается при получении сообщений от клиента.
 
-        В текущей реализации — не обрабатывает входящие данные от клиента.
+        Любое сообщение подтверждает живость соединения; обрабатываются ответ
+        {"type": "pong", ...} на ping (heartbeat.py), запрос {"action": "resync"} —
+        повторная отправка опорного кадра после пропуска номера в потоке дельт —
+        и ответы экрана на запросы {"type": "rpc_result", ...} (см. rpc.py).
+        Остальные сообщения игнорируются.
         """
-        # Если клиент что-то отправляет, но пока мы не обрабатываем это
-        pass
+        try:
+            message = json.loads(text_data) if text_data else None
+        except json.JSONDecodeError:
+            message = None
+        if self.heartbeat_received(message) or message is None:
+            return
+        if await self.handle_rpc_result(message):
+            return
+        if isinstance(message, dict) and message.get('action') == 'resync':
+            await self.send_keyframe(fresh=True)
 
     async def moscow_module_update(self, event):
         """
         Отправляет обновление клиенту, вызванное событием `moscow_module_update`.
 
         Аргументы:
-            event (dict): Словарь с ключом 'message', содержащим полезную нагрузку.
+            event (dict): Готовый кадр в ключе 'text' (см. broadcast.frame_event)
+                или полезная нагрузка в ключе 'message'; дельта-кадр — в ключе 'delta'.
         """
-        logging.info(f"Данные на сокете: {event}")
-        await self.send(text_data=json.dumps({
-            'type': 'update',
-            'message': event['message']
-        }))
-
-    async def query_switch(self, switch_ip):
+        if self.delta_mode and 'delta' in event:
+            key = (event.get('stream'), event.get('dataType'))
+            # Если в очереди ждёт кадр этого типа, он будет заменён: опора для
+            # дельты теряется, поэтому вместо дельты ставится полный кадр
+            if not self.outbound.pending(key):
+                text, data = event_delta(event, self.binary)
+                await self.enqueue_frame(text, data, key[1], key)
+                return
+        await self.send_frame(event, 'update')
+
+    async def query_switch(self, switch_ip, timeout: float = RPC_TIMEOUT):
         """
-        Выполняет запрос к клиенту-коммутатору по IP.
+        Запрашивает get_connected_devices у всех экранов коммутатора одновременно.
 
         Аргументы:
             switch_ip (str): IP-адрес коммутатора.
+            timeout (float): Общий срок ответа (сек).
 
         Возвращает:
-            dict: Ответ от клиента. Если ошибка — пустой словарь.
+            dict: Ответы экранов по портам. Не ответившие экраны не включаются.
         """
-        logging.info('Зашли в метод query_switch')
-        try:
-            await self.send(text_data=json.dumps({
-                'action': 'get_connected_devices',
-                'switchIp': switch_ip,
-            }))
-
-            response = await self.receive_response()
-            return json.loads(response)
-        except Exception as e:
-            logging.error(f"Ошибка при запросе к коммутатору {switch_ip}: {e}")
-            return {}
-
-    async def receive_response(self):
-        """
-        Асинхронно ожидает ответа от клиента в течение 5 секунд.
-
-        Возвращает:
-            str: JSON-строка, содержащая поле `text`. Пустая строка при ошибке или тайм-ауте.
-        """
-        try:
-            response = await asyncio.wait_for(self.receive(), timeout=5)
-            response_data = json.loads(response)
-            return response_data.get('text', '{}')
-        except asyncio.TimeoutError:
-            logging.warning("Тайм-аут при получении ответа от коммутатора")
-            return '{}'
-        except json.JSONDecodeError:
-            logging.error("Ошибка при разборе JSON-ответа")
-            return '{}'
\ No newline at end of file
+        result = await discover_devices([switch_ip], params={'switchIp': switch_ip}, deadline=timeout)
+        if result['errors']:
+            logging.warning(f"Не ответили экраны коммутатора {switch_ip}: {result['errors']}")
+        return result['devices'].get(switch_ip, {})
@@ -1,7 +1,9 @@
-import json
 from channels.generic.websocket import AsyncWebsocketConsumer
 
-class RedirectConsumer(AsyncWebsocketConsumer):
+from .outbound import BufferedSendMixin
+
+
+class RedirectConsumer(BufferedSendMixin, AsyncWebsocketConsumer):
     """
     WebSocket consumer, который отвечает за пересылку сообщений редиректа всем подключённым клиентам.
     Используется для принудительной смены страницы на клиенте через WebSocket.
@@ -16,7 +18,8 @@ class RedirectConsumer(AsyncWebsocketConsumer):
             self.room_group_name,
             self.channel_name
         )
-        await self.accept()
+        await self.accept(subprotocol=self.negotiate_subprotocol())
+        self.start_outbound()
 
     async def disconnect(self, close_code):
         """
@@ -26,6 +29,7 @@ class RedirectConsumer(AsyncWebsocketConsumer):
         Аргументы:
             close_code (int): Код закрытия соединения.
         """
+        await self.stop_outbound()
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
@@ -37,9 +41,6 @@ class RedirectConsumer(AsyncWebsocketConsumer):
         для выполнения перенаправления.
 
         Аргументы:
-            event (dict): Словарь с ключом "url" — адрес для редиректа.
+            event (dict): Готовый кадр в ключе "text" или ключ "url" — адрес для редиректа.
         """
-        await self.send(text_data=json.dumps({
-            "type": "redirect",
-            "url": event["url"]
-        }))
+        await self.send_frame(event, "redirect", key="url")
@@ -0,0 +1,79 @@
+"""
+Табличный расчёт CRC-16/CCITT для пакетов сеансового протокола.
+
+Контрольная сумма считается с начальным значением 0xFFFF и полиномом 0x1021
+(без отражения битов). Табличный расчёт выполняет `binascii.crc_hqx` из
+стандартной библиотеки, поэтому пакет обрабатывается частями, без побитового
+цикла на Python и без копирования буфера.
+"""
+
+
+import binascii
+
+from typing import Iterable, List
+
+
+CRC_INIT = 0xFFFF          # Начальное значение CRC
+CS_FIELD_SIZE = 2          # Размер поля контрольной суммы в заголовке (байт)
+ZERO_WORD = b"\x00\x00"    # Значение поля контрольной суммы при расчёте
+
+
+def crc16_ccitt(data, crc: int = CRC_INIT) -> int:
+    """
+    Считает CRC-16/CCITT для буфера, продолжая с переданного значения `crc`.
+
+    Аргументы:
+        data (bytes | memoryview): Данные для расчёта.
+        crc (int): Промежуточное значение CRC (для расчёта по частям).
+
+    Возвращает:
+        int: Новое значение CRC.
+    """
+    return binascii.crc_hqx(data, crc)
+
+
+def packet_crc(packet, cs_offset: int) -> int:
+    """
+    Считает CRC пакета так, будто поле контрольной суммы заполнено нулями.
+
+    Пакет обрабатывается тремя частями: заголовок до поля CRC, нулевое слово
+    и оставшаяся часть пакета. Копия пакета не создаётся.
+
+    Аргументы:
+        packet (bytes | memoryview): Пакет целиком.
+        cs_offset (int): Смещение поля контрольной суммы (в байтах).
+
+    Возвращает:
+        int: Рассчитанная контрольная сумма.
+    """
+    view = packet if isinstance(packet, memoryview) else memoryview(packet)
+    crc = binascii.crc_hqx(view[:cs_offset], CRC_INIT)
+    crc = binascii.crc_hqx(ZERO_WORD, crc)
+    return binascii.crc_hqx(view[cs_offset + CS_FIELD_SIZE:], crc)
+
+
+def verify_packet(packet, cs_offset: int) -> bool:
+    """
+    Сравнивает рассчитанную CRC с контрольной суммой из заголовка пакета.
+
+    Возвращает:
+        bool: True, если контрольная сумма совпадает.
+    """
+    if len(packet) < cs_offset + CS_FIELD_SIZE:
+        return False
+    stored = int.from_bytes(packet[cs_offset:cs_offset + CS_FIELD_SIZE], "big")
+    return packet_crc(packet, cs_offset) == stored
+
+
+def verify_packets(packets: Iterable, cs_offset: int) -> List[bool]:
+    """
+    Пакетная проверка CRC (например, при воспроизведении записанного трафика).
+
+    Аргументы:
+        packets (Iterable[bytes | memoryview]): Пакеты для проверки.
+        cs_offset (int): Смещение поля контрольной суммы (в байтах).
+
+    Возвращает:
+        List[bool]: Результат проверки для каждого пакета в исходном порядке.
+    """
+    return [verify_packet(packet, cs_offset) for packet in packets]
@@ -0,0 +1,113 @@
+"""
+Отсев повторно присланных пакетов до их разбора.
+
+Бортовая система многократно повторяет одни и те же RouteData и телеметрию.
+Повтор распознаётся по сырым байтам датаграммы, без декодирования:
+
+- дубликат: полезная нагрузка побайтно совпадает с последней принятой от того
+  же отправителя для того же типа пакета;
+- повторная передача: пара (ID пакета, контрольная сумма заголовка) уже
+  встречалась среди последних `window` пакетов этого отправителя.
+
+Совпавшая датаграмма считается повтором, только если её CRC верна: иначе
+искажённый пакет (например, RouteData с испорченным заголовком) был бы
+подтверждён без проверки. CRC считается лишь для совпавших датаграмм —
+новые пакеты проверяются при разборе.
+"""
+
+
+from collections import Counter, deque
+from typing import Dict, Optional, Set, Tuple
+
+from .crc import verify_packet
+from .moscow import SessionProtocolParser
+
+
+DUPLICATE = 'duplicate'
+RETRANSMISSION = 'retransmission'
+
+HEADER_SIZE = SessionProtocolParser.HEADER_SIZE
+SENDER_IP = slice(8, 12)     # IP отправителя в заголовке
+PACKET_ID = slice(12, 14)    # ID пакета в заголовке
+CHECKSUM = slice(18, 20)     # Контрольная сумма в заголовке
+CS_OFFSET = SessionProtocolParser.CS_OFFSET
+
+
+class RetransmitWindow:
+    """
+    Последние `size` пар (ID пакета, CRC) одного отправителя.
+    """
+    def __init__(self, size: int):
+        self._order = deque()
+        self._seen: Set[Tuple[bytes, bytes]] = set()
+        self.size = size
+
+    def __contains__(self, key: Tuple[bytes, bytes]) -> bool:
+        return key in self._seen
+
+    def add(self, key: Tuple[bytes, bytes]):
+        if key in self._seen:
+            return
+        if len(self._order) >= self.size:
+            self._seen.discard(self._order.popleft())
+        self._order.append(key)
+        self._seen.add(key)
+
+
+class DuplicateFilter:
+    """
+    Фильтр повторов для стадии разбора.
+
+    check() вызывается до разбора, remember() — после успешного разбора, чтобы
+    повтором считалась только копия уже принятого (с верной CRC) пакета.
+
+    Атрибуты:
+        window (int): Размер окна повторной передачи на отправителя.
+        skipped (Dict[str, Counter]): Число отброшенных пакетов по причине и типу пакета.
+    """
+    def __init__(self, window: int = 64):
+        self.window = window
+        self._payloads: Dict[Tuple[bytes, int], bytes] = {}
+        self._windows: Dict[bytes, RetransmitWindow] = {}
+        self.skipped: Dict[str, Counter] = {DUPLICATE: Counter(), RETRANSMISSION: Counter()}
+
+    def check(self, data: bytes, kind: str = None) -> Optional[str]:
+        """
+        Проверяет датаграмму на повтор.
+
+        Возвращает:
+            str | None: DUPLICATE, RETRANSMISSION или None, если пакет новый
+                или его CRC не сходится (такой пакет отбрасывается при разборе).
+        """
+        if len(data) <= HEADER_SIZE:
+            return None
+        sender = data[SENDER_IP]
+
+        reason = None
+        if data[PACKET_ID] != b"\x00\x00":
+            window = self._windows.get(sender)
+            if window is not None and (data[PACKET_ID], data[CHECKSUM]) in window:
+                reason = RETRANSMISSION
+        if reason is None and self._payloads.get((sender, data[HEADER_SIZE])) == data[HEADER_SIZE:]:
+            reason = DUPLICATE
+        if reason is None or not verify_packet(data, CS_OFFSET):
+            return None
+        self.skipped[reason][kind] += 1
+        return reason
+
+    def remember(self, data: bytes):
+        """
+        Запоминает успешно разобранную датаграмму как эталон для поиска повторов.
+        """
+        if len(data) <= HEADER_SIZE:
+            return
+        sender = data[SENDER_IP]
+        self._payloads[(sender, data[HEADER_SIZE])] = data[HEADER_SIZE:]
+        if data[PACKET_ID] != b"\x00\x00":
+            window = self._windows.get(sender)
+            if window is None:
+                window = self._windows[sender] = RetransmitWindow(self.window)
+            window.add((data[PACKET_ID], data[CHECKSUM]))
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {reason: dict(counter) for reason, counter in self.skipped.items()}
@@ -0,0 +1,129 @@
+"""
+Дельта-кодирование телеметрии для экранов, подключённых к ws/moscow_module/?delta=1.
+
+Каждый отправитель (поезд) образует поток, в котором у каждого типа пакета свой
+порядковый номер seq, увеличивающийся на каждый разосланный пакет этого типа.
+Отдельная нумерация по типам позволяет очереди соединения заменять ожидающий
+кадр телеметрии более новым полным кадром, не нарушая цепочку других типов.
+Для типов из DELTA_TYPES, помимо полного кадра, формируется дельта-кадр —
+только поля, изменившиеся относительно предыдущего пакета того же типа:
+
+    {"type": "delta", "stream": "10.0.1.1", "seq": 42, "dataType": "OperationalData",
+     "changed": {"time": "...", "speed": 61}, "removed": [...]}
+
+Полные кадры ("type": "update") тоже несут stream, epoch и seq, поэтому старые
+клиенты их понимают без изменений, а новые проверяют непрерывность номеров.
+Полный кадр всегда служит новой опорой для своего типа.
+epoch меняется при перезапуске сервиса приёма (нумерация начинается заново).
+
+Состояние потоков (seq и последний пакет каждого дельта-типа) сохраняется в
+состоянии процесса (state.state_store, с отложенной записью в кэш): из него
+консьюмер собирает опорный кадр (keyframe) при подключении и по запросу
+{"action": "resync"}, который клиент отправляет при пропуске номера.
+"""
+
+
+import time
+
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .state import state_store
+
+
+KEYFRAME_PREFIX = 'cached_DELTA_'          # Ключ кэша состояния потока: префикс + stream
+STREAMS_KEY = 'cached_DELTA_STREAMS'       # Ключ кэша со списком известных потоков
+KEYFRAME_TIMEOUT = 86400
+
+_MISSING = object()
+
+
+class DeltaStream:
+    """
+    Состояние одного потока: номера последних кадров и последние пакеты дельта-типов по типам.
+    """
+    __slots__ = ('epoch', 'seq', 'state')
+
+    def __init__(self, epoch: int):
+        self.epoch = epoch
+        self.seq: Dict[str, int] = {}
+        self.state: Dict[str, Dict[str, Any]] = {}
+
+    def keyframe(self) -> Dict[str, Any]:
+        # Копии: словари потока продолжают меняться после сохранения опорного кадра
+        return {'epoch': self.epoch, 'seq': dict(self.seq), 'state': dict(self.state)}
+
+
+class DeltaEncoder:
+    """
+    Нумерует кадры потоков и вычисляет изменения для дельта-типов.
+
+    Атрибуты:
+        types (set): Типы пакетов, для которых формируются дельта-кадры.
+        streams (Dict[str, DeltaStream]): Потоки по IP отправителя.
+        epoch (int): Метка запуска кодировщика (мс), общая для его потоков.
+    """
+    def __init__(self, types: Iterable[str]):
+        self.types = set(types)
+        self.streams: Dict[str, DeltaStream] = {}
+        self.epoch = int(time.time() * 1000)
+
+    def encode(self, stream_id: str, data_type: str,
+               payload: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[Dict[str, Any]], DeltaStream]:
+        """
+        Возвращает полный кадр, дельта-кадр (или None, если опоры ещё нет) и состояние потока.
+        """
+        stream = self.streams.get(stream_id)
+        if stream is None:
+            stream = self.streams[stream_id] = DeltaStream(self.epoch)
+            register_stream(stream_id)
+        seq = stream.seq[data_type] = stream.seq.get(data_type, 0) + 1
+
+        full = {'type': 'update', 'message': payload, 'stream': stream_id, 'epoch': self.epoch, 'seq': seq}
+        if data_type not in self.types:
+            return full, None, stream
+
+        delta = None
+        previous = stream.state.get(data_type)
+        if previous is not None:
+            delta = {
+                'type': 'delta',
+                'stream': stream_id,
+                'epoch': self.epoch,
+                'seq': seq,
+                'dataType': data_type,
+                'changed': {key: value for key, value in payload.items() if previous.get(key, _MISSING) != value},
+            }
+            removed = [key for key in previous if key not in payload]
+            if removed:
+                delta['removed'] = removed
+        stream.state[data_type] = payload
+        return full, delta, stream
+
+
+def register_stream(stream_id: str):
+    """
+    Добавляет поток в список известных (читается консьюмерами для опорного кадра).
+    """
+    streams = state_store.read(STREAMS_KEY) or []
+    if stream_id not in streams:
+        state_store.set(STREAMS_KEY, streams + [stream_id], KEYFRAME_TIMEOUT)
+
+
+def store_keyframe(stream_id: str, stream: DeltaStream):
+    state_store.set(KEYFRAME_PREFIX + stream_id, stream.keyframe(), KEYFRAME_TIMEOUT)
+
+
+def load_keyframes() -> Dict[str, Dict[str, Any]]:
+    """
+    Состояние всех потоков для опорного кадра: stream → {'epoch', 'seq', 'state'}.
+
+    Если состояние ведёт другой процесс, читается из кэша (вызывать через sync_to_async).
+    """
+    streams: List[str] = state_store.read(STREAMS_KEY) or []
+    if not streams:
+        return {}
+    stored = state_store.read_many([KEYFRAME_PREFIX + stream_id for stream_id in streams])
+    return {
+        stream_id: stored[KEYFRAME_PREFIX + stream_id]
+        for stream_id in streams if KEYFRAME_PREFIX + stream_id in stored
+    }
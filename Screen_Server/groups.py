@@ -0,0 +1,89 @@
+"""
+Группы рассылки экранов и положение экрана в поезде.
+
+Все экраны модуля состоят в одной группе ('moscow_module_updates',
+'route_updates'): сервер обслуживает один поезд (см. moscow.cache_set), и
+содержимое рассылок — телеметрия, маршрут, станция БНТ — одинаково для всех
+экранов модуля. Кадр кодируется один раз на группу (см. broadcast.frame_event).
+
+Положение экрана (поезд, вагон, сторона, тип устройства) определяется при
+подключении и хранится в реестре клиентов (client_registry.py): по нему
+ConfigureData сопоставляет экраны коммутаторам, а запросы к экранам
+(rpc.py) выбирают адресатов.
+"""
+
+
+import re
+
+from typing import Any, Dict
+
+
+MOSCOW_GROUP = 'moscow_module_updates'  # Группа экранов модуля Moscow (ingest.BROADCAST_GROUP)
+BNT_GROUP = 'route_updates'             # Группа экранов БНТ
+
+SIDES = ('Left', 'Right')
+
+# Порт коммутатора → тип устройства (см. moscow.ConfigureData.PORT_DEVICE_MAP)
+DEVICE_TYPES = {
+    1: 'bnt',
+    2: 'bnt',
+    3: 'bmvt',
+    4: 'bmvt',
+    5: 'bmvt',
+}
+
+SWITCH_SIDES_KEY = 'cached_SWITCH_SIDES'  # IP коммутатора → сторона по данным ConfigureData
+RIGHT_SWITCH_OFFSET = 20                   # Правый коммутатор вагона: 10.0.{поезд}.{вагон + 20}
+
+_SWITCH_IP = re.compile(r'^10\.0\.(\d+)\.(\d+)$')
+
+
+class ScreenAddress:
+    """
+    Положение экрана в поезде.
+
+    Атрибуты:
+        module (str): Группа модуля экрана (MOSCOW_GROUP, BNT_GROUP).
+        train (int | None): Номер поезда.
+        wagon (int | None): Номер вагона.
+        side (str | None): Сторона ('Left' или 'Right').
+        device (str | None): Тип устройства (DEVICE_TYPES).
+    """
+    __slots__ = ('module', 'train', 'wagon', 'side', 'device')
+
+    def __init__(self, module: str, train: int = None, wagon: int = None, side: str = None, device: str = None):
+        self.module = module
+        self.train = train
+        self.wagon = wagon
+        self.side = side
+        self.device = device
+
+    @classmethod
+    def from_switch(cls, module: str, ip: str, port: int, switch_sides: Dict[str, str] = None) -> 'ScreenAddress':
+        """
+        Адрес экрана, подключённого через коммутатор вагона (10.0.{поезд}.{вагон}).
+
+        Сторона берётся из карты коммутаторов ConfigureData (учитывает направление
+        вагона), а до её получения — по номеру коммутатора.
+        """
+        match = _SWITCH_IP.match(ip)
+        if match is None:
+            return cls(module)
+        train, number = int(match.group(1)), int(match.group(2))
+        wagon = number - RIGHT_SWITCH_OFFSET if number > RIGHT_SWITCH_OFFSET else number
+        side = (switch_sides or {}).get(ip) or ('Right' if number > RIGHT_SWITCH_OFFSET else 'Left')
+        return cls(module, train, wagon, side, DEVICE_TYPES.get(port))
+
+    @classmethod
+    def from_client(cls, module: str, client) -> 'ScreenAddress':
+        """
+        Адрес экрана по metro.Client (вагон и сторона по последнему октету IP).
+        """
+        return cls(module, wagon=client.wagon_number, side=client.side)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {'train': self.train, 'wagon': self.wagon, 'side': self.side, 'device': self.device}
+
+    def __repr__(self):
+        return f'ScreenAddress({self.module}, train={self.train}, wagon={self.wagon}, side={self.side}, device={self.device})'
+
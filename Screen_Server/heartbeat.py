@@ -0,0 +1,125 @@
+"""
+Проверка живости WebSocket-соединений экранов и учёт подключений.
+
+Клиентские скрипты переподключаются при закрытии сокета, но если экран теряет
+питание или сеть, сокет остаётся полуоткрытым: сервер не получает закрытия,
+и соединение годами остаётся в реестре и группах, а каждая рассылка
+продолжает отправлять ему кадры.
+
+HeartbeatMixin раз в INTERVAL секунд отправляет клиенту {"type": "ping", "ts": ...}.
+Клиент отвечает {"type": "pong", "ts": ...} (ts возвращается без изменений —
+по нему считается время ответа, а для консьюмеров с delivery_acks ответ
+подтверждает доставку отправленных до ping кадров, см. outbound.py). Живость подтверждает любое сообщение
+клиента; если клиент молчит дольше TIMEOUT секунд, соединение снимается:
+консьюмер освобождает его (реестр, группы, исходящая очередь) сразу, не
+дожидаясь закрытия TCP, и закрывает сокет с кодом HEARTBEAT_CLOSE_CODE.
+
+Подключения, отключения и снятые соединения считаются в churn (metrics.Metrics)
+с меткой модуля; время ответа на ping — гистограмма 'pong_rtt_us'.
+"""
+
+
+import asyncio
+import logging
+import time
+
+from typing import Any, Dict, Optional
+
+from django.conf import settings
+
+from .metrics import Metrics, render
+
+
+DEFAULT_HEARTBEAT = {
+    'INTERVAL': 15.0,  # Сек между ping
+    'TIMEOUT': 45.0,  # Сек без сообщений клиента, после которых соединение снимается
+}
+HEARTBEAT_CLOSE_CODE = 4009
+
+churn = Metrics()
+_live: Dict[str, int] = {}  # модуль → число открытых соединений
+
+
+def get_heartbeat_config() -> Dict[str, Any]:
+    config = dict(DEFAULT_HEARTBEAT)
+    config.update(getattr(settings, 'SCREEN_HEARTBEAT', {}))
+    return config
+
+
+class HeartbeatMixin:
+    """
+    Ping/pong и снятие молчащих соединений.
+
+    Консьюмер задаёт heartbeat_module (метка в метриках), вызывает start_heartbeat()
+    после accept(), heartbeat_received(message) из receive() и stop_heartbeat()
+    при освобождении соединения, а также реализует release_connection() —
+    идемпотентное освобождение ресурсов соединения.
+
+    Атрибуты:
+        last_seen (float): Время последнего сообщения клиента (time.monotonic()).
+    """
+    heartbeat_module = 'screen'
+    _heartbeat_task: Optional[asyncio.Task] = None
+
+    def start_heartbeat(self):
+        if not callable(getattr(self, 'release_connection', None)):
+            raise TypeError(f"{type(self).__name__} должен реализовать release_connection() для HeartbeatMixin")
+        self.heartbeat_config = get_heartbeat_config()
+        self.last_seen = time.monotonic()
+        self.connected_at = self.last_seen
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+        _live[self.heartbeat_module] = _live.get(self.heartbeat_module, 0) + 1
+        churn.inc('connected', self.heartbeat_module)
+
+    async def stop_heartbeat(self):
+        task, self._heartbeat_task = self._heartbeat_task, None
+        if task is None:
+            return
+        if task is not asyncio.current_task():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        _live[self.heartbeat_module] -= 1
+        churn.inc('disconnected', self.heartbeat_module)
+
+    def heartbeat_received(self, message: Any) -> bool:
+        """
+        Отмечает живость клиента; возвращает True, если сообщение — ответ pong.
+        """
+        now = time.monotonic()
+        self.last_seen = now
+        if not isinstance(message, dict) or message.get('type') != 'pong':
+            return False
+        sent_at = message.get('ts')
+        if isinstance(sent_at, (int, float)):
+            churn.observe('pong_rtt_us', self.heartbeat_module, max(0.0, time.time() - sent_at) * 1e6)
+            if getattr(self, 'delivery_acks', False):
+                self.confirm_delivery(sent_at)
+        return True
+
+    async def _heartbeat(self):
+        interval = self.heartbeat_config['INTERVAL']
+        timeout = self.heartbeat_config['TIMEOUT']
+        while True:
+            await asyncio.sleep(interval)
+            silent = time.monotonic() - self.last_seen
+            if silent > timeout:
+                await self._reap(silent)
+                return
+            await self.enqueue_frame(*self.client_frame({'type': 'ping', 'ts': time.time()}))
+
+    async def _reap(self, silent: float):
+        churn.inc('reaped', self.heartbeat_module)
+        client = self.scope.get('client')
+        logging.warning(f"Клиент {client} молчит {silent:.1f} с: соединение снято")
+        await self.release_connection()
+        try:
+            await self.close(code=HEARTBEAT_CLOSE_CODE)
+        except Exception as e:
+            logging.debug(f"Закрытие снятого соединения {client}: {e}")
+
+
+def heartbeat_stats() -> Dict[str, Any]:
+    """
+    Открытые соединения по модулям и счётчики подключений/отключений/снятий.
+    """
+    return dict(render(churn.snapshot()), live=dict(_live))
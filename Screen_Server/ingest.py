@@ -0,0 +1,472 @@
+"""
+Сервис приёма и обработки датаграмм московского протокола.
+
+Приём, разбор и рассылка выполняются отдельными стадиями, связанными
+ограниченными очередями:
+
+    сокет → receive_queue → разбор → [объединение телеметрии] → broadcast_queue → group_send
+
+Сервис работает в собственном потоке со своим циклом событий и управляется
+методами start()/stop()/restart(). Медленная рассылка через слой каналов не
+останавливает чтение сокета, а при переполнении очереди срабатывает
+настраиваемая политика: вытеснение самого старого элемента (drop_oldest) или
+замена ещё не обработанного значения того же типа от того же поезда (latest;
+новое значение встаёт в конец очереди и не обгоняет пакеты, принятые раньше него).
+
+Телеметрия (например, OperationalData) дополнительно объединяется по времени:
+для каждого поезда и типа пакета хранится только последнее значение, которое
+рассылается не чаще COALESCE_HZ раз в секунду. Пакеты, меняющие состояние
+(RouteData и др.), отправляются сразу и в исходном порядке.
+"""
+
+
+import asyncio
+import logging
+import socket
+import threading
+import time
+
+from typing import Any, Dict, Optional, Tuple
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .broadcast import binary_enabled, encode_binary, encode_frame, group_send_frame
+from .dedup import DuplicateFilter
+from .groups import MOSCOW_GROUP
+from .delta import DeltaEncoder, store_keyframe
+from .snapshot import save_snapshot
+from .state import state_store
+from .telemetry import telemetry_history
+from .metrics import Metrics
+from .queues import DROP_OLDEST, LATEST, OverflowQueue
+from .moscow import PacketFactory, SessionProtocolParser, send_route_answer
+
+
+BROADCAST_GROUP = MOSCOW_GROUP              # Группа WebSocket-рассылки (все экраны модуля)
+SILENT_TYPES = {'ConfigureData'}            # Типы пакетов, которые не рассылаются экранам
+
+DEFAULT_CONFIG = {
+    'PORT': 29789,
+    'RECEIVE_QUEUE_SIZE': 1024,
+    'BROADCAST_QUEUE_SIZE': 256,
+    'DEFAULT_OVERFLOW_POLICY': DROP_OLDEST,
+    'OVERFLOW_POLICY': {
+        'OperationalData': LATEST,
+        'AdditionalOperationalData': LATEST,
+    },
+    'RCVBUF': 4 * 1024 * 1024,  # Размер приёмного буфера сокета (байт), None — системный
+    'COALESCE_HZ': 15,  # Частота рассылки объединённой телеметрии, 0 — без объединения
+    'COALESCE_TYPES': ['OperationalData', 'AdditionalOperationalData'],
+    'DELTA_TYPES': ['OperationalData', 'AdditionalOperationalData'],  # Типы с дельта-кадрами (?delta=1)
+    'DEDUP': True,  # Отбрасывать повторы пакетов до разбора
+    'RETRANSMIT_WINDOW': 64,  # Сколько последних (ID пакета, CRC) помнить на отправителя
+    'WORKERS': 1,  # Число процессов приёма; больше 1 — см. ingest_workers.ShardedIngest
+    'SHARDING': 'reuseport',  # 'reuseport' — распределяет ядро, 'dispatch' — по IP отправителя
+    'WORKER_QUEUE_SIZE': 4096,  # Ёмкость очереди датаграмм каждого процесса
+}
+
+# Тип пакета (байт полезной нагрузки) → имя класса-парсера
+PACKET_KINDS = {packet_id: packet_class.__name__ for packet_id, packet_class in PacketFactory.PACKET_MAP.items()}
+SENDER_IP_SLICE = slice(8, 12)  # Положение IP отправителя в заголовке датаграммы
+
+
+def get_ingest_config() -> Dict[str, Any]:
+    """
+    Возвращает настройки сервиса: значения по умолчанию, дополненные settings.MOSCOW_INGEST.
+    """
+    config = dict(DEFAULT_CONFIG)
+    config.update(getattr(settings, 'MOSCOW_INGEST', {}))
+    return config
+
+
+def udp_socket_stats(port: int) -> Optional[Dict[str, int]]:
+    """
+    Читает из /proc/net/udp заполненность приёмного буфера и число потерь ядра для порта.
+
+    Возвращает:
+        dict | None: {'rx_queue_bytes', 'kernel_drops'} или None, если данные недоступны.
+    """
+    try:
+        with open('/proc/net/udp') as proc_file:
+            next(proc_file)
+            for line in proc_file:
+                fields = line.split()
+                if int(fields[1].split(':')[1], 16) == port:
+                    return {
+                        'rx_queue_bytes': int(fields[4].split(':')[1], 16),
+                        'kernel_drops': int(fields[-1]),
+                    }
+    except (OSError, ValueError, IndexError, StopIteration):
+        pass
+    return None
+
+
+class Coalescer:
+    """
+    Объединение телеметрии по принципу «побеждает последнее значение».
+
+    Для каждой пары (поезд, тип пакета) хранится только самое новое значение;
+    накопленное забирается раз в такт и уходит в рассылку одним сообщением.
+
+    Атрибуты:
+        types (set): Типы пакетов, которые объединяются.
+        coalesced (int): Сколько значений заменено более новыми до рассылки.
+    """
+    def __init__(self, types):
+        self.types = set(types)
+        self._pending: Dict[Tuple[str, str], dict] = {}
+        self.coalesced = 0
+
+    def offer(self, key: Tuple[str, str], payload: dict):
+        """
+        Запоминает значение телеметрии, заменяя ещё не отправленное.
+        """
+        if key in self._pending:
+            self.coalesced += 1
+        self._pending[key] = payload
+
+    def take(self):
+        """
+        Забирает все накопленные значения (в порядке первого появления ключа).
+        """
+        pending, self._pending = self._pending, {}
+        return pending.items()
+
+    def take_for(self, sender_ip: str):
+        """
+        Забирает накопленные значения одного поезда (перед пакетом, меняющим состояние).
+        """
+        keys = [key for key in self._pending if key[0] == sender_ip]
+        return [(key, self._pending.pop(key)) for key in keys]
+
+    def __len__(self):
+        return len(self._pending)
+
+
+class MoscowProtocol(asyncio.DatagramProtocol):
+    """
+    Стадия приёма: передаёт датаграммы в очередь сервиса без разбора.
+    Содержит методы:
+    - connection_made: обработка установления соединения
+    - datagram_received: приём данных
+    - error_received: обработка ошибок
+    - connection_lost: завершение соединения
+    """
+    def __init__(self, service: 'IngestService'):
+        self.service = service
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        logging.info("UDP-соединение установлено")
+
+    def datagram_received(self, data, addr):
+        self.service.feed(data, addr)
+
+    def send_diagnostics(self, message: bytes):
+        """
+        Отправка диагностических данных по UDP.
+
+        :param message: байтовое сообщение
+        """
+        logging.info(f"Отправлены диагностические данные: {message.hex()}")
+
+    def error_received(self, error):
+        logging.error(f"Ошибка UDP-соединения: {error}")
+
+    def connection_lost(self, exc):
+        logging.warning("UDP-соединение закрыто")
+
+
+class IngestService:
+    """
+    Управляемый сервис приёма датаграмм: приём → разбор → рассылка.
+
+    Атрибуты:
+        port (int): UDP-порт приёма.
+        config (dict): Настройки (см. DEFAULT_CONFIG и settings.MOSCOW_INGEST).
+        listen (bool): Открывать ли собственный сокет; без него датаграммы подаются через submit().
+        reuse_port (bool): Открывать сокет с SO_REUSEPORT (несколько процессов на одном порту).
+        receive_queue (OverflowQueue): Сырые датаграммы, ожидающие разбора.
+        broadcast_queue (OverflowQueue): Разобранные данные, ожидающие рассылки.
+        coalescer (Coalescer | None): Объединение телеметрии (None, если COALESCE_HZ = 0).
+        dedup (DuplicateFilter | None): Отсев повторов до разбора (None, если DEDUP выключен).
+        history (TelemetryHistory | None): История телеметрии (см. telemetry.py).
+    """
+    def __init__(self, port: int = None, sock: socket.socket = None, config: Dict[str, Any] = None,
+                 listen: bool = True, reuse_port: bool = False):
+        self.config = config or get_ingest_config()
+        self.port = port or self.config['PORT']
+        self.listen = listen
+        self.reuse_port = reuse_port
+        self._sock = sock
+        self._thread: Optional[threading.Thread] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._shutdown: Optional[asyncio.Event] = None
+        self._started = threading.Event()
+        self.receive_queue: Optional[OverflowQueue] = None
+        self.broadcast_queue: Optional[OverflowQueue] = None
+        self.coalescer = Coalescer(self.config['COALESCE_TYPES']) if self.config['COALESCE_HZ'] else None
+        self.dedup = DuplicateFilter(self.config['RETRANSMIT_WINDOW']) if self.config['DEDUP'] else None
+        self.delta = DeltaEncoder(self.config['DELTA_TYPES'])
+        self.history = telemetry_history
+        self.started_at = None
+        self.received = 0
+        self.parsed = 0
+        self.parse_errors = 0
+        self.sent = 0
+        self.send_errors = 0
+        self.metrics = Metrics()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, timeout: float = 5.0):
+        """
+        Запускает сервис в отдельном потоке и ждёт открытия сокета.
+        """
+        if self.running:
+            logging.warning("Сервис приёма уже запущен")
+            return
+        self._started.clear()
+        self._thread = threading.Thread(target=self._run, name='moscow-ingest', daemon=True)
+        self._thread.start()
+        self._started.wait(timeout)
+
+    def stop(self, timeout: float = 5.0):
+        """
+        Останавливает сервис: закрывает сокет и завершает стадии.
+        """
+        if not self.running:
+            return
+        loop, shutdown = self._loop, self._shutdown
+        if loop is not None and shutdown is not None:
+            loop.call_soon_threadsafe(shutdown.set)
+        self._thread.join(timeout)
+        # Отложенные изменения состояния записываются в Redis и в снимок до выхода
+        state_store.flush()
+        save_snapshot()
+        logging.info("Сервис приёма остановлен")
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def submit(self, data: bytes, addr: Tuple[str, int]):
+        """
+        Потокобезопасная передача датаграммы в сервис (из другого потока).
+        """
+        loop = self._loop
+        if loop is None:
+            raise RuntimeError("Сервис приёма не запущен")
+        loop.call_soon_threadsafe(self.feed, data, addr)
+
+    def feed(self, data: bytes, addr: Tuple[str, int]):
+        """
+        Стадия приёма: ставит датаграмму в очередь разбора. Вызывается в цикле сервиса.
+        """
+        self.received += 1
+        kind = PACKET_KINDS.get(data[SessionProtocolParser.HEADER_SIZE]) \
+            if len(data) > SessionProtocolParser.HEADER_SIZE else None
+        self.metrics.inc('received', kind or 'unknown')
+        key = (data[SENDER_IP_SLICE], kind)
+        self.receive_queue.put_nowait((data, addr, time.monotonic(), kind), kind=kind, key=key)
+
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self._loop = loop
+        try:
+            loop.run_until_complete(self._main())
+        except Exception as e:
+            logging.error(f"Сервис приёма завершился с ошибкой: {e}")
+        finally:
+            self._loop = None
+            self._started.set()
+            loop.close()
+
+    async def _open_endpoint(self):
+        loop = asyncio.get_running_loop()
+        if self._sock is not None:
+            endpoint = {'sock': self._sock}
+            self._sock = None  # сокет детектора используется только при первом запуске
+        else:
+            endpoint = {'local_addr': ('0.0.0.0', self.port)}
+            if self.reuse_port:
+                endpoint['reuse_port'] = True
+        transport, protocol = await loop.create_datagram_endpoint(lambda: MoscowProtocol(self), **endpoint)
+
+        if self.config.get('RCVBUF'):
+            try:
+                transport.get_extra_info('socket').setsockopt(
+                    socket.SOL_SOCKET, socket.SO_RCVBUF, self.config['RCVBUF'])
+            except OSError as e:
+                logging.warning(f"Не удалось увеличить приёмный буфер сокета: {e}")
+        return transport
+
+    async def _main(self):
+        self._shutdown = asyncio.Event()
+        policies = self.config['OVERFLOW_POLICY']
+        default_policy = self.config['DEFAULT_OVERFLOW_POLICY']
+        self.receive_queue = OverflowQueue(self.config['RECEIVE_QUEUE_SIZE'], policies, default_policy)
+        self.broadcast_queue = OverflowQueue(self.config['BROADCAST_QUEUE_SIZE'], policies, default_policy)
+
+        transport = None
+        if self.listen:
+            logging.info(f"Запуск UDP-клиента для порта {self.port}")
+            transport = await self._open_endpoint()
+        tasks = [
+            asyncio.create_task(self._parse_worker()),
+            asyncio.create_task(self._broadcast_worker()),
+        ]
+        if self.coalescer is not None:
+            tasks.append(asyncio.create_task(self._coalesce_worker()))
+        self.started_at = time.time()
+        self._started.set()
+
+        try:
+            await self._shutdown.wait()
+        finally:
+            if transport is not None:
+                transport.close()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _parse_worker(self):
+        """
+        Стадия разбора: сырые датаграммы → словари для рассылки.
+        """
+        metrics = self.metrics
+        while True:
+            data, addr, received_at, kind = await self.receive_queue.get()
+            label = kind or 'unknown'
+            metrics.observe('receive_queue_delay_us', label, (time.monotonic() - received_at) * 1e6)
+            if self.dedup is not None and self.dedup.check(data, kind) is not None:
+                if kind == 'RouteData':
+                    # Повтор уже принятого маршрута: подтверждаем без разбора
+                    send_route_answer(socket.inet_ntoa(data[SENDER_IP_SLICE]), 0x00)
+                await asyncio.sleep(0)
+                continue
+
+            started = time.perf_counter_ns()
+            try:
+                result = SessionProtocolParser(data).parse_packet()
+            except Exception as e:
+                logging.error(f"Ошибка при разборе датаграммы от {addr[0]}: {e}")
+                result = {'status': 'error'}
+            metrics.observe('parse_us', label, (time.perf_counter_ns() - started) / 1e3)
+
+            if result['status'] != 'success':
+                self.parse_errors += 1
+                if result.get('error_message') == SessionProtocolParser.CRC_ERROR:
+                    metrics.inc('crc_errors', label)
+                else:
+                    metrics.inc('parse_errors', label)
+            else:
+                self.parsed += 1
+                metrics.inc('parsed', label)
+                if self.dedup is not None:
+                    self.dedup.remember(data)
+                payload = result['payload']
+                data_type = payload.get('dataType') if isinstance(payload, dict) else None
+                if self.history is not None and data_type:
+                    self.history.record(result['header']['sender_ip'], data_type, payload)
+                if data_type and data_type not in SILENT_TYPES:
+                    self._route(result['header']['sender_ip'], data_type, payload)
+
+            # Разбор синхронный: отдаём управление приёму и рассылке между пакетами
+            await asyncio.sleep(0)
+
+    def _route(self, sender_ip: str, data_type: str, payload: dict):
+        """
+        Направляет разобранный пакет: телеметрию — в объединение, остальное — сразу в рассылку.
+        """
+        key = (sender_ip, data_type)
+        coalescer = self.coalescer
+        if coalescer is None:
+            self._enqueue_broadcast(key, payload)
+        elif data_type in coalescer.types:
+            coalescer.offer(key, payload)
+        else:
+            # Телеметрия поезда, накопленная до изменения состояния, уходит раньше него
+            for pending_key, pending in coalescer.take_for(sender_ip):
+                self._enqueue_broadcast(pending_key, pending)
+            self._enqueue_broadcast(key, payload)
+
+    def _enqueue_broadcast(self, key: Tuple[str, str], payload: dict):
+        self.broadcast_queue.put_nowait((payload, key, time.monotonic()), kind=key[1], key=key)
+
+    async def _coalesce_worker(self):
+        """
+        Такт объединения: раз в 1/COALESCE_HZ секунды отправляет последнюю телеметрию.
+        """
+        interval = 1.0 / self.config['COALESCE_HZ']
+        while True:
+            await asyncio.sleep(interval)
+            for key, payload in self.coalescer.take():
+                self._enqueue_broadcast(key, payload)
+
+    async def _broadcast_worker(self):
+        """
+        Стадия рассылки: отправка разобранных данных в WebSocket-группу.
+        """
+        channel_layer = get_channel_layer()
+        metrics = self.metrics
+        while True:
+            payload, (sender_ip, data_type), enqueued_at = await self.broadcast_queue.get()
+            metrics.observe('broadcast_queue_delay_us', data_type, (time.monotonic() - enqueued_at) * 1e6)
+            started = time.perf_counter_ns()
+            try:
+                # Кадры кодируются один раз и без изменений уходят всем экранам группы
+                full, delta, stream = self.delta.encode(sender_ip, data_type, payload)
+                # Ключ объединения в исходящих очередях соединений (см. outbound.py)
+                fields = {'stream': sender_ip, 'dataType': data_type}
+                if delta is not None:
+                    fields['delta'] = encode_frame(delta)
+                    if binary_enabled():
+                        fields['delta_msgpack'] = encode_binary(delta)
+                # Состояние потока обновляется до рассылки: опорный кадр не отстаёт от дельт
+                store_keyframe(sender_ip, stream)
+                event = await group_send_frame(channel_layer, BROADCAST_GROUP, 'moscow_module_update', full, **fields)
+                if delta is not None:
+                    metrics.inc('delta_bytes', data_type, len(event['delta']))
+                    metrics.inc('full_bytes', data_type, len(event['text']))
+                self.sent += 1
+                metrics.inc('sent', data_type)
+            except Exception as e:
+                self.send_errors += 1
+                metrics.inc('send_errors', data_type)
+                logging.error(f"Ошибка при отправке данных в WebSocket: {e}")
+            metrics.observe('group_send_us', data_type, (time.perf_counter_ns() - started) / 1e3)
+
+    def metrics_snapshot(self) -> Dict[str, Any]:
+        """
+        Снимок счётчиков и гистограмм задержек стадий (см. metrics.Metrics).
+        """
+        return self.metrics.snapshot()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Состояние сервиса: счётчики стадий, глубина очередей и потери в ядре.
+        """
+        return {
+            'running': self.running,
+            'port': self.port,
+            'started_at': self.started_at,
+            'received': self.received,
+            'parsed': self.parsed,
+            'parse_errors': self.parse_errors,
+            'sent': self.sent,
+            'send_errors': self.send_errors,
+            'receive_queue': self.receive_queue.stats() if self.receive_queue else None,
+            'broadcast_queue': self.broadcast_queue.stats() if self.broadcast_queue else None,
+            'coalescer': {
+                'pending': len(self.coalescer),
+                'coalesced': self.coalescer.coalesced,
+            } if self.coalescer is not None else None,
+            'skipped': self.dedup.stats() if self.dedup is not None else None,
+            'socket': udp_socket_stats(self.port) if self.listen else None,
+        }
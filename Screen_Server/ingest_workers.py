@@ -0,0 +1,293 @@
+"""
+Многопроцессный приём датаграмм: разбор пакетов разных отправителей на разных ядрах.
+
+Каждый рабочий процесс запускает собственный `IngestService` (разбор и
+рассылка в слой каналов), поэтому разбор пакетов разных отправителей идёт на
+разных ядрах. Датаграммы распределяются одним из способов:
+
+- 'reuseport': каждый процесс открывает порт с SO_REUSEPORT, ядро распределяет
+  датаграммы по хэшу адреса отправителя (ip, port). Пакеты одного поезда всегда
+  попадают в один процесс, пока поезд отправляет их с одного и того же порта.
+- 'dispatch': порт читает поток-диспетчер в основном процессе и передаёт
+  датаграмму процессу по IP отправителя из заголовка сеансового уровня.
+
+В обоих режимах пакеты одного поезда обрабатываются одним процессом в порядке
+получения. Рабочий процесс помечается переменной окружения INGEST_WORKER_ENV
+до django.setup(): в нём не запускается определение модуля (см.
+apps.ScreenServerConfig.ready). Снимок состояния пишет процесс, получивший
+маршрут (см. snapshot.py).
+
+Сервер ведёт один маршрут: остановки и индексы станций (cached_STOPS,
+cached_CURRENT_NEXT_INDEX) и группы экранов общие для всех отправителей.
+Маршрут другого поезда заменяет текущий, о чём пишется предупреждение
+(moscow.check_route_sender). Несколько процессов распределяют разбор
+телеметрии, но не делают сервер многопоездным.
+Процессы публикуют счётчики через разделяемую память, откуда
+`ShardedIngest.stats()` собирает производительность каждого процесса. Снимки
+метрик (гистограммы задержек) процессы передают через очередь на одно значение,
+а `ShardedIngest.metrics_snapshot()` складывает последние снимки всех процессов.
+"""
+
+
+import logging
+import multiprocessing
+import os
+import queue
+import socket
+import threading
+import time
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from .autodetect import MAX_DATAGRAM_SIZE
+from .ingest import IngestService, SENDER_IP_SLICE, get_ingest_config
+from .metrics import merge_snapshots
+from .snapshot import start_snapshot_writer
+
+
+REUSEPORT = 'reuseport'
+DISPATCH = 'dispatch'
+
+# Счётчики процесса в разделяемом массиве (по строке на процесс)
+WORKER_COUNTERS = ('pid', 'running', 'received', 'parsed', 'sent', 'packets_per_s')
+# Номер рабочего процесса приёма; в основном процессе не задана
+INGEST_WORKER_ENV = 'SCREEN_INGEST_WORKER'
+REPORT_INTERVAL = 1.0  # Период публикации счётчиков процессом (сек)
+DISPATCH_POLL_INTERVAL = 0.5  # Период проверки флага остановки диспетчером (сек)
+
+
+def ingest_worker_index() -> Optional[int]:
+    """
+    Номер рабочего процесса приёма или None в основном процессе.
+    """
+    index = os.environ.get(INGEST_WORKER_ENV)
+    return int(index) if index is not None else None
+
+
+def shard_for(data: bytes, workers: int) -> int:
+    """
+    Номер процесса для датаграммы по IP отправителя из заголовка.
+    """
+    return int.from_bytes(data[SENDER_IP_SLICE], 'big') % workers
+
+
+def _publish_latest(box, value):
+    """
+    Кладёт значение в очередь на один элемент, вытесняя непрочитанное.
+    """
+    try:
+        box.get_nowait()
+    except queue.Empty:
+        pass
+    try:
+        box.put_nowait(value)
+    except queue.Full:
+        pass
+
+
+def _report_counters(service: IngestService, counters, metrics_box, index: int):
+    """
+    Периодически записывает счётчики сервиса процесса в разделяемый массив,
+    а снимок метрик — в очередь процесса.
+    """
+    base = index * len(WORKER_COUNTERS)
+    counters[base] = os.getpid()
+    last_received, last_time = 0, time.monotonic()
+    while True:
+        counters[base + 1] = service.running
+        time.sleep(REPORT_INTERVAL)
+        now = time.monotonic()
+        received = service.received
+        counters[base + 2] = received
+        counters[base + 3] = service.parsed
+        counters[base + 4] = service.sent
+        counters[base + 5] = (received - last_received) / (now - last_time)
+        last_received, last_time = received, now
+        _publish_latest(metrics_box, service.metrics_snapshot())
+
+
+def _worker_main(index: int, settings_module: str, port: int, mode: str, inbox, counters, metrics_box):
+    """
+    Точка входа рабочего процесса.
+    """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
+    os.environ[INGEST_WORKER_ENV] = str(index)
+    import django
+    django.setup()
+
+    service = IngestService(port=port, listen=(mode == REUSEPORT), reuse_port=True)
+    service.start()
+    # Пишет снимок только процесс, в котором ведётся состояние (его поезд прислал маршрут)
+    start_snapshot_writer()
+    if not service.running:
+        logging.error(f"Процесс приёма #{index}: сервис приёма не запущен")
+    threading.Thread(target=_report_counters, args=(service, counters, metrics_box, index), daemon=True).start()
+    logging.info(f"Процесс приёма #{index} запущен (pid {os.getpid()}, режим {mode})")
+
+    while True:
+        item = inbox.get()
+        if item is None:
+            break
+        service.submit(*item)
+    service.stop()
+
+
+class ShardedIngest:
+    """
+    Приём датаграмм несколькими процессами с сохранением порядка пакетов каждого поезда.
+
+    Интерфейс совпадает с `IngestService`: start()/stop()/restart()/submit()/stats().
+
+    Атрибуты:
+        workers (int): Число рабочих процессов.
+        mode (str): Способ распределения — REUSEPORT или DISPATCH.
+        port (int): UDP-порт приёма.
+        dropped (int): Датаграммы, не поместившиеся в очередь процесса (режим DISPATCH).
+    """
+    def __init__(self, workers: int, mode: str = REUSEPORT, port: int = None,
+                 sock: socket.socket = None, config: Dict[str, Any] = None):
+        if mode not in (REUSEPORT, DISPATCH):
+            raise ValueError(f"Неизвестный режим распределения: {mode}")
+        self.config = config or get_ingest_config()
+        self.workers = workers
+        self.mode = mode
+        self.port = port or self.config['PORT']
+        self._sock = sock
+        self._context = multiprocessing.get_context('spawn')
+        self._processes: List[multiprocessing.Process] = []
+        self._inboxes: list = []
+        self._metrics_boxes: list = []
+        self._worker_metrics: Dict[int, Dict[str, Any]] = {}
+        self._counters = None
+        self._dispatcher: Optional[threading.Thread] = None
+        self._dispatch_stop = threading.Event()
+        self.dropped = 0
+        self.started_at = None
+
+    @property
+    def running(self) -> bool:
+        return any(process.is_alive() for process in self._processes)
+
+    def start(self):
+        if self.running:
+            logging.warning("Процессы приёма уже запущены")
+            return
+
+        settings_module = os.environ.get('DJANGO_SETTINGS_MODULE', 'Product_Screen_Server.settings')
+        self._counters = self._context.Array('d', self.workers * len(WORKER_COUNTERS), lock=False)
+        self._inboxes = [self._context.Queue(self.config['WORKER_QUEUE_SIZE']) for _ in range(self.workers)]
+        self._metrics_boxes = [self._context.Queue(1) for _ in range(self.workers)]
+        self._worker_metrics = {}
+        self._processes = [
+            self._context.Process(
+                target=_worker_main,
+                args=(index, settings_module, self.port, self.mode, inbox, self._counters, metrics_box),
+                name=f'moscow-ingest-{index}',
+                daemon=True,
+            )
+            for index, (inbox, metrics_box) in enumerate(zip(self._inboxes, self._metrics_boxes))
+        ]
+
+        if self.mode == REUSEPORT and self._sock is not None:
+            # Порт займут процессы с SO_REUSEPORT; сокет детектора без этого флага мешает им
+            self._sock.close()
+            self._sock = None
+
+        for process in self._processes:
+            process.start()
+
+        if self.mode == DISPATCH:
+            sock = self._sock or self._open_socket()
+            self._sock = None
+            self._dispatch_stop.clear()
+            self._dispatcher = threading.Thread(target=self._dispatch, args=(sock,), name='moscow-dispatch', daemon=True)
+            self._dispatcher.start()
+
+        self.started_at = time.time()
+        logging.info(f"Запущено процессов приёма: {self.workers} (режим {self.mode})")
+
+    def _open_socket(self) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('0.0.0.0', self.port))
+        if self.config.get('RCVBUF'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.config['RCVBUF'])
+        return sock
+
+    def _dispatch(self, sock: socket.socket):
+        """
+        Поток-диспетчер: читает порт и распределяет датаграммы по процессам.
+        """
+        sock.settimeout(DISPATCH_POLL_INTERVAL)
+        while not self._dispatch_stop.is_set():
+            try:
+                data, addr = sock.recvfrom(MAX_DATAGRAM_SIZE)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            self.submit(data, addr)
+        sock.close()
+
+    def submit(self, data: bytes, addr: Tuple[str, int]):
+        """
+        Передаёт датаграмму процессу, отвечающему за поезд-отправитель.
+        """
+        try:
+            self._inboxes[shard_for(data, self.workers)].put_nowait((data, addr))
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self, timeout: float = 5.0):
+        if self._dispatcher is not None:
+            self._dispatch_stop.set()
+            self._dispatcher.join(timeout)
+            self._dispatcher = None
+        for inbox in self._inboxes:
+            inbox.put(None)
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        logging.info("Процессы приёма остановлены")
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def metrics_snapshot(self) -> Dict[str, Any]:
+        """
+        Сумма последних снимков метрик всех процессов приёма.
+        """
+        for index, box in enumerate(self._metrics_boxes):
+            try:
+                self._worker_metrics[index] = box.get_nowait()
+            except queue.Empty:
+                pass
+        return merge_snapshots(self._worker_metrics.values())
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Счётчики и производительность каждого процесса приёма.
+        """
+        workers = []
+        if self._counters is not None:
+            width = len(WORKER_COUNTERS)
+            for index, process in enumerate(self._processes):
+                row = self._counters[index * width:(index + 1) * width]
+                worker = dict(zip(WORKER_COUNTERS, row))
+                worker['pid'] = int(worker['pid'])
+                worker['alive'] = process.is_alive()
+                # Процесс может жить с остановленным сервисом (например, порт занят)
+                worker['running'] = worker['alive'] and bool(worker['running'])
+                workers.append(worker)
+        return {
+            'running': any(worker['running'] for worker in workers),
+            'port': self.port,
+            'mode': self.mode,
+            'started_at': self.started_at,
+            'dropped': self.dropped,
+            'received': sum(worker['received'] for worker in workers),
+            'packets_per_s': sum(worker['packets_per_s'] for worker in workers),
+            'workers': workers,
+        }
@@ -0,0 +1,125 @@
+"""
+Сравнение задержки доставки group_send → receive для разных слоёв каналов.
+
+Варианты:
+- inmemory: channels.layers.InMemoryChannelLayer (отправитель в том же цикле);
+- hybrid: HybridChannelLayer без Redis, отправитель в том же цикле;
+- hybrid-thread: HybridChannelLayer, отправитель в отдельном потоке со своим
+  циклом событий — как сервис приёма (ingest.IngestService) в процессе Daphne;
+- redis: channels_redis.core.RedisChannelLayer (если пакет установлен и Redis доступен).
+
+Запуск:
+    python manage.py bench_channel_layers --messages 2000 --screens 20
+"""
+
+
+import asyncio
+import statistics
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+
+from Screen_Server.broadcast import frame_event
+from Screen_Server.channel_layer import HybridChannelLayer
+
+
+GROUP = 'bench_group'
+
+
+def percentile(samples, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def run_bench(layer, messages: int, screens: int, threaded: bool):
+    """
+    Отправляет `messages` сообщений в группу из `screens` каналов и возвращает
+    задержки доставки каждого сообщения каждому каналу (мкс).
+    """
+    channels = [await layer.new_channel() for _ in range(screens)]
+    for channel in channels:
+        await layer.group_add(GROUP, channel)
+
+    latencies = []
+    done = asyncio.Event()
+    expected = messages * screens
+
+    async def reader(channel):
+        while True:
+            message = await layer.receive(channel)
+            latencies.append((time.perf_counter_ns() - message['sent_at']) / 1e3)
+            if len(latencies) >= expected:
+                done.set()
+
+    async def produce():
+        frame = frame_event('moscow_module_update', {'type': 'update', 'message': {'dataType': 'OperationalData'}})
+        for _ in range(messages):
+            await layer.group_send(GROUP, dict(frame, sent_at=time.perf_counter_ns()))
+            # Пауза между сообщениями: измеряется задержка, а не пропускная способность
+            await asyncio.sleep(0.0005)
+
+    readers = [asyncio.create_task(reader(channel)) for channel in channels]
+    started = time.perf_counter()
+    if threaded:
+        thread = threading.Thread(target=lambda: asyncio.run(produce()))
+        thread.start()
+        await asyncio.wait_for(done.wait(), timeout=60)
+        thread.join()
+    else:
+        await produce()
+        await asyncio.wait_for(done.wait(), timeout=60)
+    elapsed = time.perf_counter() - started
+
+    for task in readers:
+        task.cancel()
+    await asyncio.gather(*readers, return_exceptions=True)
+    for channel in channels:
+        await layer.group_discard(GROUP, channel)
+    return latencies, elapsed
+
+
+class Command(BaseCommand):
+    help = "Сравнение задержки group_send для InMemory, гибридного и Redis слоёв каналов"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=2000, help="Число сообщений в группу")
+        parser.add_argument("--screens", type=int, default=20, help="Число каналов в группе")
+        parser.add_argument("--redis", default="localhost:6379", help="Адрес Redis для варианта redis")
+
+    def handle(self, *args, **options):
+        messages, screens = options["messages"], options["screens"]
+        capacity = messages + 10
+
+        variants = [
+            ('inmemory', self.inmemory_layer, False),
+            ('hybrid', lambda: HybridChannelLayer(capacity=capacity), False),
+            ('hybrid-thread', lambda: HybridChannelLayer(capacity=capacity), True),
+            ('redis', lambda: self.redis_layer(options["redis"], capacity), False),
+        ]
+
+        self.stdout.write(f"{'Слой':14s} {'p50, мкс':>9s} {'p99, мкс':>9s} {'макс, мкс':>10s} {'доставок/с':>11s}")
+        for name, factory, threaded in variants:
+            try:
+                layer = factory()
+                if name == 'inmemory':
+                    layer.capacity = capacity
+                latencies, elapsed = asyncio.run(run_bench(layer, messages, screens, threaded))
+            except Exception as e:
+                self.stdout.write(f"{name:14s} недоступен: {e}")
+                continue
+            self.stdout.write(
+                f"{name:14s} {statistics.median(latencies):9.1f} {percentile(latencies, 0.99):9.1f} "
+                f"{max(latencies):10.1f} {len(latencies) / elapsed:11.0f}"
+            )
+
+    @staticmethod
+    def inmemory_layer():
+        from channels.layers import InMemoryChannelLayer
+        return InMemoryChannelLayer()
+
+    @staticmethod
+    def redis_layer(address: str, capacity: int):
+        from channels_redis.core import RedisChannelLayer
+        host, port = address.rsplit(':', 1)
+        return RedisChannelLayer(hosts=[(host, int(port))], capacity=capacity)
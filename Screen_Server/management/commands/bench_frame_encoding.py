@@ -0,0 +1,105 @@
+"""
+Сравнение размера и времени кодирования кадров WebSocket: JSON и msgpack.
+
+Кадры собираются так же, как при рассылке:
+- update/delta: телеметрия синтетического трафика, разобранная SessionProtocolParser
+  и пронумерованная DeltaEncoder (как в ingest.IngestService);
+- connection_data: начальный контекст экрана БНТ (get_BNT_data, изображения вагонов);
+- update_station: кадр смены станции со схемой станции (PNG).
+
+Для msgpack изображения передаются байтами (broadcast.encode_binary), для JSON —
+строками base64, как раньше.
+
+Запуск:
+    python manage.py bench_frame_encoding --packets 5000 --repeat 200
+"""
+
+
+import os
+import statistics
+import time
+
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from Screen_Server.broadcast import encode_binary, encode_frame, msgpack
+from Screen_Server.delta import DeltaEncoder
+from Screen_Server.ingest import get_ingest_config
+from Screen_Server.metro import format_image, get_BNT_data
+from Screen_Server.moscow import SessionProtocolParser
+from Screen_Server.replay import synthetic_capture
+
+
+def measure(encoder, frames, repeat: int) -> float:
+    """
+    Среднее время кодирования одного кадра (мкс).
+    """
+    clock = time.perf_counter_ns
+    started = clock()
+    for _ in range(repeat):
+        for frame in frames:
+            encoder(frame)
+    return (clock() - started) / 1e3 / (repeat * len(frames))
+
+
+class Command(BaseCommand):
+    help = "Размер и время кодирования кадров WebSocket в JSON и msgpack"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--packets", type=int, default=5000, help="Число синтетических датаграмм телеметрии")
+        parser.add_argument("--repeat", type=int, default=20, help="Повторов кодирования каждого кадра")
+        parser.add_argument("--client-ip", default="192.168.1.12", help="IP экрана для connection_data")
+
+    def handle(self, *args, **options):
+        if msgpack is None:
+            raise CommandError("Пакет msgpack не установлен")
+
+        groups = self.telemetry_frames(options["packets"])
+        groups.update(self.screen_frames(options["client_ip"]))
+
+        self.stdout.write(
+            f"{'Кадр':34s} {'шт':>6s} {'JSON, Б':>9s} {'msgpack, Б':>11s} {'размер':>7s} "
+            f"{'JSON, мкс':>10s} {'msgpack, мкс':>13s}"
+        )
+        for name, frames in groups.items():
+            # Кадры с изображениями крупные: их кодирование повторяется реже
+            repeat = max(1, options["repeat"] // (10 if name in ('connection_data', 'update_station') else 1))
+            json_size = statistics.fmean(len(encode_frame(frame).encode()) for frame in frames)
+            binary_size = statistics.fmean(len(encode_binary(frame)) for frame in frames)
+            self.stdout.write(
+                f"{name:34s} {len(frames):6d} {json_size:9.0f} {binary_size:11.0f} "
+                f"{binary_size / json_size:6.0%} {measure(encode_frame, frames, repeat):10.1f} "
+                f"{measure(encode_binary, frames, repeat):13.1f}"
+            )
+
+    @staticmethod
+    def telemetry_frames(packets: int):
+        encoder = DeltaEncoder(get_ingest_config()['DELTA_TYPES'])
+        groups = defaultdict(list)
+        for _, data, _ in synthetic_capture(packets):
+            result = SessionProtocolParser(data).parse_packet()
+            if result['status'] != 'success' or not isinstance(result['payload'], dict):
+                continue
+            payload = result['payload']
+            data_type = payload.get('dataType')
+            if not data_type:
+                continue
+            full, delta, _ = encoder.encode(result['header']['sender_ip'], data_type, payload)
+            groups[f"update {data_type}"].append(full)
+            if delta is not None:
+                groups[f"delta {data_type}"].append(delta)
+        return dict(sorted(groups.items()))
+
+    @staticmethod
+    def screen_frames(client_ip: str):
+        groups = {'connection_data': [{'type': 'connection_data', 'data': get_BNT_data(client_ip)}]}
+        png_dir = os.path.join(settings.BASE_DIR, 'L1', 'R2', 'PNG')
+        images = sorted(name for name in os.listdir(png_dir) if name.endswith('.png'))[:10]
+        groups['update_station'] = [
+            {'type': 'update_station', 'message': {'current_station': name, 'next_station': None,
+                                                   'current_png': format_image(name)}}
+            for name in images
+        ]
+        return groups
@@ -0,0 +1,60 @@
+"""
+Микробенчмарк декодирования полезной нагрузки московского протокола.
+
+Для каждого типа пакета сравнивает скомпилированный декодер структуры
+(`read_structure` / `read_items`) с последовательным чтением полей через `read()`.
+
+Запуск:
+    python manage.py bench_moscow_parsers --repeat 20000 --items 30
+"""
+
+
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from Screen_Server.moscow import (
+    AdditionalOperationalData,
+    ConfigureData,
+    OperationalData,
+    RouteData,
+)
+from Screen_Server.replay import build_payload
+
+
+def decode_compiled(packet_class, payload: bytes):
+    parser = packet_class.__new__(packet_class)
+    parser.data, parser.offset = memoryview(payload), 0
+    head = parser.read_structure()
+    parser.read_items(head.get("count", 0))
+
+
+def decode_by_field(packet_class, payload: bytes):
+    parser = packet_class.__new__(packet_class)
+    parser.data, parser.offset = memoryview(payload), 0
+    head = {field_name: parser.read(field_type) for field_name, field_type in packet_class.structure}
+    for _ in range(head.get("count", 0)):
+        for _, field_type in packet_class.item_structure:
+            parser.read(field_type)
+
+
+class Command(BaseCommand):
+    help = "Микробенчмарк декодеров полезной нагрузки московского протокола"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--repeat", type=int, default=20000, help="Число декодирований на замер")
+        parser.add_argument("--items", type=int, default=30, help="Число повторяющихся записей в пакете")
+
+    def handle(self, *args, **options):
+        repeat = options["repeat"]
+        items = options["items"]
+
+        self.stdout.write(f"{'Пакет':28s} {'байт':>6s} {'read(), мкс':>12s} {'compiled, мкс':>14s} {'ускорение':>10s}")
+        for packet_class in (OperationalData, AdditionalOperationalData, RouteData, ConfigureData):
+            payload = build_payload(packet_class, items)
+            by_field = min(timeit.repeat(lambda: decode_by_field(packet_class, payload), number=repeat, repeat=3))
+            compiled = min(timeit.repeat(lambda: decode_compiled(packet_class, payload), number=repeat, repeat=3))
+            self.stdout.write(
+                f"{packet_class.__name__:28s} {len(payload):6d} "
+                f"{by_field / repeat * 1e6:12.2f} {compiled / repeat * 1e6:14.2f} {by_field / compiled:9.1f}x"
+            )
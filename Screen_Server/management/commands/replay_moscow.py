@@ -0,0 +1,217 @@
+"""
+Воспроизведение записанного трафика московского протокола через реальный конвейер
+разбора и рассылки без сети и Redis.
+
+Слой каналов подменяется InMemoryChannelLayer, кэш — locmem, подтверждения маршрута
+не отправляются. Выполняются три прохода:
+
+1. разбор каждой датаграммы `SessionProtocolParser` — p50/p99 времени по типам пакетов;
+2. тот же разбор под tracemalloc — выделение памяти на пакет по типам;
+3. полный конвейер `IngestService` (приём → разбор → объединение → group_send)
+   с K подписанными «экранами» — пакетов/с и число доставленных сообщений.
+   По умолчанию подача ограничивается глубиной очереди приёма, и разбирается
+   каждый пакет; с --conflate действуют настроенные политики переполнения.
+
+Запуск:
+    python manage.py replay_moscow capture.pcap --port 29789 --screens 20
+    python manage.py replay_moscow --synthetic 20000 --trains 4 --write sample.mscap
+"""
+
+
+import statistics
+import time
+import tracemalloc
+
+from collections import defaultdict
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from Screen_Server.ingest import BROADCAST_GROUP, PACKET_KINDS, IngestService, get_ingest_config
+from Screen_Server.moscow import SessionProtocolParser
+from Screen_Server.replay import read_capture, synthetic_capture, write_mscap
+
+
+REPLAY_SETTINGS = {
+    'CHANNEL_LAYERS': {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+            'CONFIG': {'capacity': 100000, 'expiry': 3600},
+        },
+    },
+    'CACHES': {
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    },
+    'MOSCOW_SEND_ROUTE_ANSWER': False,
+}
+DRAIN_POLL_INTERVAL = 0.01  # Период проверки опустошения очередей конвейера (сек)
+
+
+def packet_kind(data: bytes) -> str:
+    if len(data) <= SessionProtocolParser.HEADER_SIZE:
+        return 'Header'
+    return PACKET_KINDS.get(data[SessionProtocolParser.HEADER_SIZE], 'Unknown')
+
+
+def percentile(samples, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def parse(data: bytes):
+    try:
+        return SessionProtocolParser(data).parse_packet()['status']
+    except Exception:
+        return 'error'
+
+
+class Command(BaseCommand):
+    help = "Воспроизведение записи трафика через конвейер разбора и рассылки (без сети и Redis)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("capture", nargs="?", help="Файл записи: pcap или mscap")
+        parser.add_argument("--port", type=int, default=29789, help="UDP-порт протокола в pcap")
+        parser.add_argument("--synthetic", type=int, default=0, help="Сформировать N синтетических датаграмм")
+        parser.add_argument("--trains", type=int, default=1, help="Число поездов в синтетическом трафике")
+        parser.add_argument("--write", help="Сохранить датаграммы в файл mscap")
+        parser.add_argument("--loops", type=int, default=1, help="Число повторов записи в проходе конвейера")
+        parser.add_argument("--screens", type=int, default=10, help="Число подписанных экранов")
+        parser.add_argument("--speed", type=float, default=0,
+                            help="Скорость воспроизведения относительно записи (0 — максимальная)")
+        parser.add_argument("--conflate", action="store_true",
+                            help="Сохранить политики 'latest' очереди приёма (иначе разбирается каждый пакет)")
+        parser.add_argument("--no-alloc", action="store_true", help="Пропустить проход с tracemalloc")
+
+    def handle(self, *args, **options):
+        if options["synthetic"]:
+            datagrams = synthetic_capture(options["synthetic"], trains=options["trains"])
+        elif options["capture"]:
+            datagrams = read_capture(options["capture"], options["port"])
+        else:
+            raise CommandError("Укажите файл записи или --synthetic N")
+        if not datagrams:
+            raise CommandError("В записи нет датаграмм протокола")
+
+        if options["write"]:
+            count = write_mscap(options["write"], datagrams)
+            self.stdout.write(f"Записано датаграмм: {count} → {options['write']}")
+
+        self.stdout.write(f"Датаграмм: {len(datagrams)}")
+        with override_settings(**REPLAY_SETTINGS):
+            self.parse_pass(datagrams)
+            if not options["no_alloc"]:
+                self.alloc_pass(datagrams)
+            self.pipeline_pass(datagrams, options["loops"], options["screens"], options["speed"], options["conflate"])
+
+    def parse_pass(self, datagrams):
+        timings = defaultdict(list)
+        errors = defaultdict(int)
+        clock = time.perf_counter_ns
+        for _, data, _ in datagrams:
+            started = clock()
+            status = parse(data)
+            elapsed = clock() - started
+            kind = packet_kind(data)
+            timings[kind].append(elapsed)
+            if status != 'success':
+                errors[kind] += 1
+
+        self.stdout.write("\nРазбор (SessionProtocolParser.parse_packet):")
+        self.stdout.write(f"{'Пакет':28s} {'шт':>8s} {'ошибок':>7s} {'p50, мкс':>9s} {'p99, мкс':>9s} {'пакетов/с':>10s}")
+        for kind, samples in sorted(timings.items()):
+            self.stdout.write(
+                f"{kind:28s} {len(samples):8d} {errors[kind]:7d} "
+                f"{percentile(samples, 0.5) / 1e3:9.1f} {percentile(samples, 0.99) / 1e3:9.1f} "
+                f"{1e9 / statistics.fmean(samples):10.0f}"
+            )
+
+    def alloc_pass(self, datagrams):
+        peaks = defaultdict(list)
+        tracemalloc.start()
+        try:
+            for _, data, _ in datagrams:
+                tracemalloc.reset_peak()
+                before, _ = tracemalloc.get_traced_memory()
+                parse(data)
+                _, peak = tracemalloc.get_traced_memory()
+                peaks[packet_kind(data)].append(peak - before)
+        finally:
+            tracemalloc.stop()
+
+        self.stdout.write("\nВыделение памяти при разборе (пик на пакет):")
+        self.stdout.write(f"{'Пакет':28s} {'среднее, Б':>11s} {'p99, Б':>9s}")
+        for kind, samples in sorted(peaks.items()):
+            self.stdout.write(f"{kind:28s} {statistics.fmean(samples):11.0f} {percentile(samples, 0.99):9d}")
+
+    def pipeline_pass(self, datagrams, loops: int, screens: int, speed: float, conflate: bool):
+        channel_layer = get_channel_layer()
+        channels = [async_to_sync(channel_layer.new_channel)() for _ in range(screens)]
+        for channel in channels:
+            async_to_sync(channel_layer.group_add)(BROADCAST_GROUP, channel)
+
+        config = get_ingest_config()
+        if not conflate:
+            # Для замера пропускной способности разбора телеметрия не заменяется в очереди приёма
+            config['OVERFLOW_POLICY'] = {}
+        service = IngestService(config=config, listen=False)
+        service.start()
+        backlog = service.config['RECEIVE_QUEUE_SIZE'] // 2
+
+        submitted = 0
+        started = time.perf_counter()
+        try:
+            for _ in range(loops):
+                first_ts, replay_start = datagrams[0][0], time.perf_counter()
+                for timestamp, data, addr in datagrams:
+                    if speed:
+                        delay = (timestamp - first_ts) / speed - (time.perf_counter() - replay_start)
+                        if delay > 0:
+                            time.sleep(delay)
+                    else:
+                        # Максимальная скорость без переполнения очереди приёма:
+                        # учитываются и датаграммы, ещё не принятые циклом сервиса
+                        while submitted - service.received + service.receive_queue.qsize() >= backlog:
+                            time.sleep(0)
+                    service.submit(data, addr)
+                    submitted += 1
+            self.wait_drained(service, len(datagrams) * loops)
+            elapsed = time.perf_counter() - started
+            stats = service.stats()
+        finally:
+            service.stop()
+            for channel in channels:
+                async_to_sync(channel_layer.group_discard)(BROADCAST_GROUP, channel)
+
+        delivered = sum(channel_layer.channels[channel].qsize() for channel in channels
+                        if channel in channel_layer.channels)
+        async_to_sync(channel_layer.flush)()
+        self.stdout.write("\nКонвейер IngestService (приём → разбор → рассылка):")
+        self.stdout.write(
+            f"принято {stats['received']}, разобрано {stats['parsed']}, ошибок {stats['parse_errors']}, "
+            f"пропущено {stats['skipped']}, отправлено в группу {stats['sent']}, "
+            f"доставлено экранам {delivered} ({screens} шт)"
+        )
+        self.stdout.write(f"очередь приёма: {stats['receive_queue']}")
+        self.stdout.write(f"очередь рассылки: {stats['broadcast_queue']}")
+        self.stdout.write(f"время {elapsed:.2f} с, {stats['received'] / elapsed:.0f} пакетов/с")
+
+    def wait_drained(self, service: IngestService, expected: int):
+        """
+        Ждёт, пока все поданные датаграммы пройдут очереди и объединение.
+        """
+        while True:
+            idle = (
+                service.received >= expected
+                and service.receive_queue.qsize() == 0
+                and service.broadcast_queue.qsize() == 0
+                and not service.coalescer
+            )
+            if idle:
+                # Последний пакет мог быть извлечён, но ещё не разобран или не отправлен
+                time.sleep(DRAIN_POLL_INTERVAL)
+                if service.receive_queue.qsize() == 0 and service.broadcast_queue.qsize() == 0 \
+                        and not service.coalescer:
+                    return
+            time.sleep(DRAIN_POLL_INTERVAL)
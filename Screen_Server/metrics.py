@@ -0,0 +1,162 @@
+"""
+Счётчики и гистограммы задержек для горячего пути приёма датаграмм.
+
+Рассчитаны на вызов из цикла событий сервиса приёма на каждую датаграмму:
+счётчик — увеличение значения в словаре, гистограмма — двоичный поиск по
+фиксированным границам корзин (ряд 1-2-5 в микросекундах) и увеличение
+счётчика корзины. Блокировок нет: писатель один (поток сервиса), а снимок для
+HTTP-запроса копирует списки корзин и может отстать на несколько событий.
+
+Снимки гистограмм с одинаковыми границами складываются (merge_snapshots),
+поэтому метрики нескольких процессов приёма объединяются без потерь.
+"""
+
+
+import time
+
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List
+
+
+# Верхние границы корзин гистограммы (мкс): 1, 2, 5, 10, ... 5 000 000
+BUCKET_BOUNDS = tuple(base * 10 ** exp for exp in range(7) for base in (1, 2, 5))
+QUANTILES = (('p50', 0.5), ('p90', 0.9), ('p99', 0.99))
+
+
+class Histogram:
+    """
+    Гистограмма значений в микросекундах с фиксированными границами корзин.
+
+    Последняя корзина (сверх BUCKET_BOUNDS[-1]) собирает все большие значения.
+    """
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.buckets[bisect_left(BUCKET_BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'max': self.max,
+            'buckets': list(self.buckets),
+        }
+
+
+def quantile(buckets: List[int], count: int, fraction: float, maximum: float) -> float:
+    """
+    Оценка квантиля сверху: граница корзины, в которой набирается доля `fraction` значений
+    (но не больше наибольшего наблюдённого значения).
+    """
+    if not count:
+        return 0.0
+    threshold = count * fraction
+    seen = 0
+    for index, bucket in enumerate(buckets[:-1]):
+        seen += bucket
+        if seen >= threshold:
+            return min(float(BUCKET_BOUNDS[index]), maximum)
+    return maximum
+
+
+def describe(snapshot: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Дополняет снимок гистограммы средним значением и квантилями.
+    """
+    count = snapshot['count']
+    described = dict(snapshot, mean=snapshot['sum'] / count if count else 0.0)
+    for name, fraction in QUANTILES:
+        described[name] = quantile(snapshot['buckets'], count, fraction, snapshot['max'])
+    return described
+
+
+class Metrics:
+    """
+    Набор метрик одного сервиса приёма: счётчики и гистограммы с меткой (обычно тип пакета).
+
+    Пример:
+        metrics.inc('received')
+        metrics.observe('parse_us', 'RouteData', elapsed_us)
+    """
+    def __init__(self):
+        self.counters: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self.histograms: Dict[str, Dict[str, Histogram]] = defaultdict(lambda: defaultdict(Histogram))
+        self.started_at = time.time()
+
+    def inc(self, name: str, label: str = 'total', value: int = 1):
+        self.counters[name][label] += value
+
+    def observe(self, name: str, label: str, value: float):
+        self.histograms[name][label].observe(value)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Копия метрик без квантилей (для объединения и передачи между процессами).
+        """
+        return {
+            'started_at': self.started_at,
+            'counters': {name: dict(labels) for name, labels in list(self.counters.items())},
+            'histograms': {
+                name: {label: histogram.snapshot() for label, histogram in list(labels.items())}
+                for name, labels in list(self.histograms.items())
+            },
+        }
+
+
+def merge_snapshots(snapshots: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Складывает снимки метрик нескольких сервисов (процессов).
+    """
+    merged = {'started_at': None, 'counters': {}, 'histograms': {}}
+    for snapshot in snapshots:
+        started_at = snapshot.get('started_at')
+        if started_at is not None and (merged['started_at'] is None or started_at < merged['started_at']):
+            merged['started_at'] = started_at
+        for name, labels in snapshot['counters'].items():
+            target = merged['counters'].setdefault(name, {})
+            for label, value in labels.items():
+                target[label] = target.get(label, 0) + value
+        for name, labels in snapshot['histograms'].items():
+            target = merged['histograms'].setdefault(name, {})
+            for label, histogram in labels.items():
+                if label not in target:
+                    target[label] = dict(histogram, buckets=list(histogram['buckets']))
+                    continue
+                into = target[label]
+                into['count'] += histogram['count']
+                into['sum'] += histogram['sum']
+                into['max'] = max(into['max'], histogram['max'])
+                into['buckets'] = [a + b for a, b in zip(into['buckets'], histogram['buckets'])]
+    return merged
+
+
+def render(snapshot: Dict[str, Any], buckets: bool = False) -> Dict[str, Any]:
+    """
+    Готовит снимок к выдаче в JSON: квантили гистограмм, корзины — по запросу.
+    """
+    histograms = {}
+    for name, labels in snapshot['histograms'].items():
+        histograms[name] = {}
+        for label, histogram in labels.items():
+            described = describe(histogram)
+            if not buckets:
+                del described['buckets']
+            histograms[name][label] = described
+    return {
+        'started_at': snapshot['started_at'],
+        'unit': 'us',
+        'bucket_bounds': list(BUCKET_BOUNDS) if buckets else None,
+        'counters': snapshot['counters'],
+        'histograms': histograms,
+    }
@@ -10,6 +10,9 @@ from django.shortcuts import render, redirect
 from django.http import JsonResponse
 from django.core.cache import cache
 
+from .broadcast import group_send_frame
+from .groups import BNT_GROUP
+
 
 file_path = os.path.join(settings.BASE_DIR, 'L1', 'R2', 'BNT', '1pt.bnt')
 TREE = ET.parse(file_path)
@@ -20,8 +23,6 @@ SH = None
 
 CURRENT_STATION_INDEX = 0
 
-CLIENTS_IP = []
-
 
 class Client:
     """
@@ -145,14 +146,12 @@ def get_stop_info(ROOT):
 
 def get_BNT(request):
     """
-    Обрабатывает запрос к BNT-интерфейсу и регистрирует IP клиента.
+    Обрабатывает запрос к BNT-интерфейсу.
+    Клиент регистрируется при подключении WebSocket (consumers.BNTConsumer).
 
     Возвращает:
         HttpResponse: Отрисовка шаблона BNT.html.
     """
-    ip_address = get_clietnt_ip(request)
-    if ip_address not in CLIENTS_IP:
-        CLIENTS_IP.append(ip_address)
     return render(request, 'Screen_Server/BNT.html')
 
 def get_clietnt_ip(request):
@@ -303,13 +302,8 @@ def send_current_route_data():
     station_data = update_route()
     channel_layer = get_channel_layer()
 
-    async_to_sync(channel_layer.group_send)(
-        'route_updates',
-        {
-            'type': 'update_station',
-            'message': station_data,
-        }
-    )
+    frame = {'type': 'update_station', 'message': station_data}
+    async_to_sync(group_send_frame)(channel_layer, BNT_GROUP, 'update_station', frame)
 
 
 def collect_wagons(size=8, side='Left', current_wagon = 1):
@@ -2,39 +2,147 @@ import socket
 import struct
 import logging
 import asyncio
+import time
 
+from django.conf import settings
 from django.core.cache import cache
 
-from channels.layers import get_channel_layer
-from typing import List, Tuple, Dict, Any, Optional
+from typing import Iterable, List, Tuple, Dict, Any, Optional
 from datetime import datetime as dt
 
-from Screen_Server.consumers_moscow import registry
+from Screen_Server.bootstrap import bootstrap_cache
+from Screen_Server.client_registry import registry
+from Screen_Server.groups import SIDES
+from Screen_Server.state import state_store
+from Screen_Server.crc import packet_crc, verify_packet, verify_packets
+
+
+FIELD_FORMATS = {
+    "int": "B",  # 1 байт
+    "float": "f",  # 4 байта
+    "int16": "H",  # 2 байта
+    "int32": "I",  # 4 байта
+    "byte": "B",  # 1 байт
+}
+STR_LENGTH_FORMAT = "H"  # длина строки перед её содержимым (2 байта)
+BOOTSTRAP_KEYS = {'STOPS', 'CURRENT_NEXT_INDEX', 'SWITCH_SIDES'}  # Ключи кэша, из которых собираются начальные кадры экранов
+ROUTE_SENDER_KEY = 'cached_ROUTE_SENDER'  # IP поезда, приславшего текущий маршрут
+
+
+class CompiledStructure:
+    """
+    Декодер декларативной структуры пакета (список пар (поле, тип)).
+
+    Структура компилируется один раз: подряд идущие поля фиксированной длины
+    объединяются в один `struct.Struct`, а длина строкового поля читается в том же
+    вызове, что и предшествующие ей числа. Отдельно обрабатывается только
+    содержимое строк.
+
+    Атрибуты:
+        fields (List[str]): Имена полей в порядке следования.
+        steps (List[Tuple[struct.Struct, bool]]): Шаги декодирования; флаг
+            означает, что последнее значение шага — длина следующей строки.
+    """
+    def __init__(self, structure: List[Tuple[str, str]]):
+        self.fields = [field_name for field_name, _ in structure]
+        self.steps: List[Tuple[struct.Struct, bool]] = []
+
+        fmt = ""
+        for field_name, field_type in structure:
+            if field_type == "str":
+                self.steps.append((struct.Struct(">" + fmt + STR_LENGTH_FORMAT), True))
+                fmt = ""
+            elif field_type in FIELD_FORMATS:
+                fmt += FIELD_FORMATS[field_type]
+            else:
+                raise ValueError(f"Invalid data type: {field_type}")
+        if fmt:
+            self.steps.append((struct.Struct(">" + fmt), False))
+
+    def decode(self, data: memoryview, offset: int) -> Tuple[List[Any], int]:
+        """
+        Декодирует структуру начиная со смещения `offset`.
+
+        Возвращает:
+            Tuple[List[Any], int]: Значения полей и смещение после структуры.
+        """
+        values = []
+        try:
+            for fmt, str_follows in self.steps:
+                values.extend(fmt.unpack_from(data, offset))
+                offset += fmt.size
+                if str_follows:
+                    end = offset + values.pop()
+                    if end > len(data):
+                        raise ValueError(f"Not enough data to read str at offset {offset}")
+                    values.append(str(data[offset:end], "utf-8"))
+                    offset = end
+        except struct.error:
+            raise ValueError(f"Not enough data to read structure at offset {offset}")
+        return values, offset
+
+    def encode(self, values: List[Any]) -> bytes:
+        """
+        Кодирует значения полей обратно в байты (для тестовых и эталонных пакетов).
+        """
+        chunks = []
+        values = iter(values)
+        for fmt, str_follows in self.steps:
+            count = len(fmt.format) - 1  # коды полей однобуквенные, без префикса '>'
+            if str_follows:
+                head = [next(values) for _ in range(count - 1)]
+                encoded = next(values).encode("utf-8")
+                chunks.append(fmt.pack(*head, len(encoded)))
+                chunks.append(encoded)
+            else:
+                chunks.append(fmt.pack(*(next(values) for _ in range(count))))
+        return b"".join(chunks)
 
 
 class ByteParserBase:
     """
-    Базовый класс для парсинга HEX-пакетов.
+    Базовый класс для парсинга бинарных пакетов.
+
+    Данные читаются напрямую из `bytes`/`memoryview` без промежуточного
+    HEX-представления: смещения считаются в байтах, срезы не копируют буфер.
+
+    Подклассы описывают пакет декларативно: `structure` — поля в начале пакета,
+    `item_structure` — повторяющаяся запись. Обе структуры компилируются в
+    `CompiledStructure` при объявлении класса.
 
     Атрибуты:
-        data (str): HEX-представление пакета.
-        offset (int): Смещение текущего курсора чтения.
+        data (memoryview): Представление буфера пакета.
+        offset (int): Смещение текущего курсора чтения (в байтах).
         sender_ip (str): IP-адрес отправителя пакета.
 
     Методы:
         parse_packet(): Вызов метода `parse()` из подкласса.
-        read(data_type): Чтение и декодирование данных указанного типа из HEX.
+        read(data_type): Чтение и декодирование данных указанного типа из буфера.
+        read_structure(): Чтение всех полей `structure` за один проход.
+        read_items(count): Чтение `count` записей `item_structure`.
     """
-    DATA_SIZE = {
-        "int": 2,  # 2 символа HEX = 1 байт
-        "float": 8,  # 8 символов HEX = 4 байта
-        "int16": 4,  # 4 символа HEX = 2 байта
-        "int32": 8,  # 8 символов HEX = 4 байта
-        "byte": 2  # 2 символа HEX = 1 байт
+    DATA_FORMAT = {
+        data_type: struct.Struct(">" + code) for data_type, code in FIELD_FORMATS.items()
     }
-
-    def __init__(self, hex_data: str, sender_ip: str=None):
-        self.data = hex_data
+    STR_LENGTH = struct.Struct(">" + STR_LENGTH_FORMAT)
+
+    structure: List[Tuple[str, str]] = []
+    item_structure: List[Tuple[str, str]] = []
+    compiled_structure: CompiledStructure = CompiledStructure([])
+    compiled_item_structure: CompiledStructure = CompiledStructure([])
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if "structure" in cls.__dict__:
+            cls.compiled_structure = CompiledStructure(cls.structure)
+        if "item_structure" in cls.__dict__:
+            cls.compiled_item_structure = CompiledStructure(cls.item_structure)
+
+    def __init__(self, data, sender_ip: str=None):
+        if isinstance(data, str):
+            # Обратная совместимость с HEX-строками (логи, ручная отладка)
+            data = bytes.fromhex(data)
+        self.data = data if isinstance(data, memoryview) else memoryview(data)
         self.offset = 0
         self.sender_ip = sender_ip
 
@@ -48,43 +156,49 @@ class ByteParserBase:
 
     def read(self, data_type: str) -> Any:
         """
-        Читает данные указанного типа из HEX-строки.
+        Читает данные указанного типа из буфера.
         """
-        size = self.DATA_SIZE.get(data_type)
-
         if data_type == "str":
-            length = int(self.data[self.offset:self.offset + 4], 16)
-            self.offset += 4
-            string_hex = self.data[self.offset:self.offset + length * 2]
-            self.offset += length * 2
-            return bytes.fromhex(string_hex).decode("utf-8")
-        elif not size:
+            length = self.read("int16")
+            end = self.offset + length
+            if end > len(self.data):
+                raise ValueError(f"Not enough data to read str at offset {self.offset}")
+            value = str(self.data[self.offset:end], "utf-8")
+            self.offset = end
+            return value
+
+        fmt = self.DATA_FORMAT.get(data_type)
+        if not fmt:
             raise ValueError(f"Invalid data type: {data_type}")
 
-        if self.offset + size > len(self.data):
+        if self.offset + fmt.size > len(self.data):
             raise ValueError(f"Not enough data to read {data_type} at offset {self.offset}")
 
-        # Извлекаем необходимую часть строки
-        raw_value = self.data[self.offset:self.offset + size]
-        self.offset += size
-
-        if data_type == "byte":
-            return int(raw_value, 16)  # Преобразуем в целое число (1 байт)
-
-        if data_type == "int":
-            return int(raw_value, 16)  # Преобразуем в целое число (1 байт)
-
-        if data_type == "int16":
-            return int(raw_value, 16)  # Преобразуем в целое число (2 байта)
+        value = fmt.unpack_from(self.data, self.offset)[0]
+        self.offset += fmt.size
+        return value
 
-        if data_type == "int32":
-            return int(raw_value, 16)  # Преобразуем в целое число (4 байта)
+    def read_structure(self) -> Dict[str, Any]:
+        """
+        Читает все поля `structure` и возвращает их в виде словаря.
+        """
+        decoder = self.compiled_structure
+        values, self.offset = decoder.decode(self.data, self.offset)
+        return dict(zip(decoder.fields, values))
 
-        if data_type == "float":
-            # Преобразуем из HEX в float через struct
-            return struct.unpack(">f", bytes.fromhex(raw_value))[0]
+    def read_items(self, count: int) -> List[List[Any]]:
+        """
+        Читает `count` повторяющихся записей `item_structure`.
 
-        raise ValueError(f"Unsupported data type: {data_type}")
+        Возвращает:
+            List[List[Any]]: Значения полей каждой записи в порядке `item_structure`.
+        """
+        decode = self.compiled_item_structure.decode
+        items = []
+        for _ in range(count):
+            values, self.offset = decode(self.data, self.offset)
+            items.append(values)
+        return items
 
 
 class SessionProtocolParser(ByteParserBase):
@@ -94,39 +208,24 @@ class SessionProtocolParser(ByteParserBase):
     Обрабатывает заголовок, проверяет контрольную сумму (CRC),
     определяет тип полезной нагрузки и делегирует парсинг соответствующему подклассу.
     """
-    def __init__(self, hex_data: str):
-        super().__init__(hex_data)
-        self.channel_layer = get_channel_layer()
-        # logging.info(f"Получена строка данных: {hex_data}")
-
-        self.validate_marker()
+    MARKER = b"\xff\xa0\x00\x10"
+    IP_FORMAT = struct.Struct(">4B")
+    CS_OFFSET = 18  # Смещение поля контрольной суммы в заголовке (байт)
+    HEADER_SIZE = 20  # Размер заголовка сеансового уровня (байт)
+    CRC_ERROR = 'Invalid CRC'  # error_message пакета с неверной контрольной суммой
 
-    async def send_to_socket_async(self, data: dict):
-        try:
-            if data['dataType'] == 'ConfigureData':
-                return
-            else:
-                await self.channel_layer.group_send(
-                    'moscow_module_updates',
-                    {
-                        'type': 'moscow_module_update',
-                        'message': data,
-                    }
-                )
-                logging.info("Данные отправлены в WebSocket-группу 'moscow_module_updates'")
-        except Exception as e:
-            logging.error(f"Ошибка при отправке данных в WebSocket: {e}")
+    def __init__(self, data):
+        super().__init__(data)
 
-    def send_to_socket(self, data: dict):
-        asyncio.create_task(self.send_to_socket_async(data))
+        self.validate_marker()
 
     def validate_marker(self):
-        marker = self.data[:8]
-        if marker.lower() != 'ffa00010':
-            logging.error(f"Неверный маркер: {marker}")
-            raise ValueError(f"Invalid marker: {marker}")
+        marker = self.data[:len(self.MARKER)]
+        if marker != self.MARKER:
+            logging.error(f"Неверный маркер: {marker.hex()}")
+            raise ValueError(f"Invalid marker: {marker.hex()}")
         # logging.info(f"Маркер корректен: {marker}")
-        self.offset += 8
+        self.offset += len(self.MARKER)
         # logging.info(f"Смещение после валидации маркера = {self.offset}")
 
     def parse_field(self, field_name: str, data_type: str, validation_func=None):
@@ -140,28 +239,41 @@ class SessionProtocolParser(ByteParserBase):
         return value
 
     def parse_ip(self):
-        ip_bytes = [self.read("byte") for _ in range(4)]
-        ip_address = ".".join(str(byte) for byte in ip_bytes)
+        if self.offset + self.IP_FORMAT.size > len(self.data):
+            raise ValueError(f"Not enough data to read IP at offset {self.offset}")
+        ip_address = "%d.%d.%d.%d" % self.IP_FORMAT.unpack_from(self.data, self.offset)
+        self.offset += self.IP_FORMAT.size
         # logging.info(f"Расшифрованный IP адрес: {ip_address}")
         return ip_address
 
-    def calculate_crc(self, hex_data: str) -> int:
-        data_bytes = bytes.fromhex(hex_data)
-        crc = 0xFFFF
-        for byte in data_bytes:
-            crc ^= byte << 8
-            for _ in range(8):
-                if crc & 0x8000:
-                    crc = (crc << 1) ^ 0x1021
-                else:
-                    crc <<= 1
-            crc &= 0xFFFF
-        return crc
+    def calculate_crc(self, cs_offset: int) -> int:
+        """
+        Пересчитывает CRC пакета с обнулённым полем контрольной суммы.
+        """
+        return packet_crc(self.data, cs_offset)
+
+    @classmethod
+    def is_valid_datagram(cls, data: bytes) -> bool:
+        """
+        Быстрая проверка датаграммы без разбора: маркер, длина заголовка и CRC.
+        """
+        return (
+            len(data) >= cls.HEADER_SIZE
+            and data[:len(cls.MARKER)] == cls.MARKER
+            and verify_packet(data, cls.CS_OFFSET)
+        )
+
+    @classmethod
+    def verify_crc_batch(cls, packets: Iterable) -> List[bool]:
+        """
+        Проверяет CRC сразу для набора пакетов (например, при воспроизведении записи).
+        """
+        return verify_packets(packets, cls.CS_OFFSET)
 
     def parse_packet(self):
         """
         Основной метод парсинга. Проверяет CRC, извлекает заголовок и полезную нагрузку.
-        Рассылает данные через WebSocket (если нужно).
+        Рассылка результата выполняется отдельной стадией (см. ingest.IngestService).
         """
         # logging.info('Начинаем парсинг пакета...')
         try:
@@ -177,10 +289,7 @@ class SessionProtocolParser(ByteParserBase):
 
             original_cs = header['cs']
 
-            cs_offset = self.offset - 4
-            zeroed_data = self.data[:cs_offset] + "0000" + self.data[cs_offset + 4:]
-
-            recalculated_crc = self.calculate_crc(zeroed_data)
+            recalculated_crc = self.calculate_crc(self.offset - 2)
 
             # logging.info(f"Оригинальный CRC: {original_cs}")
             # logging.info(f"Пересчитанный CRC: {recalculated_crc}")
@@ -191,14 +300,14 @@ class SessionProtocolParser(ByteParserBase):
                     'header': header,
                     'payload': None,
                     'status': 'error',
-                    'error_message': 'Invalid CRC',
+                    'error_message': self.CRC_ERROR,
                 }
 
             sender_ip = header['sender_ip']
-            payload = self.data[self.offset:]
-            # logging.info(f"Полезная нагрузка: {payload}")
+            payload = None
 
             if header['size'] > 0:
+                payload = self.data[self.offset:]
                 payload_parser = PacketFactory.create_packet(payload, sender_ip)
                 if asyncio.iscoroutinefunction(payload_parser.parse_packet):
                     payload = payload_parser.parse_packet()
@@ -211,8 +320,6 @@ class SessionProtocolParser(ByteParserBase):
                 'status': 'success',
             }
 
-            self.send_to_socket(parsed_data['payload'])
-
             # logging.info(f"Распаршенный пакет: {parsed_data}")
 
             return parsed_data
@@ -233,23 +340,90 @@ class SessionProtocolParser(ByteParserBase):
             raise ValueError(f"Incorrect packet ID: {packet_id}")
 
 
-def find_station_index(next_station_id: int) -> Tuple[Optional[int], Optional[int]]:
-    next_index = None
-    current_index = None
+class StationIndex:
+    """
+    Индекс станций текущего маршрута в памяти процесса: stationID → позиция в STOPS.
+
+    Строится один раз при принятии нового маршрута (RouteData.parse), поэтому
+    телеметрия (OperationalData) находит индексы станций поиском в словаре, без
+    обращения к Redis и распаковки списка остановок на каждый пакет.
+
+    Маршрут и индекс подменяются одной ссылкой: читатель видит согласованную
+    пару (версия, индекс). До первого маршрута после запуска процесса индекс
+    один раз загружается из состояния процесса (восстановленного из снимка,
+    см. snapshot.py) или кэша; пока маршрута нет, повторная попытка и запись
+    в журнал — не чаще RELOAD_INTERVAL.
+
+    Атрибуты:
+        version (int): Номер версии маршрута; растёт при каждом новом маршруте.
+    """
+    RELOAD_INTERVAL = 1.0  # Сек между попытками загрузки из кэша, пока маршрута нет
+
+    def __init__(self):
+        self._route: Tuple[int, Dict[int, int]] = (0, {})
+        self._loaded = False
+        self._load_attempt = float('-inf')
+        self._published = None
+
+    @property
+    def version(self) -> int:
+        return self._route[0]
+
+    def update(self, stops: Optional[List[Dict[str, Any]]]):
+        """
+        Перестраивает индекс для нового списка остановок.
+        """
+        positions = {}
+        for i, stop in enumerate(stops or ()):
+            # При повторе stationID в маршруте берётся первое вхождение
+            positions.setdefault(stop['stationID'], i)
+        self._route = (self._route[0] + 1, positions)
+        self._loaded = True
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        now = time.monotonic()
+        if now - self._load_attempt < self.RELOAD_INTERVAL:
+            return
+        self._load_attempt = now
+        stops = cache_get('STOPS')
+        if stops:
+            self.update(stops)
+        else:
+            logging.error('cached_STOPS отсутствует в кэше или равно None')
+
+    def lookup(self, next_station_id: int) -> Tuple[Optional[int], Optional[int]]:
+        """
+        Индексы текущей и следующей станции по ID следующей станции.
+        """
+        self._ensure_loaded()
+        version, positions = self._route
+        if not positions:
+            return None, None
+        next_index = positions.get(next_station_id)
+        if next_index is None:
+            return None, None
+        return (next_index - 1 if next_index > 0 else None), next_index
+
+    def publish(self, current_index: Optional[int], next_index: Optional[int]):
+        """
+        Записывает индексы в кэш (для начальных кадров экранов), только если
+        они изменились с прошлой записи этого процесса или сменился маршрут.
+        """
+        published = (self.version, current_index, next_index)
+        if published == self._published:
+            return
+        logging.info(f"Кэшируем индексы: current={current_index}, next={next_index}")
+        cache_set('CURRENT_NEXT_INDEX', {'current': current_index, 'next': next_index})
+        self._published = published
 
-    stops = cache_get('STOPS')
 
-    if not stops:
-        logging.error('cached_STOPS отсутствует в кэше или равно None')
-        return current_index, next_index
+station_index = StationIndex()
 
-    for i, stop in enumerate(stops):
-        if stop['stationID'] == next_station_id:
-            next_index = i
-            current_index = i - 1 if i > 0 else None
-            break
 
-    return current_index, next_index
+def find_station_index(next_station_id: int) -> Tuple[Optional[int], Optional[int]]:
+    return station_index.lookup(next_station_id)
 
 
 class OperationalData(ByteParserBase):
@@ -274,13 +448,12 @@ class OperationalData(ByteParserBase):
     def parse(self) -> Dict[str, Any]:
         """
         Возвращает словарь с телеметрией и индексами текущей и следующей станции.
-        Кэширует информацию об этих индексах.
+        Индексы ищутся в памяти (station_index) и кэшируются, когда меняются.
         """
         parsed_data = {
             'dataType': self.__class__.__name__,
         }
-        for field_name, field_type in self.structure:
-            parsed_data[field_name] = self.read(field_type)
+        parsed_data.update(self.read_structure())
 
         next_station_id = parsed_data['nextStationID']
         current_index, next_index = find_station_index(next_station_id)
@@ -288,8 +461,7 @@ class OperationalData(ByteParserBase):
         parsed_data['currentStationIndex'] = current_index
         parsed_data['nextStationIndex'] = next_index
 
-        logging.info(f"Кэшируем индексы: current={current_index}, next={next_index}")
-        cache_set('CURRENT_NEXT_INDEX', {'current': current_index, 'next': next_index})
+        station_index.publish(current_index, next_index)
 
         logging.info(f"Отработал класс OperationalData")
         return parsed_data
@@ -308,11 +480,18 @@ class AdditionalOperationalData(ByteParserBase):
 
     Атрибуты:
         structure (List[Tuple[str, str]]): Определяет начальную структуру пакета (до повторяющейся части).
+        item_structure (List[Tuple[str, str]]): Структура одной повторяющейся записи.
     """
     structure: List[Tuple[str, str]] = [
         ("outsideTemp", "int"),
         ("count", "int"),
     ]
+    item_structure: List[Tuple[str, str]] = [
+        ("id", "int"),
+        ("train", "int"),
+        ("temp", "int"),
+        ("passengers", "int"),
+    ]
 
     def parse(self) -> Dict[str, Any]:
         """
@@ -324,15 +503,14 @@ class AdditionalOperationalData(ByteParserBase):
         parsed_data = {
             'dataType': self.__class__.__name__,
         }
-        for field_name, field_type in self.structure:
-            parsed_data[field_name] = self.read(field_type)
+        parsed_data.update(self.read_structure())
 
-        count = parsed_data["count"]
-        for i in range(1, count + 1):
-            parsed_data[f'id{i}'] = self.read("int")
-            parsed_data[f'train{i}'] = self.read("int")
-            parsed_data[f'temp{i}'] = self.read("int")
-            parsed_data[f'passengers{i}'] = self.read("int")
+        items = self.read_items(parsed_data["count"])
+        for i, (device_id, train, temp, passengers) in enumerate(items, start=1):
+            parsed_data[f'id{i}'] = device_id
+            parsed_data[f'train{i}'] = train
+            parsed_data[f'temp{i}'] = temp
+            parsed_data[f'passengers{i}'] = passengers
 
         logging.info(f"Отработал класс AdditionalOperationalData")
         return parsed_data
@@ -391,6 +569,55 @@ def get_stops_position(route_data):
 #     return wrapper
 
 
+def send_route_answer(sender_ip: str, result_code: int):
+    """
+    Отправляет бортовой системе подтверждение приёма маршрута.
+
+    Аргументы:
+        sender_ip (str): IP-адрес отправителя пакета RouteData.
+        result_code (int): Код результата (0x00 — маршрут принят, 0x02 — ошибка).
+
+    Отправку можно отключить настройкой MOSCOW_SEND_ROUTE_ANSWER = False
+    (например, при воспроизведении записанного трафика).
+    """
+    if not getattr(settings, 'MOSCOW_SEND_ROUTE_ANSWER', True):
+        return
+    try:
+        ans_packet = bytes([0xFF, result_code])
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # logging.info(f"Попытка соединения с {sender_ip}:29789")
+        sock.sendto(ans_packet, (sender_ip, 29789))
+        sock.close()
+        # logging.info(f"Отправлено подтверждение {ans_packet.hex()} на {sender_ip}")
+    except OSError as e:
+        logging.error(f"Ошибка при отправке ответа на {sender_ip}: {e}")
+
+
+def check_route_sender(sender_ip: str) -> bool:
+    """
+    Запоминает отправителя маршрута; предупреждает, если маршрут прислал другой поезд.
+
+    Маршрут и индексы станций на сервере одни на всех (cached_STOPS): маршрут
+    второго поезда заменяет текущий. Отправитель читается из кэша, а не из
+    памяти процесса: при нескольких процессах приёма поезда попадают в разные.
+
+    Возвращает:
+        bool: Маршрут прислал тот же поезд (или маршрута ещё не было).
+    """
+    try:
+        previous = cache.get(ROUTE_SENDER_KEY)
+    except Exception as e:
+        logging.warning(f"Не удалось прочитать отправителя маршрута: {e}")
+        previous = None
+    state_store.set(ROUTE_SENDER_KEY, sender_ip)
+    if previous and previous != sender_ip:
+        logging.warning(
+            f"Маршрут поезда {previous} заменён маршрутом от {sender_ip}: сервер ведёт один маршрут"
+        )
+        return False
+    return True
+
+
 class RouteData(ByteParserBase):
     """
     Парсит маршрут поезда: список станций, времена прибытия/отправления и идентификатор маршрута.
@@ -403,21 +630,18 @@ class RouteData(ByteParserBase):
         ("routeNumber", "int"),
         ("count", "int"),
     ]
+    item_structure: List[Tuple[str, str]] = [
+        ("stationID", "int32"),
+        ("stationName", "str"),
+        ("arriveTimestamp", "int32"),
+        ("departureTimestamp", "int32"),
+    ]
 
-    def __init__(self, hex_data: str, sender_ip: str):
-        super().__init__(hex_data, sender_ip)
+    def __init__(self, data, sender_ip: str):
+        super().__init__(data, sender_ip)
 
     def send_answer(self, result_code: int):
-        try:
-            ans_packet = bytes([0xFF, result_code])
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            # logging.info(f"Попытка соединения с {self.sender_ip}:29789")
-            sock.sendto(ans_packet, (self.sender_ip, 29789))
-            sock.close()
-            # logging.info(f"Отправлено подтверждение {ans_packet.hex()} на {self.sender_ip}")
-        except Exception as e:
-            # logging.error(f"Ошибка при отправке ответа: {e}")
-            raise {'status': 'error', 'error_message': str(e)}
+        send_route_answer(self.sender_ip, result_code)
 
     def parse(self) -> Dict[str, Any]:
         """
@@ -428,18 +652,12 @@ class RouteData(ByteParserBase):
             parsed_data = {
                 'dataType': self.__class__.__name__,
             }
-            for field_name, field_type in self.structure:
-                parsed_data[field_name] = self.read(field_type)
+            parsed_data.update(self.read_structure())
 
-            count = parsed_data["count"]
+            items = self.read_items(parsed_data["count"])
             stations = {}
 
-            for i in range(1, count + 1):
-                station_id = self.read("int32")
-                station_name = self.read("str")
-                arrive_timestamp = self.read("int32")
-                departure_timestamp = self.read("int32")
-
+            for i, (station_id, station_name, arrive_timestamp, departure_timestamp) in enumerate(items, start=1):
                 stations[f"station{i}"] = {
                     f'stationName{i}': station_name,
                     f'stationID{i}': station_id,
@@ -449,15 +667,16 @@ class RouteData(ByteParserBase):
 
             parsed_data['stations'] = stations
             new_stops = get_stops_position(parsed_data)
+            check_route_sender(self.sender_ip)
 
-            cached_stops = cache.get('cached_STOPS')
-
-            if new_stops != cached_stops:
+            if cache_set("STOPS", new_stops):
                 logging.info('Обновляем stops, так как маршрут изменился.')
-                cache_set("STOPS", new_stops)
+                station_index.update(new_stops)
                 result_code = 0x00
             else:
                 logging.info('Маршрут не изменился, stops остаётся тем же.')
+                if not station_index.version:
+                    station_index.update(new_stops)
                 result_code = 0x00
 
             parsed_data['stops'] = new_stops
@@ -483,6 +702,10 @@ class ConfigureData(ByteParserBase):
     structure: List[Tuple[str, str]] = [
         ("count", "int"),
     ]
+    item_structure: List[Tuple[str, str]] = [
+        ("id", "int32"),
+        ("dir", "byte"),
+    ]
 
     PORT_DEVICE_MAP = {
         1: 'БНТ (голова)',
@@ -492,33 +715,28 @@ class ConfigureData(ByteParserBase):
         5: 'БМВТ (мотор, голова)',
     }
 
-    def __init__(self, hex_data: str):
-        super().__init__(hex_data)
+    def __init__(self, data):
+        super().__init__(data)
         self.switch_map: List[Tuple[str, str]] = []  # просто пары коммутаторов
         self.device_map: Dict[str, Dict[int, Dict[str, Any]]] = {}  # ip → port → client
         self.unknown_devices: List[Dict[str, Any]] = []  # клиенты не в карте коммутаторов
 
     def get_connected_clients(self):
-        raw_clients = registry.get_all_clients()
-        logging.info(f'Информация о подключенных клиентах: {raw_clients}')
-        return [{'ip': ip, 'port': port, 'channel': channel_name} for (ip, port), channel_name in raw_clients.items()]
+        return [entry.as_dict() for entry in registry.entries()]
 
     def parse(self) -> Dict[str, Any]:
         parsed_data = {
             'dataType': self.__class__.__name__,
         }
-        for field_name, field_type in self.structure:
-            parsed_data[field_name] = self.read(field_type)
+        parsed_data.update(self.read_structure())
 
-        count = parsed_data["count"]
-        for i in range(1, count + 1):
-            raw_id = self.read("int32")
+        items = self.read_items(parsed_data["count"])
+        for i, (raw_id, direction) in enumerate(items, start=1):
             parsed_data[f'id{i}_raw'] = raw_id
 
             id_data = self.decode_id(f'id{i}', raw_id)
 
             parsed_data.update(id_data)
-            direction = self.read("byte")
             parsed_data[f'dir{i}'] = direction
 
             train = id_data[f"id{i}_train"]
@@ -532,6 +750,12 @@ class ConfigureData(ByteParserBase):
 
             self.switch_map.append((left_switch_ip, right_switch_ip))
 
+        # Стороны коммутаторов с учётом направления вагонов: по ним экраны
+        # вступают в группы своей стороны (см. groups.ScreenAddress.from_switch)
+        cache_set('SWITCH_SIDES', {
+            ip: side for pair in self.switch_map for ip, side in zip(pair, SIDES)
+        })
+
         self.map_devices()
 
         logging.info(f"Карта коммутаторов: {self.switch_map}")
@@ -544,20 +768,18 @@ class ConfigureData(ByteParserBase):
     def map_devices(self):
         """
         Сопоставляет клиентов с IP-адресами из switch_map и классифицирует их.
+
+        Клиенты каждого коммутатора берутся из индекса реестра (registry.by_switch),
+        без копирования и перебора всего реестра.
         """
-        clients = self.get_connected_clients()
         all_switch_ips = {ip for pair in self.switch_map for ip in pair}
-        used_ips = set()
 
-        for client in clients:
-            ip = client['ip']
-            port = client['port']
+        for ip in all_switch_ips:
+            clients = registry.by_switch(ip)
+            if clients:
+                self.device_map[ip] = {port: entry.as_dict() for port, entry in clients.items()}
 
-            if ip in all_switch_ips:
-                self.device_map.setdefault(ip, {})[port] = client
-                used_ips.add((ip, port))
-            else:
-                self.unknown_devices.append(client)
+        self.unknown_devices = [entry.as_dict() for entry in registry.outside_switches(all_switch_ips)]
 
     # def build_device_map(self) -> List[Tuple[Optional[Dict], Optional[Dict]]]:
     #     connected_clients = self.get_connected_clients()
@@ -615,32 +837,40 @@ class PacketFactory:
         PACKET_MAP (dict): Сопоставление ID → класс-парсер.
     """
     PACKET_MAP = {
-        '10': OperationalData,
-        '11': AdditionalOperationalData,
-        '20': RouteData,
-        '31': ConfigureData,
+        0x10: OperationalData,
+        0x11: AdditionalOperationalData,
+        0x20: RouteData,
+        0x31: ConfigureData,
     }
 
     @staticmethod
-    def create_packet(data: bytes, sender_ip: str, consumer=None) -> ByteParserBase:
-        packet_id = data[:2]
+    def create_packet(data: memoryview, sender_ip: str, consumer=None) -> ByteParserBase:
+        if not len(data):
+            raise ValueError("Empty payload")
+        packet_id = data[0]
         packet_calss = PacketFactory.PACKET_MAP.get(packet_id)
         if not packet_calss:
-            raise ValueError(f"Invalid packet id {packet_id}")
+            raise ValueError(f"Invalid packet id {packet_id:02x}")
 
         # logging.info(f"Данные класса PacketFactory: {packet_calss}")
         if packet_calss == RouteData:
-            return packet_calss(data[2:], sender_ip)
+            return packet_calss(data[1:], sender_ip)
         else:
-            return packet_calss(data[2:])
+            return packet_calss(data[1:])
 
 
-def cache_set(key, variable, timeout=86400):
-    existing_value = cache.get(f"cached_{key}")
-    if existing_value != variable:
-        cache.set(f"cached_{key}", variable, timeout)
+def cache_set(key, variable, timeout=86400) -> bool:
+    """
+    Сохраняет значение в состоянии процесса (state.state_store); в Redis оно
+    записывается отложенно. Возвращает True, если значение изменилось.
+    """
+    changed = state_store.set(f"cached_{key}", variable, timeout)
+    if changed and key in BOOTSTRAP_KEYS:
+        # Готовые начальные кадры экранов, собранные из старого значения
+        bootstrap_cache.invalidate([f"cached_{key}"])
+    return changed
 
 def cache_get(key: dict=None):
     if key is None:
         return {}
-    return cache.get(f"cached_{key}")
+    return state_store.fetch(f"cached_{key}")
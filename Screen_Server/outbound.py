@@ -0,0 +1,250 @@
+"""
+Исходящие очереди WebSocket-соединений: изоляция медленных экранов.
+
+Обработчики событий группы не отправляют кадр в сокет сами, а кладут его в
+ограниченную очередь соединения (queues.OverflowQueue); отдельная задача
+соединения отправляет кадры по одному. Политики очереди:
+
+- телеметрия (OUTBOUND_POLICY, по умолчанию OperationalData и
+  AdditionalOperationalData) — LATEST: ожидающий кадр того же поезда и типа
+  заменяется новым, экран получает только последнее значение;
+- остальное (маршрут, станции, редиректы, опорные кадры) — KEEP: не теряется.
+
+send() консьюмера под Daphne не ждёт сокета: кадр уходит в буфер
+транспорта, и по одному send() нельзя понять, что клиент не читает. Поэтому
+для консьюмеров с delivery_acks (клиент отвечает pong на ping, см. heartbeat.py)
+доставку подтверждает pong: TCP доставляет кадры по порядку, и ответ на ping
+означает, что все кадры, отправленные до него, клиент уже получил. Когда
+неподтверждённых кадров становится MAX_IN_FLIGHT // 2, соединение запрашивает
+подтверждение ping'ом, а при MAX_IN_FLIGHT перестаёт отправлять, пока
+подтверждение не придёт: в буфере транспорта лежит не больше MAX_IN_FLIGHT
+кадров, остальные ждут в очереди, где телеметрия заменяется новой.
+
+Отставание каждого кадра (от постановки в очередь до отправки) собирается в
+гистограмму соединения. Если запрошенное подтверждение не приходит дольше
+SLOW_CLIENT_TIMEOUT секунд или неотправленных кадров больше MAX_PENDING,
+соединение закрывается с кодом SLOW_CLIENT_CLOSE_CODE: экран переподключится
+и получит актуальное состояние, а память сервера не растёт. Без delivery_acks
+(редиректы) кадры отправляются без окна, и ограничение работает только там,
+где send() действительно ждёт клиента.
+"""
+
+
+import asyncio
+import logging
+import time
+
+from collections import deque
+from typing import Any, Dict, Hashable, Optional
+
+from django.conf import settings
+
+from .broadcast import EncodedFrameMixin
+from .metrics import Histogram, describe
+from .queues import KEEP, LATEST, OverflowQueue
+
+
+DEFAULT_OUTBOUND = {
+    'QUEUE_SIZE': 32,  # Ёмкость очереди кадров, вытесняемых при переполнении
+    'MAX_PENDING': 256,  # Больше неотправленных кадров — соединение закрывается
+    'MAX_IN_FLIGHT': 64,  # Отправленных, но не подтверждённых клиентом кадров
+    'ACK_INTERVAL': 1.0,  # Сек между запросами подтверждения при редких кадрах
+    'SLOW_CLIENT_TIMEOUT': 10.0,  # Сек без подтверждения запрошенной доставки
+    'POLICY': {
+        'OperationalData': LATEST,
+        'AdditionalOperationalData': LATEST,
+    },
+}
+SLOW_CLIENT_CLOSE_CODE = 4008
+
+# channel_name → соединение с исходящей очередью (для get_screen_lag)
+CONNECTIONS: Dict[str, 'BufferedSendMixin'] = {}
+
+
+def get_outbound_config() -> Dict[str, Any]:
+    config = dict(DEFAULT_OUTBOUND)
+    config.update(getattr(settings, 'MOSCOW_OUTBOUND', {}))
+    return config
+
+
+class BufferedSendMixin(EncodedFrameMixin):
+    """
+    Отправка кадров через ограниченную очередь соединения.
+
+    Консьюмер вызывает start_outbound() после accept() и stop_outbound() в disconnect();
+    send_frame()/deliver() ставят кадр в очередь вместо прямой отправки.
+    Консьюмер с delivery_acks = True передаёт ts из ответов pong в confirm_delivery()
+    (это делает HeartbeatMixin.heartbeat_received).
+
+    Атрибуты:
+        outbound (OverflowQueue): Очередь кадров соединения.
+        lag (Histogram): Отставание отправленных кадров (мкс).
+        frames_sent (int): Отправлено кадров.
+        frames_acked (int): Из них доставка подтверждена клиентом.
+        slow (bool): Соединение закрыто как медленное.
+    """
+    outbound: Optional[OverflowQueue] = None
+    delivery_acks = False
+
+    def start_outbound(self):
+        config = get_outbound_config()
+        self.outbound_config = config
+        self.outbound = OverflowQueue(config['QUEUE_SIZE'], config['POLICY'], KEEP)
+        self.lag = Histogram()
+        self.frames_sent = 0
+        self.frames_acked = 0
+        self.slow = False
+        self._ack_marks = deque()       # (ts ping, frames_sent на момент ping) неподтверждённых запросов
+        self._ack_requested_at: Optional[float] = None  # time.monotonic() самого старого из них
+        self._last_ack_request = 0.0
+        self._acked = asyncio.Event()
+        self._outbound_task = asyncio.create_task(self._drain_outbound())
+        CONNECTIONS[self.channel_name] = self
+
+    async def stop_outbound(self):
+        CONNECTIONS.pop(getattr(self, 'channel_name', None), None)
+        task = getattr(self, '_outbound_task', None)
+        if task is not None:
+            if task is not asyncio.current_task():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+            self._outbound_task = None
+
+    async def deliver(self, text: Optional[str], data: Optional[bytes], event: Dict[str, Any] = None):
+        kind = event.get('dataType') if event else None
+        await self.enqueue_frame(text, data, kind, (event.get('stream'), kind) if kind else None)
+
+    async def enqueue_frame(self, text: Optional[str], data: Optional[bytes] = None,
+                            kind: str = None, key: Hashable = None):
+        """
+        Ставит кадр в очередь соединения; закрывает соединение, если клиент не успевает.
+        """
+        if self.outbound is None:
+            await self.send(text_data=text, bytes_data=data)
+            return
+        if self.slow:
+            return
+
+        now = time.monotonic()
+        if self.stalled_for(now) > self.outbound_config['SLOW_CLIENT_TIMEOUT'] \
+                or self.outbound.qsize() >= self.outbound_config['MAX_PENDING']:
+            await self._close_slow(self.stalled_for(now))
+            return
+        self.outbound.put_nowait((text, data, now), kind, key)
+
+    def in_flight(self) -> int:
+        """
+        Сколько отправленных кадров клиент ещё не подтвердил.
+        """
+        return self.frames_sent - self.frames_acked if self.delivery_acks else 0
+
+    def stalled_for(self, now: float = None) -> float:
+        """
+        Сколько секунд ждёт ответа самый старый запрос подтверждения.
+        """
+        if self._ack_requested_at is None:
+            return 0.0
+        return (now or time.monotonic()) - self._ack_requested_at
+
+    def confirm_delivery(self, ts: float):
+        """
+        Ответ pong на ping с меткой ts: подтверждены все кадры, отправленные
+        до запросов подтверждения с меткой не позже ts.
+        """
+        if self.outbound is None:
+            return
+        marks = self._ack_marks
+        acked = None
+        while marks and marks[0][0] <= ts:
+            acked = marks.popleft()[1]
+        if acked is None:
+            return
+        self.frames_acked = max(self.frames_acked, acked)
+        self._ack_requested_at = time.monotonic() if marks else None
+        self._acked.set()
+
+    async def _request_ack(self):
+        """
+        Отправляет ping в обход очереди; ответ подтвердит кадры, отправленные до него.
+        """
+        ts = time.time()
+        text, data = self.client_frame({'type': 'ping', 'ts': ts})
+        now = time.monotonic()
+        # Метка ставится до отправки: pong может прийти, пока send() не вернулся
+        self._ack_marks.append((ts, self.frames_sent))
+        self._last_ack_request = now
+        if self._ack_requested_at is None:
+            self._ack_requested_at = now
+        await self.send(text_data=text, bytes_data=data)
+
+    async def _wait_window(self) -> bool:
+        """
+        Ждёт, пока неподтверждённых кадров станет меньше MAX_IN_FLIGHT;
+        False — подтверждение не пришло за SLOW_CLIENT_TIMEOUT.
+        """
+        config = self.outbound_config
+        while self.in_flight() >= config['MAX_IN_FLIGHT']:
+            if not self._ack_marks or self._ack_marks[-1][1] < self.frames_sent:
+                await self._request_ack()
+            remaining = config['SLOW_CLIENT_TIMEOUT'] - self.stalled_for()
+            if remaining <= 0:
+                return False
+            self._acked.clear()
+            try:
+                await asyncio.wait_for(self._acked.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    async def _drain_outbound(self):
+        config = self.outbound_config
+        while True:
+            text, data, enqueued_at = await self.outbound.get()
+            try:
+                if not await self._wait_window():
+                    await self._close_slow(self.stalled_for())
+                    return
+                await self.send(text_data=text, bytes_data=data)
+                now = time.monotonic()
+                self.lag.observe((now - enqueued_at) * 1e6)
+                self.frames_sent += 1
+                if self.delivery_acks and self._ack_requested_at is None and (
+                        self.in_flight() >= config['MAX_IN_FLIGHT'] // 2
+                        or now - self._last_ack_request >= config['ACK_INTERVAL']):
+                    await self._request_ack()
+            except Exception as e:
+                logging.warning(f"Ошибка отправки кадра клиенту {self.channel_name}: {e}")
+                return
+
+    async def _close_slow(self, stalled_for: float):
+        if self.slow:
+            return
+        self.slow = True
+        client = self.scope.get('client')
+        logging.warning(
+            f"Клиент {client} не успевает принимать данные (очередь {self.outbound.qsize()}, "
+            f"не подтверждено {self.in_flight()} кадров, ожидание {stalled_for:.1f} с): соединение закрыто"
+        )
+        CONNECTIONS.pop(self.channel_name, None)
+        await self.close(code=SLOW_CLIENT_CLOSE_CODE)
+
+    def outbound_stats(self) -> Dict[str, Any]:
+        """
+        Глубина очереди, потери, неподтверждённые кадры и отставание кадров соединения.
+        """
+        lag = describe(self.lag.snapshot())
+        del lag['buckets']
+        client = self.scope.get('client') or (None, None)
+        return dict(
+            self.outbound.stats(),
+            client=f"{client[0]}:{client[1]}",
+            path=self.scope.get('path'),
+            sent=self.frames_sent,
+            in_flight=self.in_flight(),
+            stalled_for=self.stalled_for(),
+            lag_us=lag,
+        )
+
+
+def connections_stats():
+    return [connection.outbound_stats() for connection in list(CONNECTIONS.values())]
@@ -0,0 +1,145 @@
+"""
+Ограниченные очереди с политикой переполнения по типу элемента.
+
+Используются между стадиями сервиса приёма (ingest.IngestService) и в исходящих
+очередях WebSocket-соединений (outbound.BufferedSendMixin).
+"""
+
+
+import asyncio
+
+from collections import deque
+from typing import Any, Dict, Hashable
+
+
+DROP_OLDEST = 'drop_oldest'     # При переполнении вытесняется самый старый элемент
+LATEST = 'latest'               # Новое значение заменяет ожидающее значение с тем же ключом
+KEEP = 'keep'                   # Элемент никогда не вытесняется
+
+_REPLACED = object()            # Значение элемента, заменённого более новым (пропускается при выдаче)
+
+
+class OverflowQueue:
+    """
+    Ограниченная очередь для обмена между стадиями в одном цикле событий.
+
+    Политика переполнения выбирается по типу элемента (kind):
+    - DROP_OLDEST: при заполнении очереди вытесняется самый старый элемент;
+    - LATEST: если в очереди уже ждёт элемент с тем же ключом, он удаляется,
+      а новое значение встаёт в конец очереди: элементы, поставленные между
+      ними (например, маршрут того же поезда), не обгоняются;
+    - KEEP: элемент не вытесняется; при заполнении вытесняется самый старый
+      элемент с другой политикой, а если таких нет — очередь превышает maxsize.
+
+    Атрибуты:
+        maxsize (int): Максимальное число элементов.
+        dropped (int): Сколько элементов вытеснено при переполнении.
+        replaced (int): Сколько ожидающих значений заменено более новыми.
+        overflow (int): Сколько элементов KEEP добавлено сверх maxsize.
+        high_watermark (int): Максимальная наблюдавшаяся глубина очереди.
+    """
+    def __init__(self, maxsize: int, policies: Dict[str, str] = None, default_policy: str = DROP_OLDEST):
+        self.maxsize = maxsize
+        self.policies = policies or {}
+        self.default_policy = default_policy
+        self._keeps = default_policy == KEEP or KEEP in self.policies.values()
+        self._items = deque()               # элементы очереди: [kind, key, item]
+        self._latest: Dict[Hashable, list] = {}  # key → ожидающий элемент для политики LATEST
+        self._stale = 0                     # заменённые элементы, ещё лежащие в _items
+        self._ready = asyncio.Event()
+        self.dropped = 0
+        self.replaced = 0
+        self.overflow = 0
+        self.high_watermark = 0
+
+    def put_nowait(self, item: Any, kind: str = None, key: Hashable = None):
+        """
+        Добавляет элемент, никогда не блокируясь.
+        """
+        latest = key is not None and self.policies.get(kind, self.default_policy) == LATEST
+        if latest:
+            entry = self._latest.pop(key, None)
+            if entry is not None:
+                # Удаление из середины deque — O(n): элемент помечается и пропускается в get()
+                entry[2] = _REPLACED
+                self._stale += 1
+                self.replaced += 1
+                if self._stale > self.maxsize:
+                    # Потребитель стоит: помеченные элементы не должны копиться без предела
+                    self._items = deque(entry for entry in self._items if entry[2] is not _REPLACED)
+                    self._stale = 0
+
+        if self.qsize() >= self.maxsize:
+            if self._evict():
+                self.dropped += 1
+            else:
+                self.overflow += 1
+
+        entry = [kind, key, item]
+        self._items.append(entry)
+        if latest:
+            self._latest[key] = entry
+
+        if self.qsize() > self.high_watermark:
+            self.high_watermark = self.qsize()
+        self._ready.set()
+
+    def _evict(self) -> bool:
+        """
+        Вытесняет самый старый элемент, который разрешено вытеснить.
+        """
+        items = self._items
+        if not self._keeps:
+            while items:
+                entry = items.popleft()
+                if entry[2] is _REPLACED:
+                    self._stale -= 1
+                    continue
+                self._forget(entry)
+                return True
+            return False
+        for index, entry in enumerate(items):
+            if entry[2] is not _REPLACED and self.policies.get(entry[0], self.default_policy) != KEEP:
+                del items[index]
+                self._forget(entry)
+                return True
+        return False
+
+    async def get(self) -> Any:
+        """
+        Возвращает следующий элемент, ожидая его появления.
+        """
+        while True:
+            while not self._items:
+                self._ready.clear()
+                await self._ready.wait()
+            entry = self._items.popleft()
+            if entry[2] is _REPLACED:
+                self._stale -= 1
+                continue
+            self._forget(entry)
+            return entry[2]
+
+    def _forget(self, entry: list):
+        key = entry[1]
+        if key is not None and self._latest.get(key) is entry:
+            del self._latest[key]
+
+    def pending(self, key: Hashable) -> bool:
+        """
+        Ждёт ли в очереди элемент LATEST с этим ключом.
+        """
+        return key in self._latest
+
+    def qsize(self) -> int:
+        return len(self._items) - self._stale
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'depth': self.qsize(),
+            'maxsize': self.maxsize,
+            'high_watermark': self.high_watermark,
+            'dropped': self.dropped,
+            'replaced': self.replaced,
+            'overflow': self.overflow,
+        }
@@ -0,0 +1,228 @@
+"""
+Чтение и запись записанного трафика московского протокола для воспроизведения.
+
+Поддерживаемые форматы:
+- pcap (классический libpcap, в т.ч. с наносекундными метками): из кадров
+  Ethernet / Linux SLL / raw IP извлекаются UDP-датаграммы нужного порта;
+- mscap: простой формат с префиксом длины — заголовок файла MSCAP_MAGIC, затем
+  записи `RECORD_HEADER` (время, IP и порт отправителя, длина) и байты датаграммы.
+
+Также формирует синтетический трафик из эталонных значений полей пакетов,
+чтобы измерения можно было провести без записи с поезда и без сети.
+"""
+
+
+import socket
+import struct
+
+from typing import Iterator, List, Optional, Tuple
+
+from .crc import packet_crc
+from .moscow import (
+    AdditionalOperationalData,
+    ConfigureData,
+    OperationalData,
+    PacketFactory,
+    RouteData,
+    SessionProtocolParser,
+)
+
+
+# (время приёма, датаграмма, (ip, порт) отправителя)
+Datagram = Tuple[float, bytes, Tuple[str, int]]
+
+MSCAP_MAGIC = b"MSCAP\x01"
+RECORD_HEADER = struct.Struct(">d4sHI")
+
+PCAP_MAGICS = {
+    b"\xd4\xc3\xb2\xa1": ("<", 1e-6),
+    b"\xa1\xb2\xc3\xd4": (">", 1e-6),
+    b"\x4d\x3c\xb2\xa1": ("<", 1e-9),
+    b"\xa1\xb2\x3c\x4d": (">", 1e-9),
+}
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_VLAN = (0x8100, 0x88A8)
+IPPROTO_UDP = 17
+
+# Тип пакета → ID в PacketFactory.PACKET_MAP
+PACKET_IDS = {packet_class: packet_id for packet_id, packet_class in PacketFactory.PACKET_MAP.items()}
+
+
+def _link_ip_offset(linktype: int, frame: bytes) -> Optional[int]:
+    """
+    Смещение IPv4-заголовка в кадре для поддерживаемых типов канального уровня.
+    """
+    if linktype == 1:  # Ethernet
+        offset, ethertype = 14, struct.unpack_from(">H", frame, 12)[0]
+        while ethertype in ETHERTYPE_VLAN:
+            ethertype = struct.unpack_from(">H", frame, offset + 2)[0]
+            offset += 4
+        return offset if ethertype == ETHERTYPE_IPV4 else None
+    if linktype == 113:  # Linux cooked capture (SLL)
+        return 16 if struct.unpack_from(">H", frame, 14)[0] == ETHERTYPE_IPV4 else None
+    if linktype == 276:  # Linux cooked capture v2 (SLL2)
+        return 20 if struct.unpack_from(">H", frame, 0)[0] == ETHERTYPE_IPV4 else None
+    if linktype == 0:  # BSD loopback
+        return 4
+    if linktype in (12, 101, 228):  # Raw IP / IPv4
+        return 0
+    return None
+
+
+def read_pcap(path: str, port: Optional[int] = None) -> Iterator[Datagram]:
+    """
+    Извлекает UDP-датаграммы из pcap-файла (порт источника или назначения = `port`).
+    """
+    with open(path, "rb") as pcap_file:
+        header = pcap_file.read(24)
+        if header[:4] not in PCAP_MAGICS:
+            raise ValueError(f"{path}: неизвестный формат pcap")
+        endian, ts_scale = PCAP_MAGICS[header[:4]]
+        linktype = struct.unpack_from(endian + "I", header, 20)[0] & 0x0FFFFFFF
+        record = struct.Struct(endian + "IIII")
+
+        while True:
+            record_header = pcap_file.read(record.size)
+            if len(record_header) < record.size:
+                return
+            ts_sec, ts_frac, incl_len, _ = record.unpack(record_header)
+            frame = pcap_file.read(incl_len)
+
+            ip = _link_ip_offset(linktype, frame)
+            if ip is None or len(frame) < ip + 20 or frame[ip] >> 4 != 4 or frame[ip + 9] != IPPROTO_UDP:
+                continue
+            if struct.unpack_from(">H", frame, ip + 6)[0] & 0x3FFF:
+                continue  # фрагменты IP не собираем
+            udp = ip + (frame[ip] & 0x0F) * 4
+            src_port, dst_port, udp_len = struct.unpack_from(">HHH", frame, udp)
+            if port is not None and port not in (src_port, dst_port):
+                continue
+            src_ip = socket.inet_ntoa(frame[ip + 12:ip + 16])
+            yield ts_sec + ts_frac * ts_scale, frame[udp + 8:udp + udp_len], (src_ip, src_port)
+
+
+def read_mscap(path: str) -> Iterator[Datagram]:
+    """
+    Читает датаграммы из файла формата mscap.
+    """
+    with open(path, "rb") as capture_file:
+        if capture_file.read(len(MSCAP_MAGIC)) != MSCAP_MAGIC:
+            raise ValueError(f"{path}: неизвестный формат записи")
+        while True:
+            record_header = capture_file.read(RECORD_HEADER.size)
+            if len(record_header) < RECORD_HEADER.size:
+                return
+            timestamp, ip, port, length = RECORD_HEADER.unpack(record_header)
+            yield timestamp, capture_file.read(length), (socket.inet_ntoa(ip), port)
+
+
+def write_mscap(path: str, datagrams) -> int:
+    """
+    Записывает датаграммы в файл формата mscap. Возвращает число записей.
+    """
+    count = 0
+    with open(path, "wb") as capture_file:
+        capture_file.write(MSCAP_MAGIC)
+        for timestamp, data, (ip, port) in datagrams:
+            capture_file.write(RECORD_HEADER.pack(timestamp, socket.inet_aton(ip), port, len(data)))
+            capture_file.write(data)
+            count += 1
+    return count
+
+
+def read_capture(path: str, port: Optional[int] = None) -> List[Datagram]:
+    """
+    Читает запись, определяя формат по сигнатуре файла.
+    """
+    with open(path, "rb") as capture_file:
+        magic = capture_file.read(len(MSCAP_MAGIC))
+    if magic == MSCAP_MAGIC:
+        return list(read_mscap(path))
+    return list(read_pcap(path, port))
+
+
+def sample_values(packet_class, items: int):
+    """
+    Возвращает эталонные значения полей `structure` и `item_structure` для класса пакета.
+    """
+    samples = {
+        OperationalData: (
+            ["2024-05-01T10:00:00", 55.75, 37.61, 60, 1, 1002, 500, 1, 2, 0],
+            [],
+        ),
+        AdditionalOperationalData: (
+            [20, items],
+            [[i, 5, 22, 40 + i] for i in range(items)],
+        ),
+        RouteData: (
+            ["123", "Головная", 7, items],
+            [[1000 + i, f"Станция {i}", 1700000000 + i * 60, 1700000030 + i * 60] for i in range(items)],
+        ),
+        ConfigureData: (
+            [items],
+            [[123400100 + i, i % 2] for i in range(items)],
+        ),
+    }
+    return samples[packet_class]
+
+
+def build_payload(packet_class, items: int, head: list = None) -> bytes:
+    """
+    Кодирует эталонную полезную нагрузку (без байта типа пакета).
+    """
+    sample_head, records = sample_values(packet_class, items)
+    chunks = [packet_class.compiled_structure.encode(head or sample_head)]
+    chunks.extend(packet_class.compiled_item_structure.encode(record) for record in records)
+    return b"".join(chunks)
+
+
+def build_datagram(packet_class, payload: bytes, sender_ip: str, packet_id: int = 0,
+                   receiver_ip: str = "10.0.0.1") -> bytes:
+    """
+    Собирает датаграмму сеансового уровня с корректной контрольной суммой.
+    """
+    body = bytes([PACKET_IDS[packet_class]]) + payload
+    header = (
+        SessionProtocolParser.MARKER
+        + socket.inet_aton(receiver_ip)
+        + socket.inet_aton(sender_ip)
+        + struct.pack(">HBBHH", packet_id, 1, 0, len(body), 0)
+    )
+    packet = bytearray(header + body)
+    struct.pack_into(">H", packet, SessionProtocolParser.CS_OFFSET,
+                     packet_crc(packet, SessionProtocolParser.CS_OFFSET))
+    return bytes(packet)
+
+
+def synthetic_capture(count: int, trains: int = 1, stations: int = 30, telemetry_hz: float = 10.0) -> List[Datagram]:
+    """
+    Формирует синтетический трафик: маршрут каждого поезда, затем телеметрия
+    с меняющимся временем и редкие дополнительные/конфигурационные пакеты.
+    """
+    datagrams = []
+    timestamp = 0.0
+    step = 1.0 / telemetry_hz
+    senders = [f"10.0.{train + 1}.1" for train in range(trains)]
+
+    for sender in senders:
+        payload = build_payload(RouteData, stations)
+        datagrams.append((timestamp, build_datagram(RouteData, payload, sender, packet_id=1), (sender, 29789)))
+
+    operational_head, _ = sample_values(OperationalData, 0)
+    for i in range(count - len(datagrams)):
+        sender = senders[i % trains]
+        timestamp += step / trains
+        if i % 500 == 499:
+            packet_class, payload = ConfigureData, build_payload(ConfigureData, 8)
+        elif i % 50 == 49:
+            packet_class, payload = AdditionalOperationalData, build_payload(AdditionalOperationalData, 8)
+        else:
+            head = list(operational_head)
+            head[0] = f"2024-05-01T10:{int(timestamp) // 60 % 60:02d}:{int(timestamp) % 60:02d}"
+            head[1] += i * 1e-5
+            head[5] = 1000 + (i // 200) % stations
+            head[6] = 2000 - i % 2000
+            packet_class, payload = OperationalData, build_payload(OperationalData, 0, head)
+        datagrams.append((timestamp, build_datagram(packet_class, payload, sender), (sender, 29789)))
+
+    return datagrams
@@ -0,0 +1,272 @@
+"""
+Запросы к экранам по WebSocket с ответом (RPC) через слой каналов.
+
+Раньше MoscowConsumer.query_switch отправлял запрос и ждал ответ прямым вызовом
+self.receive() — в консьюмере Channels так ответ не получить, а опрос шёл по
+одному экрану с тайм-аутом 5 с на каждый.
+
+Схема обмена:
+
+    вызывающий (RpcClient)                  консьюмер экрана (RpcServerMixin)      экран
+    'rpc.request' {id, method, params, reply_channel}  →  {"type": "rpc", id, method, params}  →
+                                            ←  {"type": "rpc_result", id, result | error}  ←
+    'rpc.response' {id, result, error}  ←
+
+Каждый запрос получает идентификатор (correlation ID); вызывающий держит
+future на идентификатор и разрешает его, когда ответ приходит в его канал.
+Консьюмер пересылает ответ экрана из receive() в канал вызывающего, а при
+отключении экрана сразу отвечает ошибкой на все неотвеченные запросы.
+
+RpcClient.gather отправляет запрос сразу всем целям и ждёт ответов до общего
+срока: опрос всех экранов поезда занимает один тайм-аут, а не N, а не
+успевшие экраны попадают в частичный результат как 'timeout'.
+"""
+
+
+import asyncio
+import logging
+import time
+import uuid
+
+from typing import Any, Dict, Hashable, Iterable, Optional, Tuple
+
+from channels.layers import get_channel_layer
+
+from .client_registry import registry
+
+
+RPC_TIMEOUT = 5.0  # Сек ожидания ответа по умолчанию
+TIMEOUT = 'timeout'
+DISCONNECTED = 'disconnected'
+
+
+class RpcError(Exception):
+    """
+    Экран ответил ошибкой, отключился или не ответил вовремя.
+    """
+
+
+class RpcClient:
+    """
+    Сторона вызывающего: собственный канал для ответов и future на каждый запрос.
+
+    Клиент привязан к циклу событий, в котором создан (см. get_rpc_client).
+
+    Атрибуты:
+        sent (int): Отправлено запросов.
+        answered (int): Получено ответов.
+        timed_out (int): Запросов без ответа к сроку.
+    """
+    def __init__(self, channel_layer=None):
+        self.channel_layer = channel_layer or get_channel_layer()
+        self.reply_channel: Optional[str] = None
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._reader: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.answered = 0
+        self.timed_out = 0
+
+    async def _ensure_channel(self):
+        if self.reply_channel is None:
+            self.reply_channel = await self.channel_layer.new_channel('rpc')
+        if self._reader is None or self._reader.done():
+            self._reader = asyncio.get_running_loop().create_task(self._read_replies())
+
+    async def _read_replies(self):
+        while True:
+            message = await self.channel_layer.receive(self.reply_channel)
+            future = self._pending.pop(message.get('id'), None)
+            if future is None or future.done():
+                continue
+            self.answered += 1
+            if message.get('error') is not None:
+                future.set_exception(RpcError(message['error']))
+            else:
+                future.set_result(message.get('result'))
+
+    async def _send(self, channel_name: str, method: str, params: Any) -> asyncio.Future:
+        request_id = uuid.uuid4().hex
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        self.sent += 1
+        await self.channel_layer.send(channel_name, {
+            'type': 'rpc.request',
+            'id': request_id,
+            'method': method,
+            'params': params,
+            'reply_channel': self.reply_channel,
+        })
+        future.request_id = request_id
+        return future
+
+    def _forget(self, future: asyncio.Future):
+        self._pending.pop(getattr(future, 'request_id', None), None)
+        if not future.done():
+            future.cancel()
+
+    async def call(self, channel_name: str, method: str, params: Any = None, timeout: float = RPC_TIMEOUT) -> Any:
+        """
+        Запрос к одному экрану; RpcError при ошибке или тайм-ауте.
+        """
+        await self._ensure_channel()
+        future = await self._send(channel_name, method, params)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            raise RpcError(TIMEOUT)
+        finally:
+            self._forget(future)
+
+    async def gather(self, targets: Dict[Hashable, str], method: str, params: Any = None,
+                     deadline: float = RPC_TIMEOUT) -> Tuple[Dict[Hashable, Any], Dict[Hashable, str]]:
+        """
+        Запрос всем целям сразу с общим сроком ответа.
+
+        Аргументы:
+            targets (dict): Ключ цели → имя канала консьюмера экрана.
+            deadline (float): Общий срок ожидания ответов (сек).
+
+        Возвращает:
+            tuple: (ключ → результат, ключ → ошибка) — ответившие и остальные.
+        """
+        if not targets:
+            return {}, {}
+        await self._ensure_channel()
+        futures = {}
+        errors = {}
+        for key, channel_name in targets.items():
+            try:
+                futures[key] = await self._send(channel_name, method, params)
+            except Exception as e:
+                errors[key] = str(e)
+
+        if futures:
+            await asyncio.wait(futures.values(), timeout=deadline)
+
+        results = {}
+        for key, future in futures.items():
+            if not future.done():
+                self.timed_out += 1
+                errors[key] = TIMEOUT
+            elif future.exception() is not None:
+                errors[key] = str(future.exception())
+            else:
+                results[key] = future.result()
+            self._forget(future)
+        return results, errors
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'pending': len(self._pending),
+            'sent': self.sent,
+            'answered': self.answered,
+            'timed_out': self.timed_out,
+        }
+
+
+_clients: Dict[asyncio.AbstractEventLoop, RpcClient] = {}
+
+
+def get_rpc_client() -> RpcClient:
+    """
+    RpcClient текущего цикла событий (ответы приходят в очередь этого цикла).
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        for stale in [other for other in _clients if other.is_closed()]:
+            del _clients[stale]
+        client = _clients[loop] = RpcClient()
+    return client
+
+
+class RpcServerMixin:
+    """
+    Сторона консьюмера: пересылает запросы экрану и ответы экрана вызывающему.
+
+    Консьюмер вызывает handle_rpc_result() из receive() и fail_rpc() в disconnect().
+    Отправка идёт через enqueue_frame/client_frame (outbound.BufferedSendMixin).
+    """
+    def _rpc_waiting(self) -> Dict[str, Tuple[str, float]]:
+        waiting = getattr(self, '_rpc_replies', None)
+        if waiting is None:
+            waiting = self._rpc_replies = {}
+        return waiting
+
+    async def rpc_request(self, event: Dict[str, Any]):
+        """
+        Событие 'rpc.request' из слоя каналов: запрос передаётся экрану.
+        """
+        waiting = self._rpc_waiting()
+        now = time.monotonic()
+        # Запросы, ответ на которые уже никто не ждёт
+        for request_id in [key for key, (_, expires) in waiting.items() if expires < now]:
+            del waiting[request_id]
+        waiting[event['id']] = (event['reply_channel'], now + RPC_TIMEOUT * 2)
+        await self.enqueue_frame(*self.client_frame({
+            'type': 'rpc',
+            'id': event['id'],
+            'method': event['method'],
+            'params': event.get('params'),
+        }))
+
+    async def handle_rpc_result(self, message: Any) -> bool:
+        """
+        Пересылает ответ экрана {"type": "rpc_result", ...} вызывающему.
+
+        Возвращает:
+            bool: Сообщение было ответом на запрос.
+        """
+        if not isinstance(message, dict) or message.get('type') != 'rpc_result':
+            return False
+        record = self._rpc_waiting().pop(message.get('id'), None)
+        if record is None:
+            return True
+        await self.channel_layer.send(record[0], {
+            'type': 'rpc.response',
+            'id': message['id'],
+            'result': message.get('result'),
+            'error': message.get('error'),
+        })
+        return True
+
+    async def fail_rpc(self, reason: str = DISCONNECTED):
+        """
+        Отвечает ошибкой на все неотвеченные запросы (экран отключился).
+        """
+        waiting = self._rpc_waiting()
+        for request_id, (reply_channel, _) in list(waiting.items()):
+            try:
+                await self.channel_layer.send(reply_channel, {'type': 'rpc.response', 'id': request_id, 'error': reason})
+            except Exception as e:
+                logging.warning(f"Не удалось ответить на запрос {request_id}: {e}")
+        waiting.clear()
+
+
+async def discover_devices(switch_ips: Iterable[str], method: str = 'get_connected_devices',
+                           params: Any = None, deadline: float = RPC_TIMEOUT) -> Dict[str, Any]:
+    """
+    Опрашивает одновременно все экраны за коммутаторами поезда.
+
+    Аргументы:
+        switch_ips: IP коммутаторов (например, из ConfigureData.switch_map).
+        deadline (float): Общий срок ответа (сек).
+
+    Возвращает:
+        dict: {"devices": {switch_ip: {port: ответ}}, "errors": {"ip:port": ошибка}}.
+    """
+    targets = {}
+    for switch_ip in switch_ips:
+        for port, entry in registry.by_switch(switch_ip).items():
+            targets[(switch_ip, port)] = entry.channel_name
+
+    results, errors = await get_rpc_client().gather(targets, method, params, deadline)
+
+    devices: Dict[str, Dict[int, Any]] = {}
+    for (switch_ip, port), result in results.items():
+        devices.setdefault(switch_ip, {})[port] = result
+    return {
+        'devices': devices,
+        'errors': {f'{switch_ip}:{port}': error for (switch_ip, port), error in errors.items()},
+    }
@@ -0,0 +1,357 @@
+"""
+Снимок состояния процесса в локальном файле для быстрого старта после перезапуска.
+
+После перезагрузки бортового сервера Redis может не содержать маршрута
+(cached_STOPS) или содержать устаревший. Экраны тогда пусты до следующего
+пакета RouteData, а каждый пакет телеметрии не находит станций.
+
+SnapshotWriter раз в INTERVAL секунд, если состояние изменилось, сохраняет
+state.state_store (маршрут, индексы станций, коммутаторы, опорные кадры
+телеметрии) в файл PATH. При запуске restore_snapshot() отображает файл в
+память (mmap), проверяет его и записывает значения в Redis (seed_cache): если
+снимок новее версии состояния в Redis — поверх записанных, иначе только
+отсутствующие ключи. Экраны получают маршрут и последнюю телеметрию
+сразу при подключении, а индекс станций (moscow.StationIndex) строится из
+восстановленного маршрута.
+
+Снимок пишет только процесс, который ведёт состояние:
+- при ingest WORKERS == 1 — основной процесс сервера; он же загружает снимок
+  в state_store как исходное состояние (StateStore.restore);
+- при WORKERS > 1 — рабочий процесс приёма, получивший маршрут: запись
+  запускается во всех процессах приёма (start_snapshot_writer), но снимок пишет
+  только тот, чьё состояние ведётся локально (StateStore.is_local). Основной
+  процесс тогда только читает состояние из Redis и снимок лишь записывает в Redis.
+
+Формат файла (little-endian):
+
+    заголовок  magic 'PSSS', формат (H), кодек (H), схема (I),
+               версия состояния (Q), время записи (d), число записей (I)
+    записи     длина ключа (H), длина значения (I), ключ UTF-8, значение
+    контроль   CRC32 всего предшествующего (I)
+
+Значения кодируются msgpack (если установлен) или JSON. Снимок отбрасывается,
+если не совпадают magic, формат или схема (SNAPSHOT_SCHEMA меняется вместе со
+структурой значений состояния), кодек недоступен, не сходится CRC, снимок
+старше MAX_AGE секунд или в Redis записана более новая версия состояния.
+
+Файл пишется во временный и подменяется атомарно (os.replace) после fsync:
+при потере питания остаётся прежний или новый снимок целиком.
+"""
+
+
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from typing import Any, Dict, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .state import STATE_TIMEOUT, STATE_VERSION_KEY, state_store
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - msgpack необязателен
+    msgpack = None
+
+
+DEFAULT_SNAPSHOT = {
+    'PATH': None,  # Файл снимка; None — снимки отключены
+    'INTERVAL': 5.0,  # Сек между снимками (если состояние изменилось)
+    'MAX_AGE': 86400.0,  # Сек, после которых снимок считается устаревшим
+}
+SNAPSHOT_MAGIC = b'PSSS'
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_SCHEMA = 1
+CODEC_MSGPACK = 1
+CODEC_JSON = 2
+
+HEADER = struct.Struct('<4sHHIQdI')
+RECORD = struct.Struct('<HI')
+TRAILER = struct.Struct('<I')
+
+
+def get_snapshot_config() -> Dict[str, Any]:
+    config = dict(DEFAULT_SNAPSHOT)
+    config.update(getattr(settings, 'SCREEN_SNAPSHOT', {}))
+    return config
+
+
+def _codec() -> int:
+    return CODEC_MSGPACK if msgpack is not None else CODEC_JSON
+
+
+def _encode(value: Any, codec: int) -> bytes:
+    if codec == CODEC_MSGPACK:
+        return msgpack.packb(value, use_bin_type=True)
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def _decode(data, codec: int) -> Any:
+    if codec == CODEC_MSGPACK:
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+    return json.loads(bytes(data))
+
+
+def encode_snapshot(values: Dict[str, Any], version: int, created: float = None) -> bytes:
+    """
+    Снимок состояния в формате файла (см. описание модуля).
+    """
+    codec = _codec()
+    parts = [HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT, codec, SNAPSHOT_SCHEMA, version,
+                         time.time() if created is None else created, len(values))]
+    for key, value in values.items():
+        key_bytes = key.encode()
+        value_bytes = _encode(value, codec)
+        parts.append(RECORD.pack(len(key_bytes), len(value_bytes)))
+        parts.append(key_bytes)
+        parts.append(value_bytes)
+    body = b''.join(parts)
+    return body + TRAILER.pack(zlib.crc32(body))
+
+
+def decode_snapshot(buffer, max_age: float = None) -> Tuple[int, float, Dict[str, Any]]:
+    """
+    Разбирает снимок из буфера (bytes или mmap).
+
+    Возвращает:
+        tuple: (версия состояния, время записи, ключ → значение).
+
+    Исключения:
+        ValueError: Снимок повреждён, устарел или записан в другом формате.
+    """
+    view = memoryview(buffer)
+    try:
+        if len(view) < HEADER.size + TRAILER.size:
+            raise ValueError('файл короче заголовка')
+        magic, file_format, codec, schema, version, created, count = HEADER.unpack_from(view)
+        if magic != SNAPSHOT_MAGIC or file_format != SNAPSHOT_FORMAT:
+            raise ValueError(f'формат {magic!r}/{file_format}, ожидается {SNAPSHOT_MAGIC!r}/{SNAPSHOT_FORMAT}')
+        if schema != SNAPSHOT_SCHEMA:
+            raise ValueError(f'схема {schema}, ожидается {SNAPSHOT_SCHEMA}')
+        if codec not in (CODEC_MSGPACK, CODEC_JSON) or (codec == CODEC_MSGPACK and msgpack is None):
+            raise ValueError(f'кодек {codec} недоступен')
+        end = len(view) - TRAILER.size
+        (crc,) = TRAILER.unpack_from(view, end)
+        if zlib.crc32(view[:end]) != crc:
+            raise ValueError('не сходится CRC')
+        age = time.time() - created
+        if max_age is not None and age > max_age:
+            raise ValueError(f'снимок записан {age:.0f} с назад')
+
+        values = {}
+        offset = HEADER.size
+        for _ in range(count):
+            key_length, value_length = RECORD.unpack_from(view, offset)
+            offset += RECORD.size
+            key = bytes(view[offset:offset + key_length]).decode()
+            offset += key_length
+            values[key] = _decode(view[offset:offset + value_length], codec)
+            offset += value_length
+        if offset != end:
+            raise ValueError('длина записей не совпадает с размером файла')
+        return version, created, values
+    except struct.error as e:
+        raise ValueError(f'запись за концом файла: {e}')
+    finally:
+        view.release()
+
+
+def write_snapshot(path, values: Dict[str, Any], version: int) -> int:
+    """
+    Атомарно записывает снимок в файл; возвращает его размер в байтах.
+    """
+    data = encode_snapshot(values, version)
+    os.makedirs(os.path.dirname(os.fspath(path)) or '.', exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+    return len(data)
+
+
+def read_snapshot(path, max_age: float = None) -> Optional[Tuple[int, float, Dict[str, Any]]]:
+    """
+    Читает снимок через mmap; None, если файла нет или он не прошёл проверку.
+    """
+    try:
+        with open(path, 'rb') as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return decode_snapshot(mapped, max_age)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logging.warning(f"Снимок состояния {path} отброшен: {e}")
+        return None
+
+
+class SnapshotWriter:
+    """
+    Периодическая запись снимка state_store в фоновом потоке.
+
+    Атрибуты:
+        written_version (int): Версия состояния последнего снимка.
+        writes (int): Записано снимков.
+        errors (int): Неудачных записей.
+        last_size (int): Размер последнего снимка (байт).
+        last_write_us (float): Время последней записи (мкс).
+    """
+    def __init__(self, path, interval: float, store=state_store):
+        self.path = path
+        self.interval = interval
+        self.store = store
+        self.written_version = 0
+        self.writes = 0
+        self.errors = 0
+        self.last_size = 0
+        self.last_write_us = 0.0
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='state-snapshot', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.write()
+
+    def write(self, force: bool = False) -> bool:
+        """
+        Записывает снимок, если состояние изменилось с прошлого снимка.
+        """
+        with self._lock:
+            if not self.store.is_local():
+                return False
+            version, values = self.store.snapshot()
+            if version == self.written_version and not force:
+                return False
+            started = time.perf_counter()
+            try:
+                self.last_size = write_snapshot(self.path, values, version)
+            except Exception as e:
+                self.errors += 1
+                logging.error(f"Не удалось записать снимок состояния {self.path}: {e}")
+                return False
+            self.last_write_us = (time.perf_counter() - started) * 1e6
+            self.written_version = version
+            self.writes += 1
+            return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'path': str(self.path),
+            'version': self.written_version,
+            'writes': self.writes,
+            'errors': self.errors,
+            'size': self.last_size,
+            'write_us': self.last_write_us,
+        }
+
+
+_writer: Optional[SnapshotWriter] = None
+
+
+def _remote_version() -> int:
+    try:
+        return int(cache.get(STATE_VERSION_KEY) or 0)
+    except Exception as e:
+        logging.warning(f"Версия состояния в Redis недоступна: {e}")
+        return 0
+
+
+def seed_cache(values: Dict[str, Any], version: int = None) -> int:
+    """
+    Записывает значения снимка в кэш; возвращает число записанных ключей.
+
+    Если передана версия снимка (она новее STATE_VERSION_KEY в Redis), значения
+    перезаписываются вместе с версией: иначе устаревший маршрут в Redis читали бы
+    read()/read_many(), а индекс станций строился бы по снимку. Без версии
+    уже записанные в кэш значения не затираются.
+    """
+    if version is not None:
+        try:
+            failed = cache.set_many(dict(values, **{STATE_VERSION_KEY: version}), STATE_TIMEOUT)
+        except Exception as e:
+            logging.warning(f"Не удалось записать снимок в кэш: {e}")
+            return 0
+        return len(values) - len([key for key in failed or () if key != STATE_VERSION_KEY])
+    seeded = 0
+    for key, value in values.items():
+        try:
+            seeded += bool(cache.add(key, value, STATE_TIMEOUT))
+        except Exception as e:
+            logging.warning(f"Не удалось записать {key} из снимка в кэш: {e}")
+            break
+    return seeded
+
+
+def start_snapshot_writer() -> Optional[SnapshotWriter]:
+    """
+    Запускает периодическую запись снимка в процессе, который ведёт состояние.
+    """
+    global _writer
+    config = get_snapshot_config()
+    if not config['PATH']:
+        return None
+    if _writer is None:
+        _writer = SnapshotWriter(config['PATH'], config['INTERVAL'])
+    _writer.start()
+    return _writer
+
+
+def restore_snapshot(owner: bool = True) -> bool:
+    """
+    Восстанавливает состояние из снимка при запуске.
+
+    Параметры:
+        owner (bool): Процесс ведёт состояние: снимок загружается и в state_store,
+            запускается периодическая запись. Иначе значения только записываются в Redis.
+
+    Возвращает:
+        bool: Состояние восстановлено из снимка.
+    """
+    config = get_snapshot_config()
+    if not config['PATH']:
+        return False
+    writer = start_snapshot_writer() if owner else None
+
+    started = time.perf_counter()
+    snapshot = read_snapshot(config['PATH'], config['MAX_AGE'])
+    if snapshot is None:
+        return False
+    version, created, values = snapshot
+    remote_version = _remote_version()
+    if remote_version > version:
+        logging.info(f"Снимок состояния отброшен: версия {version}, в Redis новее ({remote_version})")
+        return False
+    seeded = seed_cache(values, version if version > remote_version else None)
+    if writer is not None:
+        state_store.restore(values, version)
+        writer.written_version = version
+    logging.info(
+        f"Состояние восстановлено из снимка: версия {version}, ключей {len(values)} (в Redis записано {seeded}), "
+        f"записан {time.time() - created:.0f} с назад, загрузка {(time.perf_counter() - started) * 1e3:.1f} мс"
+    )
+    return True
+
+
+def save_snapshot() -> bool:
+    """
+    Записывает снимок немедленно (при остановке сервиса приёма).
+    """
+    return _writer.write() if _writer is not None else False
+
+
+def snapshot_stats() -> Optional[Dict[str, Any]]:
+    return _writer.stats() if _writer is not None else None
@@ -0,0 +1,222 @@
+"""
+Состояние маршрута и телеметрии в памяти процесса с отложенной записью в Redis.
+
+Раньше каждое значение (маршрут, индексы станций, состояние потоков дельт)
+записывалось через cache_set: GET из Redis, сравнение в Python и SET — два
+блокирующих обращения на каждый пакет OperationalData, прямо из цикла событий
+сервиса приёма. Консьюмеры при подключении читали эти же ключи из Redis через
+sync_to_async.
+
+StateStore — основная копия состояния в процессе, где идёт разбор пакетов:
+- set() сравнивает значение с копией в памяти и при изменении увеличивает
+  версию хранилища (монотонно растущий номер) — без обращений к Redis;
+- изменённые ключи пишутся в Redis отдельным потоком пакетами (cache.set_many,
+  в django_redis — один конвейер) не чаще раза в FLUSH_INTERVAL секунд;
+  повторные изменения ключа между записями схлопываются в последнее значение;
+- вместе со значениями пишется номер версии (STATE_VERSION_KEY), по которому
+  читатели других процессов видят, насколько свежи данные.
+
+Redis нужен только читателям других процессов: процессам приёма при
+ingest WORKERS > 1 и второму экземпляру сервера. Если в этом процессе
+состояние ещё не записывалось (is_local() is False), чтение идёт из Redis.
+"""
+
+
+import logging
+import threading
+import time
+
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+
+
+DEFAULT_STATE = {
+    'FLUSH_INTERVAL': 0.05,  # Сек накопления изменений перед записью в Redis
+}
+STATE_VERSION_KEY = 'cached_STATE_VERSION'
+STATE_TIMEOUT = 86400
+
+_MISSING = object()
+
+
+def get_state_config() -> Dict[str, Any]:
+    config = dict(DEFAULT_STATE)
+    config.update(getattr(settings, 'SCREEN_STATE', {}))
+    return config
+
+
+class StateStore:
+    """
+    Версионированное хранилище ключ → значение с отложенной пакетной записью в кэш.
+
+    Писать можно из любого потока; чтение из памяти не блокирует цикл событий
+    и не требует sync_to_async.
+
+    Атрибуты:
+        version (int): Номер последнего изменения.
+        flushes (int): Пакетов записи в Redis.
+        written (int): Записано ключей.
+        write_errors (int): Неудачных пакетов (ключи остаются к следующей записи).
+    """
+    def __init__(self, flush_interval: float):
+        self.flush_interval = flush_interval
+        self.version = 0
+        self.flushes = 0
+        self.written = 0
+        self.write_errors = 0
+        self._local = False
+        self._values: Dict[str, Tuple[int, Any]] = {}
+        self._dirty: Dict[str, int] = {}  # ключ → срок хранения в кэше
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._writer: Optional[threading.Thread] = None
+
+    # Запись
+
+    def set(self, key: str, value: Any, timeout: int = STATE_TIMEOUT) -> bool:
+        """
+        Сохраняет значение; возвращает True, если оно изменилось.
+        """
+        with self._lock:
+            current = self._values.get(key)
+            # Значение из снимка (версия 0) не подтверждено: в Redis может быть другое
+            if current is not None and current[0] and current[1] == value:
+                return False
+            self.version += 1
+            self._local = True
+            self._values[key] = (self.version, value)
+            self._dirty[key] = timeout
+        self._schedule()
+        return True
+
+    def _schedule(self):
+        if self._writer is None or not self._writer.is_alive():
+            with self._lock:
+                if self._writer is None or not self._writer.is_alive():
+                    self._writer = threading.Thread(target=self._write_behind, name='state-writer', daemon=True)
+                    self._writer.start()
+        self._wakeup.set()
+
+    def _write_behind(self):
+        while True:
+            self._wakeup.wait()
+            # Изменения, пришедшие за интервал, уходят одним пакетом
+            time.sleep(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self) -> int:
+        """
+        Записывает изменённые ключи в кэш; возвращает число записанных ключей.
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            batches: Dict[int, Dict[str, Any]] = {}
+            for key, timeout in dirty.items():
+                batches.setdefault(timeout, {})[key] = self._values[key][1]
+            version = self.version
+        if not dirty:
+            return 0
+        batches.setdefault(STATE_TIMEOUT, {})[STATE_VERSION_KEY] = version
+        try:
+            for timeout, values in batches.items():
+                cache.set_many(values, timeout)
+        except Exception as e:
+            self.write_errors += 1
+            logging.error(f"Не удалось записать состояние в кэш: {e}")
+            with self._lock:
+                # Ключи, изменённые после снятия пакета, уже ждут записи с новым значением
+                for key, timeout in dirty.items():
+                    self._dirty.setdefault(key, timeout)
+            return 0
+        self.flushes += 1
+        self.written += len(dirty)
+        return len(dirty)
+
+    def restore(self, values: Dict[str, Any], version: int):
+        """
+        Загружает состояние, сохранённое до перезапуска (см. snapshot.py), как
+        исходное: хранилище не становится источником состояния (is_local()),
+        пока процесс не запишет собственное значение, и ключи не пишутся в Redis
+        (туда их записывает snapshot.seed_cache, не затирая более новых).
+        """
+        with self._lock:
+            self.version = max(self.version, version)
+            for key, value in values.items():
+                if key not in self._values:
+                    self._values[key] = (0, value)
+
+    def snapshot(self) -> Tuple[int, Dict[str, Any]]:
+        """
+        Согласованная копия состояния: (версия, ключ → значение).
+        """
+        with self._lock:
+            return self.version, {key: entry[1] for key, entry in self._values.items()}
+
+    # Чтение
+
+    def is_local(self) -> bool:
+        """
+        Состояние записывается в этом процессе (иначе его ведёт другой процесс).
+        """
+        return self._local
+
+    def get(self, key: str, default: Any = None) -> Any:
+        entry = self._values.get(key)
+        return default if entry is None else entry[1]
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        values = self._values
+        return {key: values[key][1] for key in keys if key in values}
+
+    def read(self, key: str, default: Any = None) -> Any:
+        """
+        Значение из памяти, а если состояние ведёт другой процесс — из кэша.
+        Обращается к Redis: в консьюмерах — только через sync_to_async.
+        """
+        if self.is_local():
+            return self.get(key, default)
+        value = cache.get(key, _MISSING)
+        return default if value is _MISSING else value
+
+    def fetch(self, key: str, default: Any = None) -> Any:
+        """
+        Значение из памяти, а если его там нет — из кэша (например, маршрут,
+        полученный до перезапуска процесса). Обращается к Redis.
+        """
+        entry = self._values.get(key)
+        if entry is not None:
+            return entry[1]
+        value = cache.get(key, _MISSING)
+        return default if value is _MISSING else value
+
+    def read_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        if self.is_local():
+            return self.get_many(keys)
+        return cache.get_many(list(keys))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'version': self.version,
+            'keys': len(self._values),
+            'pending': len(self._dirty),
+            'flushes': self.flushes,
+            'written': self.written,
+            'write_errors': self.write_errors,
+        }
+
+
+state_store = StateStore(get_state_config()['FLUSH_INTERVAL'])
+
+
+async def read_state(func, *args):
+    """
+    Вызывает функцию чтения состояния из консьюмера: сразу, если состояние
+    в памяти процесса, иначе в потоке через sync_to_async (чтение из Redis).
+    """
+    if state_store.is_local():
+        return func(*args)
+    return await sync_to_async(func)(*args)
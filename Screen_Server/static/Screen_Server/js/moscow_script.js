@@ -5,6 +5,12 @@ let serverTime = null;
 let localOffset = 0;
 const maxReconnectAttempts = 60;
 const reconnectInterval = 1000;
+// Дельта-протокол: поток (IP поезда) → {epoch, seq: {dataType: номер}, state: {dataType: последний пакет}}
+const useDelta = true;
+// Двоичные кадры msgpack (декодер — msgpack.js); сообщения серверу по-прежнему JSON
+const useBinary = true;
+let streams = {};
+let resyncRequested = false;
 
 /**
  * Создаёт и настраивает WebSocket соединение с сервером,
@@ -13,7 +19,11 @@ const reconnectInterval = 1000;
  */
 function createWebSocket() {
     // Определяем адрес WebSocket-сервера
-    socket = new WebSocket(`ws://${window.location.host}/ws/moscow_module/`);
+    socket = new WebSocket(
+        `ws://${window.location.host}/ws/moscow_module/${useDelta ? '?delta=1' : ''}`,
+        useBinary ? ['msgpack'] : []
+    );
+    socket.binaryType = 'arraybuffer';
 
     /**
      * Обработчик успешного открытия WebSocket-соединения.
@@ -42,8 +52,18 @@ function createWebSocket() {
      * @param {MessageEvent} event
      */
     socket.onmessage = function (event) {
-        const data = JSON.parse(event.data);
-        console.log("Получены данные:", data);
+        const data = decodeFrame(event);
+
+        // Проверка живости соединения сервером: ts возвращается без изменений
+        if (data.type === 'ping') {
+            socket.send(JSON.stringify({type: 'pong', ts: data.ts}));
+            return;
+        }
+
+        if (data.type === 'rpc') {
+            handleRpc(data);
+            return;
+        }
 
         if (data.start_stops) {
             stops = data.start_stops;
@@ -52,24 +72,15 @@ function createWebSocket() {
             updateProgressBar(data.currentStationIndex, data.nextStationIndex);
         }
 
-        if (data.message && data.message.dataType === 'RouteData') {
-            const newStops = data.message.stops;
-            if (isStopsChanged(newStops)) {
-                stops = newStops;
-                console.log('Маршрут изменился, обновляем...');
-                renderStops(stops);
-            } else {
-                console.log('Маршрут не изменился, пропускаем обновление.');
-            }
-        }
-
-        if (data.message && data.message.dataType === 'OperationalData') {
-            console.log("Данные типа:", data.message.dataType);
-            updateProgressBar(data.message.currentStationIndex, data.message.nextStationIndex);
-            if (data.message?.time) {
-                let time = data.message.time;
-                handleServerMessage(time);
+        if (data.type === 'keyframe') {
+            applyKeyframe(data.streams || {});
+        } else if (data.type === 'delta') {
+            const message = applyDelta(data);
+            if (message) {
+                handleUpdate(message);
             }
+        } else if (data.message && trackStream(data)) {
+            handleUpdate(data.message);
         }
     };
 
@@ -93,8 +104,158 @@ function createWebSocket() {
     };
 }
 
+/**
+ * Обрабатывает полный пакет данных (из кадра update или собранный из дельты).
+ * @param {Object} message
+ */
+function handleUpdate(message) {
+    if (message.dataType === 'RouteData') {
+        const newStops = message.stops;
+        if (isStopsChanged(newStops)) {
+            stops = newStops;
+            console.log('Маршрут изменился, обновляем...');
+            renderStops(stops);
+        } else {
+            console.log('Маршрут не изменился, пропускаем обновление.');
+        }
+    }
+
+    if (message.dataType === 'OperationalData') {
+        updateProgressBar(message.currentStationIndex, message.nextStationIndex);
+        if (message.time) {
+            handleServerMessage(message.time);
+        }
+    }
+}
+
+/**
+ * Принимает опорный кадр: состояние потоков заменяется присланным,
+ * последняя телеметрия каждого потока сразу применяется.
+ * @param {Object} keyframeStreams - поток → {epoch, seq, state}
+ */
+function applyKeyframe(keyframeStreams) {
+    streams = keyframeStreams;
+    resyncRequested = false;
+    Object.values(streams).forEach(stream => {
+        Object.values(stream.state || {}).forEach(handleUpdate);
+    });
+}
+
+/**
+ * Запрашивает опорный кадр после пропуска номера в потоке (не чаще одного раза до ответа).
+ */
+function requestResync() {
+    if (resyncRequested || !socket || socket.readyState !== WebSocket.OPEN) {
+        return;
+    }
+    resyncRequested = true;
+    console.log('Пропуск в потоке дельт, запрашиваем опорный кадр');
+    socket.send(JSON.stringify({action: 'resync'}));
+}
+
+/**
+ * Проверяет номер кадра потока (номера ведутся отдельно для каждого типа пакета).
+ * @returns {string} 'next' — очередной, 'stale' — уже применён, 'gap' — пропуск, 'new' — нет опоры
+ */
+function checkSequence(data, dataType) {
+    const stream = streams[data.stream];
+    if (!stream || stream.epoch !== data.epoch || stream.seq[dataType] === undefined) {
+        return 'new';
+    }
+    const last = stream.seq[dataType];
+    if (data.seq <= last) {
+        return 'stale';
+    }
+    return data.seq === last + 1 ? 'next' : 'gap';
+}
+
+/**
+ * Запоминает полный кадр как опору для следующих дельт того же типа.
+ * Полный кадр самодостаточен, поэтому пропуск перед ним не требует опорного кадра.
+ * @param {Object} data - кадр update с полями stream, epoch, seq
+ * @returns {boolean} false, если кадр устарел (более новое состояние уже применено)
+ */
+function trackStream(data) {
+    if (!useDelta || data.stream === undefined) {
+        return true;
+    }
+    const dataType = data.message.dataType;
+    if (checkSequence(data, dataType) === 'stale') {
+        return false;
+    }
+    let stream = streams[data.stream];
+    if (!stream || stream.epoch !== data.epoch) {
+        stream = streams[data.stream] = {epoch: data.epoch, seq: {}, state: {}};
+    }
+    stream.seq[dataType] = data.seq;
+    stream.state[dataType] = data.message;
+    return true;
+}
+
+/**
+ * Применяет дельта-кадр к последнему пакету того же типа.
+ * @param {Object} data - {stream, epoch, seq, dataType, changed, removed}
+ * @returns {Object|null} собранный пакет или null, если применить нельзя
+ */
+function applyDelta(data) {
+    const status = checkSequence(data, data.dataType);
+    if (status === 'stale') {
+        return null;
+    }
+    const stream = streams[data.stream];
+    const base = stream && stream.state[data.dataType];
+    if (status !== 'next' || !base) {
+        requestResync();
+        return null;
+    }
+    const message = Object.assign({}, base, data.changed);
+    (data.removed || []).forEach(key => delete message[key]);
+    stream.seq[data.dataType] = data.seq;
+    stream.state[data.dataType] = message;
+    return message;
+}
+
 createWebSocket();
 
+/**
+ * Методы, которые сервер может вызвать у экрана (запрос {type: 'rpc', id, method, params}).
+ * Результат возвращается серверу как {type: 'rpc_result', id, result} или {..., error}.
+ */
+const rpcMethods = {
+    /**
+     * Сведения об экране для карты устройств поезда.
+     */
+    get_connected_devices: function (params) {
+        return {
+            page: window.location.pathname,
+            userAgent: navigator.userAgent,
+            screen: {width: window.screen.width, height: window.screen.height},
+            switchIp: params && params.switchIp,
+        };
+    },
+};
+
+/**
+ * Выполняет запрос сервера и отправляет ответ с тем же id.
+ * @param {Object} request - {id, method, params}
+ */
+function handleRpc(request) {
+    const method = rpcMethods[request.method];
+    const reply = {type: 'rpc_result', id: request.id};
+    if (!method) {
+        reply.error = `Неизвестный метод ${request.method}`;
+    } else {
+        try {
+            reply.result = method(request.params);
+        } catch (error) {
+            reply.error = String(error);
+        }
+    }
+    if (socket && socket.readyState === WebSocket.OPEN) {
+        socket.send(JSON.stringify(reply));
+    }
+}
+
 /**
  * Проверяет, изменился ли список остановок, сравнивая старый и новый массивы.
  * Возвращает true, если изменился (по длине или stationID), иначе false.
@@ -0,0 +1,135 @@
+/**
+ * Декодер msgpack для двоичных кадров WebSocket (подпротокол 'msgpack').
+ *
+ * Сервер кодирует кадры тем же содержимым, что и JSON, но изображения
+ * передаются сырыми байтами (bin) — они декодируются в Uint8Array.
+ * Поддерживаются все типы формата, кроме расширений (ext декодируется в null).
+ */
+
+const msgpackTextDecoder = new TextDecoder('utf-8');
+
+/**
+ * Декодирует двоичное сообщение msgpack.
+ * @param {ArrayBuffer} buffer - Данные сообщения (socket.binaryType = 'arraybuffer').
+ * @returns {*} Декодированное значение.
+ */
+function msgpackDecode(buffer) {
+    const bytes = new Uint8Array(buffer);
+    const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+    let offset = 0;
+
+    function str(length) {
+        const value = msgpackTextDecoder.decode(bytes.subarray(offset, offset + length));
+        offset += length;
+        return value;
+    }
+
+    function bin(length) {
+        const value = bytes.slice(offset, offset + length);
+        offset += length;
+        return value;
+    }
+
+    function array(length) {
+        const value = new Array(length);
+        for (let i = 0; i < length; i++) {
+            value[i] = read();
+        }
+        return value;
+    }
+
+    function map(length) {
+        const value = {};
+        for (let i = 0; i < length; i++) {
+            const key = read();
+            value[key] = read();
+        }
+        return value;
+    }
+
+    function ext(length) {
+        offset += 1 + length;
+        return null;
+    }
+
+    function read() {
+        const type = bytes[offset++];
+        let value;
+
+        if (type <= 0x7f) return type;                          // positive fixint
+        if (type >= 0xe0) return type - 0x100;                  // negative fixint
+        if (type >= 0xa0 && type <= 0xbf) return str(type & 0x1f);
+        if (type >= 0x90 && type <= 0x9f) return array(type & 0x0f);
+        if (type >= 0x80 && type <= 0x8f) return map(type & 0x0f);
+
+        switch (type) {
+            case 0xc0: return null;
+            case 0xc2: return false;
+            case 0xc3: return true;
+            case 0xc4: value = bytes[offset]; offset += 1; return bin(value);
+            case 0xc5: value = view.getUint16(offset); offset += 2; return bin(value);
+            case 0xc6: value = view.getUint32(offset); offset += 4; return bin(value);
+            case 0xc7: value = bytes[offset]; offset += 1; return ext(value);
+            case 0xc8: value = view.getUint16(offset); offset += 2; return ext(value);
+            case 0xc9: value = view.getUint32(offset); offset += 4; return ext(value);
+            case 0xca: value = view.getFloat32(offset); offset += 4; return value;
+            case 0xcb: value = view.getFloat64(offset); offset += 8; return value;
+            case 0xcc: value = bytes[offset]; offset += 1; return value;
+            case 0xcd: value = view.getUint16(offset); offset += 2; return value;
+            case 0xce: value = view.getUint32(offset); offset += 4; return value;
+            case 0xcf: value = Number(view.getBigUint64(offset)); offset += 8; return value;
+            case 0xd0: value = view.getInt8(offset); offset += 1; return value;
+            case 0xd1: value = view.getInt16(offset); offset += 2; return value;
+            case 0xd2: value = view.getInt32(offset); offset += 4; return value;
+            case 0xd3: value = Number(view.getBigInt64(offset)); offset += 8; return value;
+            case 0xd4: return ext(1);
+            case 0xd5: return ext(2);
+            case 0xd6: return ext(4);
+            case 0xd7: return ext(8);
+            case 0xd8: return ext(16);
+            case 0xd9: value = bytes[offset]; offset += 1; return str(value);
+            case 0xda: value = view.getUint16(offset); offset += 2; return str(value);
+            case 0xdb: value = view.getUint32(offset); offset += 4; return str(value);
+            case 0xdc: value = view.getUint16(offset); offset += 2; return array(value);
+            case 0xdd: value = view.getUint32(offset); offset += 4; return array(value);
+            case 0xde: value = view.getUint16(offset); offset += 2; return map(value);
+            case 0xdf: value = view.getUint32(offset); offset += 4; return map(value);
+        }
+        throw new Error(`msgpack: неизвестный тип 0x${type.toString(16)} в позиции ${offset - 1}`);
+    }
+
+    return read();
+}
+
+/**
+ * Разбирает сообщение WebSocket: текст — JSON, двоичное сообщение — msgpack.
+ * @param {MessageEvent} event
+ * @returns {*} Кадр сервера.
+ */
+function decodeFrame(event) {
+    if (typeof event.data === 'string') {
+        return JSON.parse(event.data);
+    }
+    return msgpackDecode(event.data);
+}
+
+/**
+ * URL изображения PNG из поля кадра: base64-строка (JSON) или байты (msgpack).
+ * URL для байтов создаётся через URL.createObjectURL; предыдущий URL того же
+ * слота освобождается, если передан.
+ * @param {string|Uint8Array} image
+ * @param {string} [previousUrl] - Ранее выданный URL, который больше не нужен.
+ * @returns {string|null}
+ */
+function imageUrl(image, previousUrl) {
+    if (previousUrl && previousUrl.startsWith('blob:')) {
+        URL.revokeObjectURL(previousUrl);
+    }
+    if (!image) {
+        return null;
+    }
+    if (typeof image === 'string') {
+        return `data:image/png;base64,${image}`;
+    }
+    return URL.createObjectURL(new Blob([image], {type: 'image/png'}));
+}
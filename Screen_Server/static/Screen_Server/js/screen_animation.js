@@ -12,17 +12,26 @@ document.addEventListener('DOMContentLoaded', () => {
     let isVisible = true;
 
 
-    const socket = new WebSocket('ws://127.0.0.1:8000/ws/bnt/');
+    // Двоичные кадры msgpack: изображения приходят байтами (декодер — msgpack.js)
+    const socket = new WebSocket('ws://127.0.0.1:8000/ws/bnt/', ['msgpack']);
+    socket.binaryType = 'arraybuffer';
 
     let wagons = null;
     let side = null;
     let stops = null
     let lineColor = null;
+    let schemaUrl = null;
 
     socket.onopen = function() {};
 
     socket.onmessage = function(event) {
-        const packege = JSON.parse(event.data);
+        const packege = decodeFrame(event);
+
+        // Проверка живости соединения сервером: ts возвращается без изменений
+        if (packege.type === 'ping') {
+            socket.send(JSON.stringify({type: 'pong', ts: packege.ts}));
+            return;
+        }
 
         if (packege.type === 'connection_data') {
             const data = packege.data;
@@ -491,7 +500,7 @@ document.addEventListener('DOMContentLoaded', () => {
        /**
          * Отрисовывает изображения вагонов в нижнем контейнере.
          * Если контейнер вагонов отсутствует — создаёт новый.
-         * @param {Array} wagons - Массив объектов вагонов с base64-строкой изображения.
+         * @param {Array} wagons - Массив объектов вагонов с изображением (base64-строка или байты).
          */
         let wagonsContainer = document.querySelector('.wagons-container');
 
@@ -517,7 +526,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
         wagons.forEach(wagon => {
             const wagonImg = document.createElement('img');
-            wagonImg.src = `data:image/png;base64,${wagon.encoded_string}`;
+            wagonImg.src = imageUrl(wagon.encoded_string);
             wagonImg.alt = wagon.name;
             wagonImg.style.maxWidth = '100%';
             wagonImg.style.maxHeight = '100%';
@@ -538,7 +547,7 @@ document.addEventListener('DOMContentLoaded', () => {
        /**
          * Отрисовывает PNG-схему текущей станции как фон в нижнем контейнере.
          * Если изображения нет — выводит предупреждение.
-         * @param {string} currentPng - Base64-код PNG-изображения.
+         * @param {string|Uint8Array} currentPng - PNG-изображение: base64-строка или байты.
          */
        if (!currentPng) {
            console.warn("No image data available for current station.");
@@ -552,10 +561,10 @@ document.addEventListener('DOMContentLoaded', () => {
            bottomContainer.appendChild(schemaContainer);
        }
 
-       // Преобразуем PNG в URL
-       const imageUrl = `data:image/png;base64,${currentPng}`;
+       // Преобразуем PNG в URL (URL предыдущей схемы освобождается)
+       schemaUrl = imageUrl(currentPng, schemaUrl);
        // Устанавливаем изображение как фон для schema-container
-       schemaContainer.style.backgroundImage = `url(${imageUrl})`;
+       schemaContainer.style.backgroundImage = `url(${schemaUrl})`;
        schemaContainer.style.backgroundSize = '100% 100%';    // Подгоняет изображение под размеры контейнера, сохраняя пропорции
        schemaContainer.style.backgroundPosition = 'center'; // Центрирует изображение
        schemaContainer.style.backgroundRepeat = 'no-repeat'; // Не повторяет изображение
@@ -0,0 +1,357 @@
+"""
+История телеметрии поездов в кольцевых буферах фиксированного размера.
+
+Пакеты OperationalData (скорость, координаты, расстояние до станции, двери)
+и AdditionalOperationalData (температура и число пассажиров по вагонам)
+раньше отбрасывались после рассылки. TelemetryHistory хранит их по потокам
+(IP отправителя) в кольцевых буферах по столбцам: каждый столбец — array.array
+фиксированного типа и длины, новая запись заменяет самую старую. Память не
+растёт со временем работы: CAPACITY строк телеметрии и WAGON_CAPACITY строк
+вагонов на поток, не больше MAX_STREAMS потоков (дольше всех молчащий
+вытесняется).
+
+Запросы к окну последних N секунд (поиск начала окна — двоичный по времени):
+- summary — минимум, максимум, среднее и последнее значение полей, доля
+  времени с открытыми дверями;
+- segments — участки пути между сменами следующей станции: длительность,
+  скорость, время с открытыми дверями;
+- wagons — температура и пассажиры по вагонам.
+
+Если установлен NumPy, агрегаты считаются векторно над теми же буферами
+(np.frombuffer без копирования), иначе — встроенными функциями Python.
+
+Запись идёт из цикла событий сервиса приёма (ingest.py), чтение — из
+HTTP-запроса (views.get_telemetry_history): буфер защищён блокировкой.
+При ingest WORKERS > 1 история хранится в процессах приёма и в этом
+процессе не видна.
+"""
+
+
+import logging
+import threading
+import time
+
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from django.conf import settings
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - NumPy необязателен
+    np = None
+
+
+DEFAULT_TELEMETRY = {
+    'CAPACITY': 36000,  # Строк OperationalData на поток (час при 10 пакетах в секунду)
+    'WAGON_CAPACITY': 72000,  # Строк вагонов на поток
+    'MAX_STREAMS': 8,  # Потоков (поездов) в истории
+}
+
+# Столбцы: имя → код типа array (соответствие полям пакета — в TelemetryHistory.record)
+OPERATIONAL_COLUMNS = (
+    ('ts', 'd'),
+    ('speed', 'H'),
+    ('latitude', 'f'),
+    ('longitude', 'f'),
+    ('next_station_distance', 'I'),
+    ('door_state', 'B'),
+    ('next_station_id', 'I'),
+    ('station', 'h'),  # nextStationIndex, -1 — станция не найдена
+)
+WAGON_COLUMNS = (
+    ('ts', 'd'),
+    ('device', 'H'),
+    ('train', 'H'),
+    ('temp', 'h'),
+    ('passengers', 'H'),
+    ('outside_temp', 'h'),
+)
+OPERATIONAL_FIELDS = ('speed', 'latitude', 'longitude', 'next_station_distance')
+WAGON_FIELDS = ('temp', 'passengers')
+
+
+def get_telemetry_config() -> Dict[str, Any]:
+    config = dict(DEFAULT_TELEMETRY)
+    config.update(getattr(settings, 'SCREEN_TELEMETRY', {}))
+    return config
+
+
+class ColumnRing:
+    """
+    Кольцевой буфер строк, хранимых по столбцам фиксированного типа.
+
+    Атрибуты:
+        capacity (int): Число строк.
+        size (int): Заполнено строк.
+        appended (int): Всего добавлено строк (включая вытесненные).
+    """
+    def __init__(self, capacity: int, columns: Sequence[Tuple[str, str]]):
+        self.capacity = capacity
+        self.names = tuple(name for name, _ in columns)
+        self.columns = {name: array(typecode, [0]) * capacity for name, typecode in columns}
+        self._ordered = tuple(self.columns[name] for name in self.names)
+        self._ts = self.columns['ts']
+        self.head = 0
+        self.size = 0
+        self.appended = 0
+        self.lock = threading.Lock()
+
+    def append(self, row: Sequence[Any]):
+        """
+        Добавляет строку (значения в порядке столбцов), вытесняя самую старую.
+        """
+        with self.lock:
+            head = self.head
+            for column, value in zip(self._ordered, row):
+                column[head] = value
+            self.head = (head + 1) % self.capacity
+            if self.size < self.capacity:
+                self.size += 1
+            self.appended += 1
+
+    def __getitem__(self, index: int) -> float:
+        # Время строки по логическому номеру (0 — самая старая); для bisect
+        return self._ts[(self.head - self.size + index) % self.capacity]
+
+    def __len__(self):
+        return self.size
+
+    def since(self, started: float) -> Dict[str, array]:
+        """
+        Копии столбцов для строк не старше started в порядке записи.
+        """
+        with self.lock:
+            low = bisect_left(self, started, 0, self.size)
+            count = self.size - low
+            first = (self.head - self.size + low) % self.capacity
+            tail = min(count, self.capacity - first)
+            return {
+                name: column[first:first + tail] + column[:count - tail]
+                for name, column in self.columns.items()
+            }
+
+    def nbytes(self) -> int:
+        return sum(column.itemsize * len(column) for column in self._ordered)
+
+
+# Агрегаты (NumPy, если доступен)
+
+def _numbers(column: array):
+    return np.frombuffer(column, dtype=column.typecode) if np is not None else column
+
+
+def _stats(column: array) -> Optional[Dict[str, float]]:
+    if not len(column):
+        return None
+    values = _numbers(column)
+    if np is not None:
+        return {'min': values.min().item(), 'max': values.max().item(),
+                'mean': round(float(values.mean()), 3), 'last': values[-1].item()}
+    return {'min': min(values), 'max': max(values), 'mean': round(sum(values) / len(values), 3), 'last': values[-1]}
+
+
+def _open_seconds(ts: array, door_state: array) -> List[float]:
+    """
+    Время с открытыми дверями после каждой строки (до следующей строки).
+    """
+    if np is not None:
+        times = _numbers(ts)
+        gaps = np.diff(times, append=times[-1]) if len(times) else times
+        return (gaps * (_numbers(door_state) != 0)).tolist()
+    gaps = [later - earlier for earlier, later in zip(ts, ts[1:])] + [0.0]
+    return [gap if door else 0.0 for gap, door in zip(gaps, door_state)]
+
+
+def _runs(column: array) -> List[Tuple[int, int]]:
+    """
+    Границы участков с одинаковым значением: [(начало, конец), ...].
+    """
+    if not len(column):
+        return []
+    if np is not None:
+        starts = (np.flatnonzero(np.diff(_numbers(column))) + 1).tolist()
+    else:
+        starts = [i for i in range(1, len(column)) if column[i] != column[i - 1]]
+    bounds = [0] + starts + [len(column)]
+    return list(zip(bounds, bounds[1:]))
+
+
+def _groups(column: array) -> Dict[int, Any]:
+    """
+    Номера строк по значению столбца.
+    """
+    if np is not None:
+        values = _numbers(column)
+        return {key.item(): np.flatnonzero(values == key) for key in np.unique(values)}
+    groups: Dict[int, List[int]] = {}
+    for i, value in enumerate(column):
+        groups.setdefault(value, []).append(i)
+    return groups
+
+
+def _take(column: array, rows) -> array:
+    if np is not None:
+        return array(column.typecode, _numbers(column)[rows].tobytes())
+    return array(column.typecode, (column[i] for i in rows))
+
+
+class TelemetryHistory:
+    """
+    История телеметрии по потокам (IP отправителя).
+
+    Атрибуты:
+        recorded (int): Записано пакетов.
+        evicted_streams (int): Потоков вытеснено из-за MAX_STREAMS.
+    """
+    RECORDED_TYPES = ('OperationalData', 'AdditionalOperationalData')
+
+    def __init__(self, capacity: int, wagon_capacity: int, max_streams: int):
+        self.capacity = capacity
+        self.wagon_capacity = wagon_capacity
+        self.max_streams = max_streams
+        self.recorded = 0
+        self.evicted_streams = 0
+        self._streams: 'OrderedDict[str, Tuple[ColumnRing, ColumnRing]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _rings(self, stream: str) -> Tuple[ColumnRing, ColumnRing]:
+        with self._lock:
+            rings = self._streams.get(stream)
+            if rings is None:
+                if len(self._streams) >= self.max_streams:
+                    evicted, _ = self._streams.popitem(last=False)
+                    self.evicted_streams += 1
+                    logging.warning(f"История телеметрии: поток {evicted} вытеснен потоком {stream}")
+                rings = self._streams[stream] = (
+                    ColumnRing(self.capacity, OPERATIONAL_COLUMNS),
+                    ColumnRing(self.wagon_capacity, WAGON_COLUMNS),
+                )
+            else:
+                self._streams.move_to_end(stream)
+            return rings
+
+    def record(self, stream: str, data_type: str, payload: Dict[str, Any], at: float = None):
+        """
+        Сохраняет разобранный пакет телеметрии (остальные типы пропускаются).
+        """
+        if data_type not in self.RECORDED_TYPES:
+            return
+        at = time.time() if at is None else at
+        try:
+            # Строки собираются до выделения буферов: пакет без нужных полей не заводит поток
+            if data_type == 'OperationalData':
+                station = payload.get('nextStationIndex')
+                ring, rows = 0, [(
+                    at,
+                    payload['speed'],
+                    payload['latitude'],
+                    payload['longitude'],
+                    payload['nextStationDistance'],
+                    payload['doorState'],
+                    payload['nextStationID'],
+                    -1 if station is None else station,
+                )]
+            else:
+                outside = payload['outsideTemp']
+                ring, rows = 1, [
+                    (at, payload[f'id{i}'], payload[f'train{i}'], payload[f'temp{i}'], payload[f'passengers{i}'], outside)
+                    for i in range(1, payload['count'] + 1)
+                ]
+            target = self._rings(stream)[ring]
+            for row in rows:
+                target.append(row)
+            self.recorded += 1
+        except (KeyError, OverflowError, TypeError) as e:
+            logging.warning(f"История телеметрии: пакет {data_type} от {stream} не записан: {e}")
+
+    def streams(self) -> List[str]:
+        return list(self._streams)
+
+    # Запросы
+
+    def summary(self, stream: str, window: float) -> Optional[Dict[str, Any]]:
+        """
+        Сводка телеметрии потока за последние window секунд.
+        """
+        rows = self._window(stream, 0, window)
+        if rows is None:
+            return None
+        result = {'samples': len(rows['ts'])}
+        if not result['samples']:
+            return result
+        result['from'], result['to'] = rows['ts'][0], rows['ts'][-1]
+        for name in OPERATIONAL_FIELDS:
+            result[name] = _stats(rows[name])
+        duration = rows['ts'][-1] - rows['ts'][0]
+        open_seconds = sum(_open_seconds(rows['ts'], rows['door_state']))
+        result['doors_open_share'] = round(open_seconds / duration, 3) if duration > 0 else None
+        return result
+
+    def segments(self, stream: str, window: float) -> Optional[List[Dict[str, Any]]]:
+        """
+        Участки пути за последние window секунд: смена следующей станции начинает новый участок.
+        """
+        rows = self._window(stream, 0, window)
+        if rows is None:
+            return None
+        ts, station, speed = rows['ts'], rows['station'], rows['speed']
+        open_seconds = _open_seconds(ts, rows['door_state'])
+        result = []
+        for start, end in _runs(station):
+            segment_speed = _stats(speed[start:end])
+            result.append({
+                'station': station[start] if station[start] >= 0 else None,
+                'next_station_id': rows['next_station_id'][start],
+                'from': ts[start],
+                'to': ts[end - 1],
+                'duration': round(ts[end - 1] - ts[start], 3),
+                'samples': end - start,
+                'speed_max': segment_speed['max'],
+                'speed_mean': segment_speed['mean'],
+                'doors_open_seconds': round(sum(open_seconds[start:end]), 3),
+            })
+        return result
+
+    def wagons(self, stream: str, window: float) -> Optional[Dict[str, Any]]:
+        """
+        Температура и число пассажиров по вагонам (устройствам) за последние window секунд.
+        """
+        rows = self._window(stream, 1, window)
+        if rows is None:
+            return None
+        result = {}
+        for device, indices in sorted(_groups(rows['device']).items()):
+            result[device] = {
+                'train': rows['train'][indices[-1]],
+                'samples': len(indices),
+                **{name: _stats(_take(rows[name], indices)) for name in WAGON_FIELDS},
+            }
+        return {'outside_temp': _stats(rows['outside_temp']), 'wagons': result}
+
+    def _window(self, stream: str, ring: int, window: float) -> Optional[Dict[str, array]]:
+        rings = self._streams.get(stream)
+        if rings is None:
+            return None
+        return rings[ring].since(time.time() - window)
+
+    def stats(self) -> Dict[str, Any]:
+        streams = {}
+        for stream, (operational, wagons) in list(self._streams.items()):
+            streams[stream] = {
+                'operational': {'rows': operational.size, 'capacity': operational.capacity},
+                'wagons': {'rows': wagons.size, 'capacity': wagons.capacity},
+                'bytes': operational.nbytes() + wagons.nbytes(),
+            }
+        return {
+            'recorded': self.recorded,
+            'evicted_streams': self.evicted_streams,
+            'vectorized': np is not None,
+            'streams': streams,
+        }
+
+
+_config = get_telemetry_config()
+telemetry_history = TelemetryHistory(_config['CAPACITY'], _config['WAGON_CAPACITY'], _config['MAX_STREAMS'])
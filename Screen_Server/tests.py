@@ -1,3 +1,1389 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import queue
+import socket
+import tempfile
+import threading
+import time
 
-# Create your tests here.
+from unittest import mock, skipIf
+
+from django.test import SimpleTestCase, override_settings
+
+from .autodetect import ModuleDetector
+from .bootstrap import AdmissionGate, BootstrapCache
+from .broadcast import msgpack
+from .cache_backend import LocalTier, TwoTierCache, add_invalidation_listener
+from .channel_layer import HybridChannelLayer
+from .client_registry import ClientRegistry
+from .crc import CRC_INIT, packet_crc, verify_packet
+from .dedup import DUPLICATE, RETRANSMISSION, DuplicateFilter
+from .delta import DeltaEncoder
+from .heartbeat import HEARTBEAT_CLOSE_CODE, HeartbeatMixin, heartbeat_stats
+from .metrics import BUCKET_BOUNDS, Histogram, Metrics, describe, merge_snapshots, render
+from .moscow import ByteParserBase, PacketFactory, SessionProtocolParser
+from .outbound import CONNECTIONS, SLOW_CLIENT_CLOSE_CODE, BufferedSendMixin
+from .queues import DROP_OLDEST, KEEP, LATEST, OverflowQueue
+from .replay import build_datagram, build_payload, synthetic_capture
+from .rpc import DISCONNECTED, TIMEOUT, RpcClient, RpcError, RpcServerMixin
+from .snapshot import decode_snapshot, encode_snapshot, read_snapshot, restore_snapshot, write_snapshot
+from .state import STATE_VERSION_KEY, StateStore
+from .telemetry import ColumnRing
+
+
+def bitwise_crc(data: bytes) -> int:
+    """
+    Побитовый расчёт CRC-16/CCITT, как в исходной версии SessionProtocolParser.
+    """
+    crc = CRC_INIT
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = (crc << 1) ^ 0x1021
+            else:
+                crc <<= 1
+        crc &= 0xFFFF
+    return crc
+
+
+class CrcTests(SimpleTestCase):
+    def test_packet_crc_matches_bitwise(self):
+        offset = SessionProtocolParser.CS_OFFSET
+        for _, data, _ in synthetic_capture(120, trains=2):
+            zeroed = data[:offset] + b"\x00\x00" + data[offset + 2:]
+            self.assertEqual(packet_crc(data, offset), bitwise_crc(zeroed))
+            self.assertEqual(packet_crc(memoryview(data), offset), bitwise_crc(zeroed))
+
+    def test_verify_packet(self):
+        offset = SessionProtocolParser.CS_OFFSET
+        _, data, _ = synthetic_capture(1)[0]
+        self.assertTrue(verify_packet(data, offset))
+        corrupted = bytearray(data)
+        corrupted[-1] ^= 0x01
+        self.assertFalse(verify_packet(bytes(corrupted), offset))
+        self.assertFalse(verify_packet(data[:offset + 1], offset))
+
+
+class CompiledDecoderTests(SimpleTestCase):
+    """
+    Скомпилированные структуры пакетов на синтетическом трафике replay.py.
+    """
+    def decode_payload(self, payload):
+        parser = PacketFactory.create_packet(memoryview(payload), '10.0.1.1')
+        head, offset = parser.compiled_structure.decode(parser.data, 0)
+        items = []
+        if parser.compiled_item_structure.fields:
+            while offset < len(parser.data):
+                item, offset = parser.compiled_item_structure.decode(parser.data, offset)
+                items.append(item)
+        self.assertEqual(offset, len(parser.data))
+        return parser, head, items
+
+    def test_round_trip(self):
+        header_size = SessionProtocolParser.HEADER_SIZE
+        for _, data, _ in synthetic_capture(600, trains=2):
+            self.assertTrue(SessionProtocolParser.is_valid_datagram(data))
+            payload = data[header_size + 1:]
+            parser, head, items = self.decode_payload(data[header_size:])
+            encoded = parser.compiled_structure.encode(head) + b"".join(
+                parser.compiled_item_structure.encode(item) for item in items)
+            self.assertEqual(encoded, payload)
+
+    def test_matches_field_by_field_read(self):
+        header_size = SessionProtocolParser.HEADER_SIZE
+        seen = set()
+        for _, data, _ in synthetic_capture(600):
+            parser, head, _ = self.decode_payload(data[header_size:])
+            if type(parser) in seen:
+                continue
+            seen.add(type(parser))
+            reader = ByteParserBase(data[header_size + 1:])
+            expected = [reader.read(field_type) for _, field_type in parser.structure]
+            self.assertEqual(head, expected)
+        self.assertEqual(len(seen), len(PacketFactory.PACKET_MAP))
+
+    def test_truncated_payload(self):
+        from .moscow import RouteData
+        payload = memoryview(build_payload(RouteData, 1))
+        head, offset = RouteData.compiled_structure.decode(payload, 0)
+        with self.assertRaises(ValueError):
+            RouteData.compiled_structure.decode(payload[:offset - 1], 0)
+        with self.assertRaises(ValueError):
+            RouteData.compiled_item_structure.decode(payload[:-1], offset)
+
+    def test_parse_packet_rejects_bad_crc(self):
+        _, data, _ = synthetic_capture(1)[0]
+        corrupted = bytearray(data)
+        corrupted[-1] ^= 0x01
+        result = SessionProtocolParser(bytes(corrupted)).parse_packet()
+        self.assertEqual(result['status'], 'error')
+        self.assertEqual(result['error_message'], SessionProtocolParser.CRC_ERROR)
+
+
+class OverflowQueueTests(SimpleTestCase):
+    def drain(self, queue):
+        async def get_all():
+            return [await queue.get() for _ in range(queue.qsize())]
+        return asyncio.run(get_all())
+
+    def test_drop_oldest(self):
+        queue = OverflowQueue(3)
+        for i in range(5):
+            queue.put_nowait(i, kind='telemetry')
+        self.assertEqual(self.drain(queue), [2, 3, 4])
+        self.assertEqual(queue.dropped, 2)
+        self.assertEqual(queue.high_watermark, 3)
+
+    def test_latest_replaces_pending_value(self):
+        queue = OverflowQueue(10, {'telemetry': LATEST}, DROP_OLDEST)
+        queue.put_nowait('a1', kind='telemetry', key='a')
+        queue.put_nowait('b1', kind='telemetry', key='b')
+        queue.put_nowait('a2', kind='telemetry', key='a')
+        self.assertTrue(queue.pending('a'))
+        self.assertEqual((queue.replaced, queue.qsize()), (1, 2))
+        self.assertEqual(self.drain(queue), ['b1', 'a2'])
+        self.assertFalse(queue.pending('a'))
+        # После выдачи ключ снова ставится в очередь
+        queue.put_nowait('a3', kind='telemetry', key='a')
+        self.assertEqual(self.drain(queue), ['a3'])
+
+    def test_latest_does_not_overtake_route(self):
+        queue = OverflowQueue(10, {'OperationalData': LATEST}, DROP_OLDEST)
+        key = ('10.0.1.1', 'OperationalData')
+        queue.put_nowait('T1', kind='OperationalData', key=key)
+        queue.put_nowait('R', kind='RouteData', key=('10.0.1.1', 'RouteData'))
+        queue.put_nowait('T2', kind='OperationalData', key=key)
+        self.assertEqual(self.drain(queue), ['R', 'T2'])
+
+    def test_replaced_entries_are_bounded(self):
+        queue = OverflowQueue(4, {'telemetry': LATEST}, DROP_OLDEST)
+        for i in range(100):
+            queue.put_nowait(i, kind='telemetry', key='a')
+        self.assertLessEqual(len(queue._items), queue.maxsize + 1)
+        self.assertEqual((queue.qsize(), queue.dropped), (1, 0))
+        self.assertEqual(self.drain(queue), [99])
+
+    def test_replaced_entries_do_not_count_towards_maxsize(self):
+        queue = OverflowQueue(2, {'telemetry': LATEST}, DROP_OLDEST)
+        queue.put_nowait('a1', kind='telemetry', key='a')
+        queue.put_nowait('a2', kind='telemetry', key='a')
+        queue.put_nowait('r1', kind='route')
+        self.assertEqual(queue.dropped, 0)
+        queue.put_nowait('r2', kind='route')
+        self.assertEqual(queue.dropped, 1)
+        self.assertEqual(self.drain(queue), ['r1', 'r2'])
+
+    def test_keep_is_never_evicted(self):
+        queue = OverflowQueue(2, {'route': KEEP}, DROP_OLDEST)
+        queue.put_nowait('route1', kind='route')
+        queue.put_nowait('t1', kind='telemetry')
+        queue.put_nowait('t2', kind='telemetry')
+        self.assertEqual(queue.dropped, 1)
+        queue.put_nowait('route2', kind='route')
+        queue.put_nowait('route3', kind='route')
+        self.assertEqual(queue.overflow, 1)
+        self.assertEqual(self.drain(queue), ['route1', 'route2', 'route3'])
+
+
+class DuplicateFilterTests(SimpleTestCase):
+    def datagram(self, speed, packet_id=0, sender='10.0.1.1'):
+        from .moscow import OperationalData
+        from .replay import sample_values
+        head, _ = sample_values(OperationalData, 0)
+        head = list(head)
+        head[3] = speed
+        return build_datagram(OperationalData, build_payload(OperationalData, 0, head), sender, packet_id)
+
+    def test_duplicate_payload(self):
+        dedup = DuplicateFilter()
+        first = self.datagram(60)
+        self.assertIsNone(dedup.check(first, 'OperationalData'))
+        # Пока пакет не разобран, его копия повтором не считается
+        self.assertIsNone(dedup.check(first, 'OperationalData'))
+        dedup.remember(first)
+        self.assertEqual(dedup.check(first, 'OperationalData'), DUPLICATE)
+        self.assertIsNone(dedup.check(self.datagram(61), 'OperationalData'))
+        self.assertIsNone(dedup.check(self.datagram(60, sender='10.0.2.1'), 'OperationalData'))
+        self.assertEqual(dedup.stats()[DUPLICATE], {'OperationalData': 1})
+
+    def test_retransmission_window(self):
+        dedup = DuplicateFilter(window=2)
+        packets = [self.datagram(speed, packet_id=speed) for speed in (1, 2, 3)]
+        for packet in packets:
+            dedup.remember(packet)
+        # Пакет 1 вытеснен из окна, но совпадает с последней нагрузкой только пакет 3
+        self.assertIsNone(dedup.check(packets[0], 'OperationalData'))
+        self.assertEqual(dedup.check(packets[1], 'OperationalData'), RETRANSMISSION)
+        self.assertEqual(dedup.check(packets[2], 'OperationalData'), RETRANSMISSION)
+
+
+@mock.patch('Screen_Server.delta.register_stream')
+class DeltaEncoderTests(SimpleTestCase):
+    def test_sequence_per_type(self, register_stream):
+        encoder = DeltaEncoder(['OperationalData'])
+        full, delta, _ = encoder.encode('10.0.1.1', 'OperationalData', {'speed': 1})
+        self.assertEqual((full['seq'], delta), (1, None))
+        full, _, _ = encoder.encode('10.0.1.1', 'RouteData', {'stops': []})
+        self.assertEqual(full['seq'], 1)
+        full, delta, _ = encoder.encode('10.0.1.1', 'OperationalData', {'speed': 1})
+        self.assertEqual((full['seq'], delta['seq']), (2, 2))
+        register_stream.assert_called_once_with('10.0.1.1')
+
+    def test_delta_changes(self, register_stream):
+        encoder = DeltaEncoder(['OperationalData'])
+        encoder.encode('10.0.1.1', 'OperationalData', {'speed': 1, 'time': 't1', 'doors': 0})
+        _, delta, _ = encoder.encode('10.0.1.1', 'OperationalData', {'speed': 2, 'time': 't1'})
+        self.assertEqual(delta['changed'], {'speed': 2})
+        self.assertEqual(delta['removed'], ['doors'])
+        self.assertEqual(delta['dataType'], 'OperationalData')
+        # Типы не из DELTA_TYPES передаются только полными кадрами
+        _, delta, _ = encoder.encode('10.0.1.1', 'RouteData', {'stops': []})
+        self.assertIsNone(delta)
+
+    def test_keyframe_is_a_copy(self, register_stream):
+        encoder = DeltaEncoder(['OperationalData'])
+        _, _, stream = encoder.encode('10.0.1.1', 'OperationalData', {'speed': 1})
+        keyframe = stream.keyframe()
+        encoder.encode('10.0.1.1', 'OperationalData', {'speed': 2})
+        self.assertEqual(keyframe['seq'], {'OperationalData': 1})
+        self.assertEqual(keyframe['state']['OperationalData'], {'speed': 1})
+        self.assertEqual(stream.keyframe()['seq'], {'OperationalData': 2})
+        self.assertEqual(keyframe['epoch'], encoder.epoch)
+
+    def test_streams_are_independent(self, register_stream):
+        encoder = DeltaEncoder(['OperationalData'])
+        encoder.encode('10.0.1.1', 'OperationalData', {'speed': 1})
+        full, delta, _ = encoder.encode('10.0.2.1', 'OperationalData', {'speed': 1})
+        self.assertEqual((full['seq'], delta), (1, None))
+
+
+class StateStoreTests(SimpleTestCase):
+    def setUp(self):
+        # Поток отложенной записи не успевает проснуться: запись вызывается явно
+        self.store = StateStore(flush_interval=3600)
+        patcher = mock.patch('Screen_Server.state.cache')
+        self.cache = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_set_reports_changes(self):
+        self.assertTrue(self.store.set('cached_STOPS', [1, 2]))
+        self.assertFalse(self.store.set('cached_STOPS', [1, 2]))
+        self.assertTrue(self.store.set('cached_STOPS', [1, 2, 3]))
+        self.assertEqual(self.store.version, 2)
+        self.assertTrue(self.store.is_local())
+
+    def test_flush_batches_by_timeout(self):
+        self.store.set('a', 1)
+        self.store.set('a', 2)
+        self.store.set('b', 3, timeout=60)
+        self.assertEqual(self.store.flush(), 2)
+        self.cache.set_many.assert_any_call({'a': 2, STATE_VERSION_KEY: 3}, 86400)
+        self.cache.set_many.assert_any_call({'b': 3}, 60)
+        self.assertEqual(self.store.flush(), 0)
+        self.assertEqual(self.store.stats()['pending'], 0)
+
+    def test_failed_flush_is_requeued(self):
+        self.store.set('a', 1)
+        self.cache.set_many.side_effect = ConnectionError('redis down')
+        self.assertEqual(self.store.flush(), 0)
+        self.assertEqual(self.store.write_errors, 1)
+        self.assertEqual(self.store.stats()['pending'], 1)
+        self.cache.set_many.side_effect = None
+        self.assertEqual(self.store.flush(), 1)
+        self.cache.set_many.assert_called_with({'a': 1, STATE_VERSION_KEY: 1}, 86400)
+
+    def test_restored_state_does_not_make_store_local(self):
+        self.store.restore({'cached_STOPS': [1]}, version=7)
+        self.assertFalse(self.store.is_local())
+        self.assertEqual(self.store.get('cached_STOPS'), [1])
+        self.assertEqual(self.store.flush(), 0)
+        # Значение из снимка не подтверждено: равное ему пишется в Redis
+        self.assertTrue(self.store.set('cached_STOPS', [1]))
+        self.assertEqual(self.store.version, 8)
+
+    def test_reader_uses_cache(self):
+        self.cache.get.return_value = [4]
+        self.assertEqual(self.store.read('cached_STOPS'), [4])
+        self.store.set('cached_STOPS', [5])
+        self.assertEqual(self.store.read('cached_STOPS'), [5])
+
+
+class SnapshotTests(SimpleTestCase):
+    values = {'cached_STOPS': [{'id': 1000, 'name': 'Станция 0'}], 'cached_CURRENT_NEXT_INDEX': {'current': 0, 'next': 1}}
+
+    def test_round_trip(self):
+        data = encode_snapshot(self.values, 12, created=1000.0)
+        version, created, values = decode_snapshot(data)
+        self.assertEqual((version, created, values), (12, 1000.0, self.values))
+
+    def test_corruption_rejected(self):
+        data = encode_snapshot(self.values, 1)
+        corrupted = bytearray(data)
+        corrupted[len(data) // 2] ^= 0x01
+        for broken in (bytes(corrupted), data[:-1], data[:10], b'XXXX' + data[4:], b''):
+            with self.assertRaises(ValueError):
+                decode_snapshot(broken)
+
+    def test_schema_and_age_rejected(self):
+        data = encode_snapshot(self.values, 1)
+        with mock.patch('Screen_Server.snapshot.SNAPSHOT_SCHEMA', 2):
+            with self.assertRaises(ValueError):
+                decode_snapshot(data)
+        with self.assertRaises(ValueError):
+            decode_snapshot(encode_snapshot(self.values, 1, created=0.0), max_age=60)
+
+    def test_file_round_trip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'state.snapshot')
+            self.assertIsNone(read_snapshot(path))
+            size = write_snapshot(path, self.values, 5)
+            self.assertEqual(os.path.getsize(path), size)
+            self.assertEqual(read_snapshot(path)[2], self.values)
+            self.assertEqual(os.listdir(directory), ['state.snapshot'])
+            with open(path, 'r+b') as file:
+                file.seek(size - 1)
+                file.write(b'\x00' if file.read(1) != b'\x00' else b'\x01')
+            self.assertIsNone(read_snapshot(path))
+
+    def test_missing_directory_is_created(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'var', 'state.snapshot')
+            write_snapshot(path, self.values, 5)
+            self.assertEqual(read_snapshot(path)[:1], (5,))
+
+    def restore(self, remote_version, remote_stops, snapshot_version):
+        from django.core.cache import cache
+        locmem = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'snapshot'}}
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'state.snapshot')
+            write_snapshot(path, self.values, snapshot_version)
+            with self.settings(CACHES=locmem, SCREEN_SNAPSHOT={'PATH': path}):
+                cache.clear()
+                cache.set_many({STATE_VERSION_KEY: remote_version, 'cached_STOPS': remote_stops})
+                restored = restore_snapshot(owner=False)
+                return restored, cache.get_many([STATE_VERSION_KEY, *self.values])
+
+    def test_newer_snapshot_overwrites_stale_cache(self):
+        restored, cached = self.restore(3, [{'id': 7, 'name': 'Старый маршрут'}], 5)
+        self.assertTrue(restored)
+        self.assertEqual(cached, dict(self.values, **{STATE_VERSION_KEY: 5}))
+
+    def test_same_version_fills_only_missing_keys(self):
+        stops = [{'id': 7, 'name': 'Тот же маршрут'}]
+        restored, cached = self.restore(5, stops, 5)
+        self.assertTrue(restored)
+        self.assertEqual(cached['cached_STOPS'], stops)
+        self.assertEqual(cached['cached_CURRENT_NEXT_INDEX'], self.values['cached_CURRENT_NEXT_INDEX'])
+
+    def test_older_snapshot_is_discarded(self):
+        stops = [{'id': 7, 'name': 'Новый маршрут'}]
+        restored, cached = self.restore(9, stops, 5)
+        self.assertFalse(restored)
+        self.assertEqual(cached, {STATE_VERSION_KEY: 9, 'cached_STOPS': stops})
+
+
+class ColumnRingTests(SimpleTestCase):
+    columns = (('ts', 'd'), ('speed', 'H'))
+
+    def fill(self, capacity, count):
+        ring = ColumnRing(capacity, self.columns)
+        for i in range(count):
+            ring.append((float(i), i % 65536))
+        return ring
+
+    def test_since_before_wraparound(self):
+        ring = self.fill(8, 5)
+        self.assertEqual(list(ring.since(2.0)['speed']), [2, 3, 4])
+        self.assertEqual(list(ring.since(-1.0)['ts']), [0.0, 1.0, 2.0, 3.0, 4.0])
+
+    def test_since_after_wraparound(self):
+        ring = self.fill(8, 13)
+        self.assertEqual((len(ring), ring.appended), (8, 13))
+        self.assertEqual(list(ring.since(0.0)['ts']), [float(i) for i in range(5, 13)])
+        # Окно, начинающееся до и после точки перехода через конец массива
+        self.assertEqual(list(ring.since(6.5)['speed']), [7, 8, 9, 10, 11, 12])
+        self.assertEqual(list(ring.since(10.0)['speed']), [10, 11, 12])
+        self.assertEqual(list(ring.since(12.5)['speed']), [])
+
+    def test_since_full_ring_exact_boundary(self):
+        ring = self.fill(4, 8)
+        self.assertEqual(list(ring.since(4.0)['ts']), [4.0, 5.0, 6.0, 7.0])
+        self.assertEqual(ring.nbytes(), 4 * (8 + 2))
+
+    def test_since_returns_copies(self):
+        ring = self.fill(4, 6)
+        window = ring.since(0.0)
+        ring.append((6.0, 6))
+        self.assertEqual(list(window['speed']), [2, 3, 4, 5])
+
+
+class CoalescingOrderTests(SimpleTestCase):
+    """
+    Объединённая телеметрия не обгоняет маршрут того же поезда в broadcast_queue.
+    """
+    def setUp(self):
+        from .ingest import DEFAULT_CONFIG, IngestService
+        self.service = IngestService(config=dict(DEFAULT_CONFIG, DEDUP=False), listen=False)
+        config = self.service.config
+        self.service.broadcast_queue = OverflowQueue(
+            config['BROADCAST_QUEUE_SIZE'], config['OVERFLOW_POLICY'], config['DEFAULT_OVERFLOW_POLICY'])
+
+    def tick(self):
+        # Один такт _coalesce_worker
+        for key, payload in self.service.coalescer.take():
+            self.service._enqueue_broadcast(key, payload)
+
+    def drain(self):
+        queue = self.service.broadcast_queue
+
+        async def get_all():
+            return [(await queue.get())[0]['name'] for _ in range(queue.qsize())]
+        return asyncio.run(get_all())
+
+    def test_pending_telemetry_goes_before_route(self):
+        self.service._route('10.0.1.1', 'OperationalData', {'name': 'T1'})
+        self.service._route('10.0.1.1', 'RouteData', {'name': 'R'})
+        self.assertEqual(self.drain(), ['T1', 'R'])
+
+    def test_telemetry_after_route_stays_after_it(self):
+        self.service._route('10.0.1.1', 'OperationalData', {'name': 'T1'})
+        self.tick()
+        self.service._route('10.0.1.1', 'RouteData', {'name': 'R'})
+        self.service._route('10.0.1.1', 'OperationalData', {'name': 'T2'})
+        self.service._route('10.0.2.1', 'OperationalData', {'name': 'U1'})
+        self.tick()
+        self.assertEqual(self.drain(), ['R', 'T2', 'U1'])
+        self.assertEqual(self.service.broadcast_queue.replaced, 1)
+
+
+class ScreenAddressTests(SimpleTestCase):
+    def test_from_switch(self):
+        from .groups import MOSCOW_GROUP, ScreenAddress
+        left = ScreenAddress.from_switch(MOSCOW_GROUP, '10.0.5.3', 3)
+        self.assertEqual(left.as_dict(), {'train': 5, 'wagon': 3, 'side': 'Left', 'device': 'bmvt'})
+        right = ScreenAddress.from_switch(MOSCOW_GROUP, '10.0.5.23', 1)
+        self.assertEqual(right.as_dict(), {'train': 5, 'wagon': 3, 'side': 'Right', 'device': 'bnt'})
+        # Развёрнутый вагон: сторону задаёт карта коммутаторов ConfigureData
+        turned = ScreenAddress.from_switch(MOSCOW_GROUP, '10.0.5.3', 1, {'10.0.5.3': 'Right'})
+        self.assertEqual(turned.side, 'Right')
+        self.assertEqual(ScreenAddress.from_switch(MOSCOW_GROUP, '192.168.1.10', 1).as_dict(),
+                         {'train': None, 'wagon': None, 'side': None, 'device': None})
+
+    @mock.patch('Screen_Server.metro.get_channel_layer')
+    @mock.patch('Screen_Server.metro.update_route')
+    def test_station_update_is_sent_once(self, update_route, get_channel_layer):
+        from .groups import BNT_GROUP
+        from .metro import send_current_route_data
+        update_route.return_value = {'current_station': {'name': 'A'}, 'next_station': {'name': 'B'}}
+        layer = get_channel_layer.return_value = mock.Mock(group_send=mock.AsyncMock())
+        send_current_route_data()
+        layer.group_send.assert_awaited_once()
+        group, event = layer.group_send.await_args.args
+        self.assertEqual((group, event['type']), (BNT_GROUP, 'update_station'))
+        self.assertIn('"current_station"', event['text'])
+
+
+class ShardingTests(SimpleTestCase):
+    def test_sender_maps_to_one_worker(self):
+        from .ingest_workers import shard_for
+        shards = {}
+        for _, data, (sender, _) in synthetic_capture(200, trains=4):
+            shards.setdefault(sender, set()).add(shard_for(data, 3))
+        self.assertTrue(all(len(workers) == 1 for workers in shards.values()))
+        self.assertEqual({shard for workers in shards.values() for shard in workers}, {0, 1, 2})
+
+    def test_worker_index(self):
+        from .ingest_workers import INGEST_WORKER_ENV, ingest_worker_index
+        with mock.patch.dict(os.environ, {INGEST_WORKER_ENV: '2'}):
+            self.assertEqual(ingest_worker_index(), 2)
+        with mock.patch.dict(os.environ):
+            os.environ.pop(INGEST_WORKER_ENV, None)
+            self.assertIsNone(ingest_worker_index())
+
+    def test_stats_before_start(self):
+        from .ingest_workers import ShardedIngest
+        stats = ShardedIngest(2, config={'PORT': 29789, 'WORKER_QUEUE_SIZE': 16}).stats()
+        self.assertEqual((stats['running'], stats['workers'], stats['received']), (False, [], 0))
+
+
+@mock.patch('Screen_Server.moscow.state_store')
+@mock.patch('Screen_Server.moscow.cache')
+class RouteSenderTests(SimpleTestCase):
+    def test_first_and_same_sender(self, cache, state_store):
+        from .moscow import ROUTE_SENDER_KEY, check_route_sender
+        cache.get.return_value = None
+        self.assertTrue(check_route_sender('10.0.1.1'))
+        state_store.set.assert_called_once_with(ROUTE_SENDER_KEY, '10.0.1.1')
+        cache.get.return_value = '10.0.1.1'
+        self.assertTrue(check_route_sender('10.0.1.1'))
+
+    def test_second_train_is_reported(self, cache, state_store):
+        from .moscow import check_route_sender
+        cache.get.return_value = '10.0.1.1'
+        with self.assertLogs(level='WARNING') as logs:
+            self.assertFalse(check_route_sender('10.0.2.1'))
+        self.assertIn('10.0.2.1', logs.output[0])
+
+    def test_unavailable_cache(self, cache, state_store):
+        from .moscow import check_route_sender
+        cache.get.side_effect = ConnectionError('redis down')
+        with self.assertLogs(level='WARNING'):
+            self.assertTrue(check_route_sender('10.0.1.1'))
+        state_store.set.assert_called_once()
+
+
+class DuplicateCrcTests(SimpleTestCase):
+    """
+    Повтором считается только датаграмма с верной CRC.
+    """
+    def setUp(self):
+        from .moscow import RouteData
+        self.route = build_datagram(RouteData, build_payload(RouteData, 3), '10.0.1.1', packet_id=7)
+        self.dedup = DuplicateFilter()
+        self.dedup.remember(self.route)
+
+    def corrupt(self, index):
+        data = bytearray(self.route)
+        data[index] ^= 0x01
+        return bytes(data)
+
+    def test_corrupted_header_is_not_a_duplicate(self):
+        # Заголовок испорчен (размер данных), полезная нагрузка совпадает
+        self.assertIsNone(self.dedup.check(self.corrupt(17), 'RouteData'))
+        self.assertEqual(self.dedup.check(self.route, 'RouteData'), RETRANSMISSION)
+
+    def test_corrupted_payload_is_not_a_retransmission(self):
+        # ID пакета и поле CRC совпадают, но данные искажены
+        self.assertIsNone(self.dedup.check(self.corrupt(-1), 'RouteData'))
+        self.assertEqual(self.dedup.stats(), {DUPLICATE: {}, RETRANSMISSION: {}})
+
+    @mock.patch('Screen_Server.ingest.send_route_answer')
+    def test_corrupted_duplicate_route_is_not_acked(self, send_route_answer):
+        from .ingest import DEFAULT_CONFIG, IngestService
+        service = IngestService(config=dict(DEFAULT_CONFIG, COALESCE_HZ=0), listen=False)
+        service.dedup = self.dedup
+        service.receive_queue = OverflowQueue(8)
+        service.receive_queue.put_nowait((self.corrupt(17), ('10.0.1.1', 29789), 0.0, 'RouteData'))
+
+        async def run_once():
+            task = asyncio.create_task(service._parse_worker())
+            while service.receive_queue.qsize():
+                await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            task.cancel()
+        asyncio.run(run_once())
+        send_route_answer.assert_not_called()
+        self.assertEqual(service.parse_errors, 1)
+        self.assertEqual(service.metrics_snapshot()['counters']['crc_errors'], {'RouteData': 1})
+
+
+class BroadcastEncodingTests(SimpleTestCase):
+    """
+    Кадр кодируется один раз при отправке в группу; консьюмер отправляет его как есть.
+    """
+    def test_group_send_frame(self):
+        from .broadcast import group_send_frame
+        layer = mock.Mock(group_send=mock.AsyncMock())
+        frame = {'type': 'update', 'message': {'current_png': 'AAEC'}}
+        event = asyncio.run(group_send_frame(layer, 'group', 'moscow_module_update', frame, stream='10.0.1.1'))
+        layer.group_send.assert_awaited_once_with('group', event)
+        self.assertEqual(event['type'], 'moscow_module_update')
+        self.assertEqual(event['stream'], '10.0.1.1')
+        self.assertEqual(json.loads(event['text']), frame)
+        if msgpack is not None:
+            # В msgpack изображение передаётся байтами
+            self.assertEqual(msgpack.unpackb(event['msgpack'])['message']['current_png'], b'\x00\x01\x02')
+
+    def test_event_frame_reuses_encoding(self):
+        from .broadcast import event_frame
+        event = {'type': 'update_station', 'text': '{"cached": 1}', 'msgpack': b'\x81'}
+        with mock.patch('Screen_Server.broadcast.encode_frame') as encode_frame:
+            self.assertEqual(event_frame(event, 'update_station'), ('{"cached": 1}', None))
+            self.assertEqual(event_frame(event, 'update_station', binary=True), (None, b'\x81'))
+            encode_frame.assert_not_called()
+        # События старого вида со словарём 'message' по-прежнему понимаются
+        self.assertEqual(json.loads(event_frame({'message': {'a': 1}}, 'update')[0]),
+                         {'type': 'update', 'message': {'a': 1}})
+
+    @mock.patch('Screen_Server.ingest.store_keyframe')
+    @mock.patch('Screen_Server.delta.register_stream')
+    @mock.patch('Screen_Server.ingest.get_channel_layer')
+    def test_broadcast_worker_sends_one_event_per_packet(self, get_channel_layer, register_stream, store_keyframe):
+        from .ingest import BROADCAST_GROUP, DEFAULT_CONFIG, IngestService
+        layer = get_channel_layer.return_value = mock.Mock(group_send=mock.AsyncMock())
+        service = IngestService(config=dict(DEFAULT_CONFIG, COALESCE_HZ=0), listen=False)
+        service.broadcast_queue = OverflowQueue(8)
+        for speed in (1, 2):
+            service._enqueue_broadcast(('10.0.1.1', 'OperationalData'), {'dataType': 'OperationalData', 'speed': speed})
+
+        async def run():
+            task = asyncio.create_task(service._broadcast_worker())
+            while layer.group_send.await_count < 2:
+                await asyncio.sleep(0)
+            task.cancel()
+        asyncio.run(run())
+        (group, first), (_, second) = [call.args for call in layer.group_send.await_args_list]
+        self.assertEqual(group, BROADCAST_GROUP)
+        self.assertEqual((first['stream'], first['dataType']), ('10.0.1.1', 'OperationalData'))
+        self.assertNotIn('delta', first)
+        self.assertEqual(json.loads(second['delta'])['changed'], {'speed': 2})
+        self.assertEqual('delta_msgpack' in second, msgpack is not None)
+        self.assertEqual(service.sent, 2)
+
+
+class FakeScreen(HeartbeatMixin, BufferedSendMixin):
+    """
+    Соединение экрана без сокета: send() сразу возвращается, как под Daphne.
+    """
+    delivery_acks = True
+    binary = False
+
+    def __init__(self):
+        self.scope = {'client': ('10.0.1.5', 5000), 'path': '/ws/moscow_module/'}
+        self.channel_name = 'test.screen'
+        self.sent = []
+        self.close_code = None
+
+    async def send(self, text_data=None, bytes_data=None):
+        self.sent.append(json.loads(text_data))
+
+    async def close(self, code=None):
+        self.close_code = code
+
+    def frames(self):
+        return [frame['n'] for frame in self.sent if frame['type'] == 'route']
+
+    def pings(self):
+        return [frame for frame in self.sent if frame['type'] == 'ping']
+
+
+@override_settings(MOSCOW_OUTBOUND={'MAX_IN_FLIGHT': 8, 'SLOW_CLIENT_TIMEOUT': 0.2, 'MAX_PENDING': 1000})
+class OutboundBackpressureTests(SimpleTestCase):
+    """
+    Окно неподтверждённых кадров и закрытие экрана, который не читает сокет.
+    """
+    def enqueue(self, screen, count):
+        async def run():
+            for n in range(count):
+                await screen.enqueue_frame(json.dumps({'type': 'route', 'n': n}))
+        return run()
+
+    def test_stalled_client_is_bounded_and_closed(self):
+        screen = FakeScreen()
+
+        async def run():
+            screen.start_outbound()
+            await self.enqueue(screen, 100)
+            await asyncio.sleep(0.05)
+            # Клиент не отвечает на ping: в транспорт ушло не больше окна
+            self.assertEqual(screen.frames(), list(range(8)))
+            self.assertIsNone(screen.close_code)
+            await asyncio.sleep(0.3)
+            self.assertEqual(screen.close_code, SLOW_CLIENT_CLOSE_CODE)
+            self.assertEqual(len(screen.frames()), 8)
+            self.assertNotIn(screen.channel_name, CONNECTIONS)
+            # После закрытия новые кадры не принимаются
+            depth = screen.outbound.qsize()
+            await self.enqueue(screen, 10)
+            self.assertEqual(screen.outbound.qsize(), depth)
+            await screen.stop_outbound()
+        asyncio.run(run())
+
+    def test_pong_opens_window(self):
+        screen = FakeScreen()
+
+        async def run():
+            screen.start_outbound()
+            await self.enqueue(screen, 100)
+            answered = 0
+            while len(screen.frames()) < 100:
+                self.assertLessEqual(screen.in_flight(), 8)
+                pings = screen.pings()
+                for ping in pings[answered:]:
+                    self.assertTrue(screen.heartbeat_received({'type': 'pong', 'ts': ping['ts']}))
+                answered = len(pings)
+                await asyncio.sleep(0)
+            await screen.stop_outbound()
+        asyncio.run(run())
+        self.assertEqual(screen.frames(), list(range(100)))
+        self.assertIsNone(screen.close_code)
+
+    def test_without_delivery_acks_frames_are_not_windowed(self):
+        screen = FakeScreen()
+        screen.delivery_acks = False
+
+        async def run():
+            screen.start_outbound()
+            await self.enqueue(screen, 20)
+            await asyncio.sleep(0.05)
+            await screen.stop_outbound()
+        asyncio.run(run())
+        self.assertEqual(screen.frames(), list(range(20)))
+        self.assertEqual(screen.pings(), [])
+
+
+class ReapedScreen(FakeScreen):
+    heartbeat_module = 'test'
+
+    def __init__(self):
+        super().__init__()
+        self.released = 0
+
+    async def release_connection(self):
+        self.released += 1
+        await self.stop_heartbeat()
+
+
+@override_settings(SCREEN_HEARTBEAT={'INTERVAL': 0.05, 'TIMEOUT': 0.12})
+class HeartbeatTests(SimpleTestCase):
+    """
+    Снятие молчащих соединений и ответы pong.
+    """
+    def reaped(self):
+        return heartbeat_stats()['counters'].get('reaped', {}).get('test', 0)
+
+    def test_silent_client_is_reaped(self):
+        screen = ReapedScreen()
+        reaped = self.reaped()
+
+        async def run():
+            screen.start_heartbeat()
+            self.assertEqual(heartbeat_stats()['live']['test'], 1)
+            await asyncio.sleep(0.3)
+        asyncio.run(run())
+        self.assertTrue(screen.pings())
+        self.assertEqual(screen.released, 1)
+        self.assertEqual(screen.close_code, HEARTBEAT_CLOSE_CODE)
+        self.assertEqual(self.reaped(), reaped + 1)
+        self.assertEqual(heartbeat_stats()['live']['test'], 0)
+
+    def test_answering_client_stays_connected(self):
+        screen = ReapedScreen()
+
+        async def run():
+            screen.start_heartbeat()
+            answered = 0
+            for _ in range(30):
+                pings = screen.pings()
+                for ping in pings[answered:]:
+                    self.assertTrue(screen.heartbeat_received({'type': 'pong', 'ts': ping['ts']}))
+                answered = len(pings)
+                await asyncio.sleep(0.01)
+            await screen.release_connection()
+        asyncio.run(run())
+        self.assertGreaterEqual(len(screen.pings()), 3)
+        self.assertIsNone(screen.close_code)
+        self.assertEqual(screen.released, 1)
+        self.assertFalse(screen.heartbeat_received({'type': 'resync'}))
+
+    def test_release_connection_is_required(self):
+        async def run():
+            FakeScreen().start_heartbeat()
+        with self.assertRaises(TypeError):
+            asyncio.run(run())
+
+
+class FakeRedis:
+    """
+    Общие каналы и группы нескольких слоёв (API RedisChannelLayer, без Redis).
+    """
+    def __init__(self):
+        self.queues = {}
+        self.groups = {}
+        self.sent = 0
+
+    def queue(self, channel):
+        return self.queues.setdefault(channel, asyncio.Queue())
+
+    async def send(self, channel, message):
+        self.queue(channel).put_nowait(dict(message))
+
+    async def receive(self, channel):
+        return await self.queue(channel).get()
+
+    async def group_add(self, group, channel):
+        self.groups.setdefault(group, set()).add(channel)
+
+    async def group_discard(self, group, channel):
+        self.groups.get(group, set()).discard(channel)
+
+    async def group_send(self, group, message):
+        self.sent += 1
+        for channel in list(self.groups.get(group, ())):
+            self.queue(channel).put_nowait(dict(message))
+
+    async def close_pools(self):
+        pass
+
+
+class HybridChannelLayerTests(SimpleTestCase):
+    """
+    Прямая доставка внутри процесса, реестр групп и цикл событий посредника.
+    """
+    def remote_layer(self, redis):
+        layer = HybridChannelLayer(membership_interval=0.2)
+        layer.remote = redis
+        return layer
+
+    def test_group_send_from_other_thread_is_delivered_locally(self):
+        layer = HybridChannelLayer()
+
+        async def run():
+            channel = await layer.new_channel()
+            await layer.group_add('route', channel)
+            # Сервис приёма рассылает из своего потока и цикла
+            await asyncio.get_running_loop().run_in_executor(
+                None, lambda: asyncio.run(layer.group_send('route', {'type': 'update'})))
+            return await asyncio.wait_for(layer.receive(channel), 1)
+        self.assertEqual(asyncio.run(run()), {'type': 'update'})
+        self.assertEqual((layer.local_delivered, layer.remote_sent), (1, 0))
+
+    def test_registry_skips_redis_for_local_only_groups(self):
+        redis = FakeRedis()
+        a, b = self.remote_layer(redis), self.remote_layer(redis)
+
+        async def run():
+            channel = await a.new_channel()
+            await a.group_add('route', channel)
+            await b.new_channel()
+            await asyncio.sleep(0.15)
+            self.assertEqual(b.stats()['peers'], {a.proxy_channel: ['route']})
+            sent = redis.sent
+            await b.group_send('other', {'type': 'update'})
+            self.assertEqual(redis.sent, sent)
+            await b.group_send('route', {'type': 'update', 'n': 1})
+            self.assertEqual(redis.sent, sent + 1)
+            message = await asyncio.wait_for(a.receive(channel), 1)
+            await a.close_pools()
+            await b.close_pools()
+            return message
+        with mock.patch('Screen_Server.channel_layer.MEMBERSHIP_WARMUP', 0.1):
+            self.assertEqual(asyncio.run(run()), {'type': 'update', 'n': 1})
+
+    def test_proxy_runs_on_consumer_loop(self):
+        layer = self.remote_layer(FakeRedis())
+
+        # Первым рассылает временный цикл, который останавливается, не отменив задачи
+        temporary = asyncio.new_event_loop()
+        temporary.run_until_complete(layer.group_send('route', {'type': 'update'}))
+        temporary.close()
+        self.assertIs(layer._proxy_task.get_loop(), temporary)
+
+        consumers = asyncio.new_event_loop()
+        thread = threading.Thread(target=consumers.run_forever, daemon=True)
+        thread.start()
+        try:
+            asyncio.run_coroutine_threadsafe(layer.new_channel(), consumers).result(1)
+            proxy = layer._proxy_task
+            self.assertIs(proxy.get_loop(), consumers)
+            self.assertIs(layer._membership_task.get_loop(), consumers)
+
+            # Рассылка из другого работающего цикла не переносит посредника
+            asyncio.run(layer.group_send('route', {'type': 'update'}))
+            self.assertIs(layer._proxy_task, proxy)
+            self.assertFalse(proxy.done())
+            asyncio.run_coroutine_threadsafe(layer.close_pools(), consumers).result(1)
+        finally:
+            consumers.call_soon_threadsafe(consumers.stop)
+            thread.join(1)
+            consumers.close()
+
+    def test_proxy_is_recreated_after_its_loop_closes(self):
+        layer = self.remote_layer(FakeRedis())
+        temporary = asyncio.new_event_loop()
+        temporary.run_until_complete(layer.group_send('route', {'type': 'update'}))
+        temporary.close()
+
+        async def run():
+            await layer.group_send('route', {'type': 'update'})
+            running = layer._proxy_task.get_loop() is asyncio.get_running_loop()
+            await layer.close_pools()
+            return running
+        self.assertTrue(asyncio.run(run()))
+
+
+def free_udp_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class ModuleDetectorTests(SimpleTestCase):
+    """
+    Выбор модуля по первой корректной датаграмме на его порту.
+    """
+    def test_first_valid_datagram_selects_module(self):
+        bnt_port, moscow_port = free_udp_port(), free_udp_port()
+        detected = []
+        detector = ModuleDetector(
+            {bnt_port: 'bnt', moscow_port: 'moscow'},
+            {'moscow': lambda data: data.startswith(b'\xaa')},
+            lambda module, sock, datagram: detected.append((module, sock, datagram)),
+            host='127.0.0.1',
+        )
+        thread = threading.Thread(target=detector.run, kwargs={'poll_interval': 0.05})
+        thread.start()
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+            for _ in range(100):
+                # Сокеты детектора открываются в его потоке: повторяем, пока датаграмма не принята
+                sender.sendto(b'\x00bad', ('127.0.0.1', moscow_port))
+                sender.sendto(b'\xaagood', ('127.0.0.1', moscow_port))
+                thread.join(0.05)
+                if not thread.is_alive():
+                    break
+        detector.stop()
+        thread.join(1)
+
+        self.assertEqual(detector.module, 'moscow')
+        (module, sock, (data, addr)), = detected
+        self.assertEqual((module, data), ('moscow', b'\xaagood'))
+        # Выбранный сокет остаётся открытым для клиента модуля, порт БНТ освобождён
+        self.assertEqual(sock.getsockname()[1], moscow_port)
+        sock.close()
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+            probe.bind(('127.0.0.1', bnt_port))
+
+    def test_stop_without_datagrams(self):
+        detected = []
+        detector = ModuleDetector({free_udp_port(): 'bnt'}, {}, lambda *args: detected.append(args), host='127.0.0.1')
+        thread = threading.Thread(target=detector.run, kwargs={'poll_interval': 0.05})
+        thread.start()
+        detector.stop()
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        self.assertIsNone(detector.module)
+        self.assertEqual(detected, [])
+
+
+class MetricsTests(SimpleTestCase):
+    """
+    Гистограммы задержек, объединение снимков процессов и метрики стадий приёма.
+    """
+    def test_histogram_quantiles(self):
+        histogram = Histogram()
+        for value in [3] * 90 + [40] * 9 + [7000]:
+            histogram.observe(value)
+        described = describe(histogram.snapshot())
+        self.assertEqual((described['count'], described['max']), (100, 7000))
+        # Квантиль — верхняя граница корзины (1-2-5), но не больше максимума
+        self.assertEqual((described['p50'], described['p90'], described['p99']), (5.0, 5.0, 50.0))
+        self.assertAlmostEqual(described['mean'], (270 + 360 + 7000) / 100)
+        histogram.observe(BUCKET_BOUNDS[-1] * 10)
+        self.assertEqual(histogram.buckets[-1], 1)
+
+    def test_merge_snapshots(self):
+        first, second = Metrics(), Metrics()
+        first.inc('parsed', 'RouteData')
+        second.inc('parsed', 'RouteData', 2)
+        second.inc('parsed', 'OperationalData')
+        first.observe('parse_us', 'RouteData', 10)
+        second.observe('parse_us', 'RouteData', 1000)
+        merged = merge_snapshots([first.snapshot(), second.snapshot()])
+        self.assertEqual(merged['counters'], {'parsed': {'RouteData': 3, 'OperationalData': 1}})
+        histogram = merged['histograms']['parse_us']['RouteData']
+        self.assertEqual((histogram['count'], histogram['sum'], histogram['max']), (2, 1010, 1000))
+        self.assertEqual(merged['started_at'], min(first.started_at, second.started_at))
+        # Снимок первого процесса не изменился при объединении
+        self.assertEqual(first.snapshot()['histograms']['parse_us']['RouteData']['count'], 1)
+
+        rendered = render(merged)
+        self.assertNotIn('buckets', rendered['histograms']['parse_us']['RouteData'])
+        self.assertIsNone(rendered['bucket_bounds'])
+        self.assertEqual(render(merged, buckets=True)['bucket_bounds'], list(BUCKET_BOUNDS))
+
+    def test_parse_stage_is_instrumented(self):
+        from .ingest import DEFAULT_CONFIG, IngestService
+        from .moscow import RouteData
+        route = bytearray(build_datagram(RouteData, build_payload(RouteData, 3), '10.0.1.1'))
+        route[-1] ^= 0x01
+        service = IngestService(config=dict(DEFAULT_CONFIG, DEDUP=False), listen=False)
+        service.receive_queue = OverflowQueue(8)
+        service.receive_queue.put_nowait((bytes(route), ('10.0.1.1', 29789), 0.0, 'RouteData'))
+
+        async def run_once():
+            task = asyncio.create_task(service._parse_worker())
+            while service.receive_queue.qsize():
+                await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            task.cancel()
+        asyncio.run(run_once())
+        snapshot = service.metrics_snapshot()
+        self.assertEqual(snapshot['counters'], {'crc_errors': {'RouteData': 1}})
+        self.assertEqual(snapshot['histograms']['parse_us']['RouteData']['count'], 1)
+        self.assertEqual(snapshot['histograms']['receive_queue_delay_us']['RouteData']['count'], 1)
+
+
+@skipIf(msgpack is None, 'msgpack не установлен')
+class BinaryFramingTests(SimpleTestCase):
+    """
+    Подпротокол 'msgpack': согласование и двоичные кадры с изображениями в байтах.
+    """
+    def screen(self, subprotocols):
+        from .broadcast import EncodedFrameMixin
+        screen = EncodedFrameMixin()
+        screen.scope = {'subprotocols': subprotocols}
+        return screen
+
+    def test_negotiation(self):
+        screen = self.screen(['msgpack'])
+        self.assertEqual(screen.negotiate_subprotocol(), 'msgpack')
+        self.assertTrue(screen.binary)
+        data = screen.client_frame({'type': 'ping', 'ts': 1.5})
+        self.assertEqual((data[0], msgpack.unpackb(data[1])), (None, {'type': 'ping', 'ts': 1.5}))
+
+        screen = self.screen([])
+        self.assertIsNone(screen.negotiate_subprotocol())
+        self.assertEqual(screen.client_frame({'type': 'ping'}), ('{"type": "ping"}', None))
+
+    def test_nested_images_become_bytes(self):
+        from .broadcast import encode_binary
+        frame = {'type': 'update', 'message': {'cars': [{'encoded_string': 'AAE=', 'name': 'AAE='}]}}
+        decoded = msgpack.unpackb(encode_binary(frame))
+        self.assertEqual(decoded['message']['cars'], [{'encoded_string': b'\x00\x01', 'name': 'AAE='}])
+        # Исходный кадр не меняется: из него же кодируется JSON
+        self.assertEqual(frame['message']['cars'][0]['encoded_string'], 'AAE=')
+
+    def test_binary_frames_can_be_disabled(self):
+        from .broadcast import event_delta, frame_event
+        with self.settings(WS_BINARY_FRAMES=False):
+            event = frame_event('moscow_module_update', {'type': 'update', 'message': {}})
+        self.assertNotIn('msgpack', event)
+        # Клиент msgpack всё равно получает двоичный кадр, закодированный консьюмером
+        self.assertEqual(msgpack.unpackb(event_delta({'delta': '{"changed": {}}'}, binary=True)[1]), {'changed': {}})
+
+
+class ClientRegistryTests(SimpleTestCase):
+    """
+    Вторичные индексы реестра и неизменность прочитанного состояния.
+    """
+    def setUp(self):
+        from .groups import ScreenAddress
+        self.registry = ClientRegistry()
+        self.registry.register('10.0.1.2', 1, 'a', ScreenAddress('moscow', 1, 2, 'left'), switch='10.0.1.2')
+        self.registry.register('10.0.1.2', 2, 'b', ScreenAddress('moscow', 1, 2, 'right'), switch='10.0.1.2')
+        self.registry.register('10.0.2.7', 5000, 'c', ScreenAddress('bnt', None, 3, 'left'))
+
+    def test_indexes(self):
+        registry = self.registry
+        self.assertEqual(sorted(entry.channel_name for entry in registry.by_ip('10.0.1.2')), ['a', 'b'])
+        self.assertEqual(sorted(entry.channel_name for entry in registry.by_wagon(2, train=1)), ['a', 'b'])
+        self.assertEqual([entry.channel_name for entry in registry.by_side('left', train=1)], ['a'])
+        self.assertEqual([entry.channel_name for entry in registry.by_wagon(3)], ['c'])
+        self.assertEqual(sorted(registry.by_switch('10.0.1.2')), [1, 2])
+        self.assertEqual(registry.switches(), ['10.0.1.2'])
+        self.assertEqual([entry.channel_name for entry in registry.outside_switches(['10.0.1.2'])], ['c'])
+        self.assertTrue(registry.has_ip('10.0.2.7'))
+
+    def test_reregister_and_unregister_update_indexes(self):
+        from .groups import ScreenAddress
+        registry = self.registry
+        registry.register('10.0.1.2', 1, 'a2', ScreenAddress('moscow', 1, 4, 'left'), switch='10.0.1.2')
+        self.assertEqual(len(registry), 3)
+        self.assertEqual([entry.channel_name for entry in registry.by_wagon(4, train=1)], ['a2'])
+        self.assertEqual([entry.channel_name for entry in registry.by_wagon(2, train=1)], ['b'])
+
+        registry.update('10.0.1.2', 1, 'a3')
+        self.assertEqual(registry.get('10.0.1.2', 1).address.wagon, 4)
+        self.assertEqual(registry.get_channel_name('10.0.1.2', 1), 'a3')
+
+        self.assertEqual(registry.unregister('10.0.2.7', 5000).channel_name, 'c')
+        self.assertIsNone(registry.unregister('10.0.2.7', 5000))
+        self.assertFalse(registry.has_ip('10.0.2.7'))
+        self.assertEqual(registry.by_wagon(3), [])
+        self.assertEqual(registry.stats(), {'clients': 2, 'ips': 1, 'wagons': 2, 'switches': 1})
+
+    def test_readers_keep_a_consistent_state(self):
+        clients = self.registry.get_all_clients()
+        entries = self.registry.entries()
+        self.registry.unregister('10.0.1.2', 1)
+        # Прочитанное раньше состояние не меняется записью
+        self.assertEqual(len(entries), 3)
+        self.assertIn(('10.0.1.2', 1), clients)
+        self.assertNotIn(('10.0.1.2', 1), self.registry.get_all_clients())
+
+
+class BootstrapTests(SimpleTestCase):
+    """
+    Однократная сборка начального кадра, сброс по ключам состояния и допуск подключений.
+    """
+    def test_concurrent_connections_share_one_build(self):
+        cache = BootstrapCache()
+        builds = []
+
+        async def build():
+            builds.append(1)
+            await asyncio.sleep(0.01)
+            return {'start_stops': [1, 2]}
+
+        async def run():
+            return await asyncio.gather(*(cache.get('moscow', build, sources=['cached_STOPS']) for _ in range(50)))
+        frames = asyncio.run(run())
+        self.assertEqual(len(builds), 1)
+        self.assertTrue(all(frame is frames[0] for frame in frames))
+        text, _ = frames[0].encoded()
+        self.assertIs(frames[0].encoded()[0], text)
+        self.assertEqual((cache.builds, cache.hits), (1, 49))
+
+    def test_invalidation_by_source(self):
+        cache = BootstrapCache()
+        counter = iter(range(100))
+
+        async def build():
+            return next(counter)
+
+        async def run():
+            get = cache.get
+            moscow = await get('moscow', build, sources=['cached_STOPS'])
+            switches = await get('switches', build, sources=['cached_SWITCH_SIDES'])
+            cache.invalidate(['cached_OTHER'])
+            self.assertIs(await get('moscow', build, sources=['cached_STOPS']), moscow)
+            cache.invalidate(['cached_STOPS'])
+            self.assertEqual((await get('moscow', build, sources=['cached_STOPS'])).frame, 2)
+            self.assertIs(await get('switches', build, sources=['cached_SWITCH_SIDES']), switches)
+            cache.invalidate()
+            self.assertEqual((await get('switches', build, sources=['cached_SWITCH_SIDES'])).frame, 3)
+        asyncio.run(run())
+        self.assertEqual(cache.invalidated, 3)
+
+    def test_frame_changed_during_build_is_not_kept(self):
+        cache = BootstrapCache()
+
+        async def build():
+            cache.invalidate(['cached_STOPS'])
+            return 'stale'
+
+        async def run():
+            await cache.get('moscow', build, sources=['cached_STOPS'])
+            await cache.get('moscow', build, sources=['cached_STOPS'])
+        asyncio.run(run())
+        self.assertEqual(cache.builds, 2)
+
+    def test_build_error_reaches_waiters(self):
+        cache = BootstrapCache()
+
+        async def build():
+            await asyncio.sleep(0.01)
+            raise ValueError('нет маршрута')
+
+        async def run():
+            return await asyncio.gather(*(cache.get('bnt', build) for _ in range(3)), return_exceptions=True)
+        results = asyncio.run(run())
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+        self.assertEqual(cache.stats()['frames'], 0)
+
+    def test_admission_rate(self):
+        gate = AdmissionGate(rate=100.0, burst=5)
+
+        async def run():
+            return await asyncio.gather(*(gate.acquire() for _ in range(10)))
+        waits = asyncio.run(run())
+        self.assertEqual(waits[:5], [0.0] * 5)
+        # Сверх запаса — по маркеру каждые 1 / rate секунд, в порядке прихода
+        for index, wait in enumerate(waits[5:], 1):
+            self.assertAlmostEqual(wait, index / 100.0, delta=0.005)
+        self.assertEqual((gate.admitted, gate.delayed), (10, 5))
+
+
+class RpcScreen(RpcServerMixin):
+    """
+    Консьюмер экрана, который отвечает сразу, молчит или отключается.
+    """
+    def __init__(self, channel_layer, answer):
+        self.channel_layer = channel_layer
+        self.answer = answer
+        self.requests = []
+
+    def client_frame(self, frame):
+        return frame, None
+
+    async def enqueue_frame(self, frame, data=None):
+        self.requests.append(frame)
+        if self.answer == 'result':
+            await self.handle_rpc_result({'type': 'rpc_result', 'id': frame['id'], 'result': frame['params']})
+        elif self.answer == 'error':
+            await self.handle_rpc_result({'type': 'rpc_result', 'id': frame['id'], 'error': 'unknown method'})
+        elif self.answer == 'disconnect':
+            await self.fail_rpc()
+
+    async def serve(self):
+        self.channel_name = await self.channel_layer.new_channel()
+        asyncio.get_running_loop().create_task(self._serve())
+        return self
+
+    async def _serve(self):
+        while True:
+            await self.rpc_request(await self.channel_layer.receive(self.channel_name))
+
+
+class RpcTests(SimpleTestCase):
+    """
+    Одновременный опрос экранов с общим сроком ответа.
+    """
+    def test_gather_collects_partial_results_within_one_deadline(self):
+        async def run():
+            layer = HybridChannelLayer()
+            screens = {answer: await RpcScreen(layer, answer).serve()
+                       for answer in ('result', 'error', 'silent', 'disconnect')}
+            client = RpcClient(layer)
+            started = time.monotonic()
+            results, errors = await client.gather(
+                {answer: screen.channel_name for answer, screen in screens.items()},
+                'get_connected_devices', {'switchIp': '10.0.1.2'}, deadline=0.2)
+            elapsed = time.monotonic() - started
+            return screens, client, results, errors, elapsed
+        screens, client, results, errors, elapsed = asyncio.run(run())
+        self.assertEqual(results, {'result': {'switchIp': '10.0.1.2'}})
+        self.assertEqual(errors, {'error': 'unknown method', 'silent': TIMEOUT, 'disconnect': DISCONNECTED})
+        self.assertLess(elapsed, 0.4)
+        self.assertTrue(all(screen.requests[0]['method'] == 'get_connected_devices' for screen in screens.values()))
+        self.assertEqual(client.stats(), {'pending': 0, 'sent': 4, 'answered': 3, 'timed_out': 1})
+
+    def test_call_timeout(self):
+        async def run():
+            layer = HybridChannelLayer()
+            screen = await RpcScreen(layer, 'silent').serve()
+            client = RpcClient(layer)
+            with self.assertRaises(RpcError) as raised:
+                await client.call(screen.channel_name, 'ping', timeout=0.05)
+            self.assertEqual(str(raised.exception), TIMEOUT)
+            self.assertEqual(await RpcClient(layer).gather({}, 'ping'), ({}, {}))
+            return client
+        self.assertEqual(asyncio.run(run()).stats()['pending'], 0)
+
+
+class StationIndexTests(SimpleTestCase):
+    """
+    Индексы станций по ID без обращения к кэшу на каждый пакет.
+    """
+    stops = [{'stationID': 1000}, {'stationID': 1001}, {'stationID': 1002}, {'stationID': 1001}]
+
+    def test_lookup(self):
+        from .moscow import StationIndex
+        index = StationIndex()
+        index.update(self.stops)
+        self.assertEqual(index.lookup(1000), (None, 0))
+        # Повтор станции в маршруте: берётся первое вхождение
+        self.assertEqual(index.lookup(1001), (0, 1))
+        self.assertEqual(index.lookup(1002), (1, 2))
+        self.assertEqual(index.lookup(9999), (None, None))
+        version = index.version
+        index.update(self.stops[2:])
+        self.assertEqual((index.version, index.lookup(1002)), (version + 1, (None, 0)))
+
+    @mock.patch('Screen_Server.moscow.cache_get')
+    def test_loaded_once_and_retried_at_most_every_interval(self, cache_get):
+        from .moscow import StationIndex
+        index = StationIndex()
+        cache_get.return_value = None
+        self.assertEqual(index.lookup(1000), (None, None))
+        self.assertEqual(index.lookup(1000), (None, None))
+        self.assertEqual(cache_get.call_count, 1)
+
+        cache_get.return_value = self.stops
+        index._load_attempt -= StationIndex.RELOAD_INTERVAL
+        for _ in range(3):
+            self.assertEqual(index.lookup(1002), (1, 2))
+        self.assertEqual(cache_get.call_count, 2)
+
+    @mock.patch('Screen_Server.moscow.cache_set')
+    def test_publish_only_changes(self, cache_set):
+        from .moscow import StationIndex
+        index = StationIndex()
+        index.update(self.stops)
+        index.publish(0, 1)
+        index.publish(0, 1)
+        index.publish(1, 2)
+        index.update(self.stops)
+        index.publish(1, 2)
+        self.assertEqual([call.args[1] for call in cache_set.call_args_list],
+                         [{'current': 0, 'next': 1}, {'current': 1, 'next': 2}, {'current': 1, 'next': 2}])
+
+
+class FakePubSub:
+    """
+    Сообщения канала Redis pub/sub для нескольких процессов (redis-py API).
+    """
+    def __init__(self):
+        self.subscribers = []
+
+    def pubsub(self, ignore_subscribe_messages=True):
+        return self
+
+    def subscribe(self, channel):
+        pass
+
+    def listen(self):
+        messages = queue.Queue()
+        self.subscribers.append(messages)
+        while True:
+            yield {'type': 'message', 'data': messages.get()}
+
+    def publish(self, channel, data):
+        for messages in list(self.subscribers):
+            messages.put(data)
+
+
+class TwoTierCacheTests(SimpleTestCase):
+    """
+    Локальный уровень перед удалённым бэкендом и сброс копий по сообщениям других процессов.
+    """
+    def process_cache(self, bus):
+        cache = TwoTierCache('two-tier-tests', {
+            'OPTIONS': {'REMOTE_BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+        })
+        # Каждый «процесс» со своим локальным уровнем и общей шиной pub/sub
+        cache.local = LocalTier(16, 60.0, 'invalidate', lambda: bus)
+        while not cache.local.enabled():
+            time.sleep(0.001)
+        return cache
+
+    def setUp(self):
+        bus = FakePubSub()
+        self.names = []
+        add_invalidation_listener(self.names.append)
+        self.first, self.second = self.process_cache(bus), self.process_cache(bus)
+        self.first.remote.clear()
+        # Подписка начинается с очистки и уведомления None
+        self.names.clear()
+
+    def tearDown(self):
+        from .cache_backend import _invalidation_listeners
+        _invalidation_listeners.remove(self.names.append)
+
+    def test_reads_are_served_locally(self):
+        self.first.set('cached_STOPS', [1, 2])
+        with mock.patch.object(self.second.remote, 'get', wraps=self.second.remote.get) as remote_get:
+            for _ in range(3):
+                self.assertEqual(self.second.get('cached_STOPS'), [1, 2])
+            self.assertIsNone(self.second.get('cached_MISSING'))
+            self.assertIsNone(self.second.get('cached_MISSING'))
+        self.assertEqual(remote_get.call_count, 2)
+        self.assertEqual(self.second.stats()['hits'], 3)
+
+    def test_write_invalidates_other_processes(self):
+        self.first.set('cached_STOPS', [1, 2])
+        self.assertEqual(self.second.get('cached_STOPS'), [1, 2])
+        self.first.set_many({'cached_STOPS': [3], 'cached_CURRENT_NEXT_INDEX': {'current': 0, 'next': 1}})
+        deadline = time.monotonic() + 1
+        while self.second.local.invalidations < 2 and time.monotonic() < deadline:
+            time.sleep(0.001)
+        self.assertEqual(self.second.get('cached_STOPS'), [3])
+        self.assertIn(['cached_STOPS', 'cached_CURRENT_NEXT_INDEX'], self.names)
+        # Собственные сообщения процесс не обрабатывает
+        self.assertEqual(self.first.local.invalidations, 0)
+
+    def test_local_tier_bounds(self):
+        tier = LocalTier(2, 60.0)
+        for key in ('a', 'b', 'c'):
+            tier.put(key, key)
+        self.assertEqual((len(tier), tier.evictions), (2, 1))
+        self.assertEqual(tier.get('b'), 'b')
+        # Значение, прочитанное до удаления ключа, не сохраняется
+        generation = tier.generation
+        tier.discard(['b'])
+        tier.put('b', 'stale', generation=generation)
+        self.assertNotEqual(tier.get('b'), 'stale')
+        tier.put('d', 'd', timeout=0)
+        self.assertNotEqual(tier.get('d'), 'd')
@@ -13,5 +13,15 @@ urlpatterns = [
 # Основной интерфейс отображения данных по модулю Moscow.
     path('get_module_state/', views.get_module_state, name='get_module_state'),
 # Возвращает текущий активный модуль (например, 'moscow') через JSON.
+    path('get_ingest_state/', views.get_ingest_state, name='get_ingest_state'),
+# Возвращает состояние сервиса приёма датаграмм: счётчики и глубину очередей.
+    path('get_ingest_metrics/', views.get_ingest_metrics, name='get_ingest_metrics'),
+# Возвращает метрики горячего пути приёма: счётчики и гистограммы задержек стадий.
+    path('get_screen_lag/', views.get_screen_lag, name='get_screen_lag'),
+# Возвращает состояние исходящих очередей и отставание WebSocket-соединений экранов.
+    path('get_train_devices/', views.get_train_devices, name='get_train_devices'),
+# Одновременно опрашивает экраны за коммутаторами поезда (get_connected_devices) с общим сроком ответа.
+    path('get_telemetry_history/', views.get_telemetry_history, name='get_telemetry_history'),
+# Возвращает историю телеметрии за окно: сводку, участки между станциями или данные по вагонам.
 ]
 
@@ -2,25 +2,35 @@
 Модуль обработки UDP-пакетов и определения состояния транспортного модуля.
 
 Основные задачи:
-- Сниффинг UDP-пакетов (с использованием Scapy)
-- Определение и переключение на нужный модуль (например, 'moscow')
-- Запуск асинхронного UDP-клиента через asyncio и MoscowProtocol
+- Определение модуля по первой корректной UDP-датаграмме (см. autodetect.ModuleDetector)
+- Переключение на нужный модуль (например, 'moscow')
+- Запуск сервиса приёма датаграмм (ingest.IngestService)
 - Отрисовка базовых Django-страниц в зависимости от состояния
 """
 
 
 import threading
 import logging
-import asyncio
 
 
+from django.conf import settings
+from asgiref.sync import async_to_sync
 from django.http import HttpResponseRedirect
 
-from scapy.all import sniff
-from scapy.layers.inet import UDP
-from scapy.packet import Raw
-
 from .metro import *
+from .autodetect import ModuleDetector
+from .bootstrap import bootstrap_stats
+from .ingest import IngestService, get_ingest_config
+from .ingest_workers import ShardedIngest
+from . import metrics
+from .outbound import connections_stats
+from .client_registry import registry
+from .groups import SWITCH_SIDES_KEY
+from .heartbeat import heartbeat_stats
+from .rpc import RPC_TIMEOUT, discover_devices
+from .snapshot import snapshot_stats
+from .state import state_store
+from .telemetry import telemetry_history
 from .moscow import SessionProtocolParser
 
 
@@ -28,65 +38,64 @@ logging.basicConfig(level=logging.DEBUG)
 
 
 # Глобальные переменные
-LAST_PACKET_DATA = None           # Последние данные из UDP пакета (в hex)
 MODULE_STATE = None               # Состояние активного модуля (moscow и т.п.)
 MOSCOW_PORT = 29789               # Порт для обработки 'московского' протокола
 MOSCOW_CLIENT_RUNNING = False     # Запущен ли клиент
-_sniffing_started = False         # Был ли запущен сниффер
+INGEST_SERVICE = None             # Сервис приёма датаграмм (ingest.IngestService)
+_detection_started = False        # Было ли запущено определение модуля
 
-# Функция для запуска UDP-сервера
-def packet_callback(packet):
-    """
-    Callback-функция для обработки UDP-пакетов.
-    Определяет тип модуля и сохраняет hex-данные, если это Raw-пакет.
+# Порты, на которых ожидаются датаграммы модулей: порт → имя модуля
+MODULE_PORTS = getattr(settings, 'MODULE_PORTS', {MOSCOW_PORT: 'moscow'})
 
-    :param packet: объект scapy.packet.Packet
-    """
-    global LAST_PACKET_DATA, MODULE_STATE
-    try:
-        if packet.haslayer(UDP):
-            port = packet[UDP].sport
-            if MODULE_STATE is None:
-                if port == MOSCOW_PORT:
-                    MODULE_STATE = 'moscow'
-                    logging.info('Сервер переключен на модуль Moscow')
-                    start_moscow_client()
-                elif port != MOSCOW_PORT:
-                    logging.info('Переключаем на другой модуль')
+# Проверка формата первой датаграммы для каждого модуля
+MODULE_VALIDATORS = {
+    'moscow': SessionProtocolParser.is_valid_datagram,
+}
 
-            elif MODULE_STATE == 'moscow':
-                if Raw in packet and isinstance(packet[Raw].load, bytes):
-                    LAST_PACKET_DATA = packet[Raw].load.hex()
 
-    except Exception as e:
-        logging.error(f'Ошибка при обработке пакета: {e}')
+def on_module_detected(module, sock, first_datagram):
+    """
+    Callback детектора: переключает состояние и запускает клиент выбранного модуля.
 
+    :param module: имя модуля ('moscow' и т.п.)
+    :param sock: уже привязанный к порту модуля UDP-сокет
+    :param first_datagram: первая корректная датаграмма (data, addr)
+    """
+    global MODULE_STATE
+    MODULE_STATE = module
+    if module == 'moscow':
+        logging.info('Сервер переключен на модуль Moscow')
+        start_moscow_client(sock, first_datagram)
+    else:
+        logging.info(f'Модуль {module} не поддерживается, сокет закрыт')
+        sock.close()
 
-def start_sniffing():
+
+def start_detection():
     """
-    Запускает Scapy-сниффинг UDP-пакетов на заданном интерфейсе и порту.
-    Используется фильтр: udp and port 29789
+    Запускает ожидание первой датаграммы на портах MODULE_PORTS.
     """
-    sniff(prn=packet_callback, iface="enp6s0", filter='udp and port 29789', store=0, monitor=True)
+    detector = ModuleDetector(MODULE_PORTS, MODULE_VALIDATORS, on_module_detected)
+    detector.run()
 
-def start_sniffing_thread():
+def start_detection_thread():
     """
-    Запускает сниффинг в отдельном потоке, если ещё не был запущен.
+    Запускает определение модуля в отдельном потоке, если ещё не было запущено.
     """
-    global _sniffing_started
-    if not _sniffing_started:
-        _sniffing_started = True
-        sniff_thread = threading.Thread(target=start_sniffing, daemon=True)
-        sniff_thread.start()
+    global _detection_started
+    if not _detection_started:
+        _detection_started = True
+        detection_thread = threading.Thread(target=start_detection, daemon=True)
+        detection_thread.start()
 
 def index(request):
     """
-    Главная точка входа. Если модуль не определён — запускает сниффинг.
+    Главная точка входа. Если модуль не определён — запускает определение модуля.
     Если уже определён как 'moscow', делает редирект на moscowBNT.
     """
     global MODULE_STATE
     if MODULE_STATE is None:
-        start_sniffing_thread()
+        start_detection_thread()
     elif MODULE_STATE == 'moscow':
         return HttpResponseRedirect('/moscowBNT/')
     return render(request, 'Screen_Server/index.html')
@@ -110,72 +119,123 @@ def get_module_state(request):
     return JsonResponse({'module_state': MODULE_STATE})
 
 
-async def moscow_client():
-    """
-    Асинхронный UDP-клиент, принимающий и обрабатывающий пакеты,
-    используя MoscowProtocol.
+def start_moscow_client(sock=None, first_datagram=None):
     """
-    logging.info(f"Запуск UDP-клиента для порта {MOSCOW_PORT}")
-    loop = asyncio.get_event_loop()
+    Запускает сервис приёма датаграмм модуля Moscow, если он ещё не был запущен.
 
-    transport, protocol = await loop.create_datagram_endpoint(
-        lambda: MoscowProtocol(),
-        local_addr = ('0.0.0.0', MOSCOW_PORT),
-    )
-
-    try:
-        while True:
-            await asyncio.sleep(1)
-    except asyncio.CancelledError:
-        transport.close()
-
-
-def start_moscow_client():
+    :param sock: готовый сокет от детектора модуля (иначе порт открывается заново)
+    :param first_datagram: датаграмма, по которой был определён модуль
     """
-    Инициализирует запуск UDP-клиента, если он ещё не был запущен.
-    """
-    global MOSCOW_CLIENT_RUNNING
+    global MOSCOW_CLIENT_RUNNING, INGEST_SERVICE
     if MOSCOW_CLIENT_RUNNING:
         logging.warning("UDP-клиент уже запущен")
         return
 
     logging.info("🚀 Стартуем UDP-клиент...")
     MOSCOW_CLIENT_RUNNING = True
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(moscow_client())
+    config = get_ingest_config()
+    if config['WORKERS'] > 1:
+        INGEST_SERVICE = ShardedIngest(config['WORKERS'], config['SHARDING'], port=MOSCOW_PORT, sock=sock)
+    else:
+        INGEST_SERVICE = IngestService(port=MOSCOW_PORT, sock=sock)
+    INGEST_SERVICE.start()
+    if first_datagram is not None and INGEST_SERVICE.running:
+        INGEST_SERVICE.submit(*first_datagram)
+
+
+def get_ingest_state(request):
+    """
+    Возвращает JSON с состоянием сервиса приёма: счётчики стадий и глубину очередей.
+
+    :return: JsonResponse со статистикой IngestService/ShardedIngest или {"running": false}
+    """
+    if INGEST_SERVICE is None:
+        return JsonResponse({'running': False})
+    return JsonResponse(INGEST_SERVICE.stats())
 
 
-class MoscowProtocol(asyncio.DatagramProtocol):
+def get_ingest_metrics(request):
     """
-    Пользовательский протокол для обработки UDP-пакетов от московского модуля.
-    Содержит методы:
-    - connection_made: обработка установления соединения
-    - datagram_received: приём данных
-    - error_received: обработка ошибок
-    - connection_lost: завершение соединения
+    Возвращает JSON с метриками горячего пути приёма: счётчики по типам пакетов
+    (принято, разобрано, ошибки CRC и разбора, отправлено) и гистограммы задержек
+    в микросекундах (ожидание в очередях, разбор, group_send) с p50/p90/p99.
+
+    Параметр ?buckets=1 добавляет границы и содержимое корзин гистограмм.
+
+    :return: JsonResponse со снимком метрик или {"running": false}
     """
+    if INGEST_SERVICE is None:
+        return JsonResponse({'running': False})
+    snapshot = metrics.render(INGEST_SERVICE.metrics_snapshot(), buckets=request.GET.get('buckets') == '1')
+    return JsonResponse(dict(snapshot, running=INGEST_SERVICE.running))
 
-    def connection_made(self, transport):
-        self.transport = transport
-        logging.info("UDP-соединение установлено")
 
-    def datagram_received(self, data, addr):
-        # logging.info(f"Получены данные: {data.hex()}")
-        hex_data = data.hex()
-        parser = SessionProtocolParser(hex_data)
-        parser.parse_packet()
+def get_screen_lag(request):
+    """
+    Возвращает JSON с состоянием исходящих очередей WebSocket-соединений этого
+    процесса: глубина, вытесненные/заменённые кадры и отставание отправки (мкс),
+    а также готовые начальные кадры и очередь подключений (см. bootstrap.py)
+    и открытые/снятые по тайм-ауту соединения (см. heartbeat.py), версия
+    состояния процесса и отложенная запись его в Redis (см. state.py), попадания
+    в локальный уровень кэша (см. cache_backend.py) и запись снимка состояния (см. snapshot.py).
+
+    :return: JsonResponse вида {"connections": [...], "bootstrap": {...}, "heartbeat": {...},
+             "state": {...}, "cache": {...}, "snapshot": {...}}
+    """
+    cache_stats = getattr(cache, 'stats', None)
+    return JsonResponse({
+        'connections': connections_stats(),
+        'bootstrap': bootstrap_stats(),
+        'heartbeat': heartbeat_stats(),
+        'state': state_store.stats(),
+        'cache': cache_stats() if callable(cache_stats) else None,
+        'snapshot': snapshot_stats(),
+    })
 
-    def send_diagnostics(selfself, message: bytes):
-        """
-        Отправка диагностических данных по UDP.
 
-        :param message: байтовое сообщение
-        """
-        logging.info(f"Отправлены диагностические данные: {message.hex()}")
+def get_train_devices(request):
+    """
+    Опрашивает одновременно все экраны за коммутаторами поезда (rpc.discover_devices)
+    и возвращает ответы и список не ответивших экранов.
 
-    def error_received(self, error):
-        logging.error(f"Ошибка UDP-соединения: {error}")
+    Коммутаторы берутся из последнего пакета ConfigureData, а до его получения —
+    из реестра подключённых экранов. Параметр ?timeout= задаёт общий срок ответа (сек).
 
-    def connection_lost(self, exc):
-        logging.warning("UDP-соединение закрыто")
\ No newline at end of file
+    :return: JsonResponse вида {"devices": {switch_ip: {port: ответ}}, "errors": {"ip:port": ошибка}}
+    """
+    try:
+        timeout = float(request.GET.get('timeout', RPC_TIMEOUT))
+    except ValueError:
+        timeout = RPC_TIMEOUT
+    switch_ips = list(state_store.read(SWITCH_SIDES_KEY) or {}) or registry.switches()
+    return JsonResponse(async_to_sync(discover_devices)(switch_ips, deadline=timeout))
+
+
+def get_telemetry_history(request):
+    """
+    Возвращает JSON с историей телеметрии поездов за последние N секунд (см. telemetry.py).
+
+    Параметры запроса:
+        view: 'summary' (по умолчанию) — сводка полей; 'segments' — участки между
+              станциями; 'wagons' — температура и пассажиры по вагонам.
+        window: Окно в секундах (по умолчанию 300).
+        stream: IP поезда; без него — все поезда в истории.
+
+    :return: JsonResponse вида {"view": ..., "window": ..., "streams": {ip: ...}, "history": {...}}
+    """
+    view = request.GET.get('view', 'summary')
+    if view not in ('summary', 'segments', 'wagons'):
+        return JsonResponse({'error': f'Неизвестный view: {view}'}, status=400)
+    try:
+        window = float(request.GET.get('window', 300))
+    except ValueError:
+        return JsonResponse({'error': 'window должен быть числом'}, status=400)
+    stream = request.GET.get('stream')
+    streams = [stream] if stream else telemetry_history.streams()
+    query = getattr(telemetry_history, view)
+    return JsonResponse({
+        'view': view,
+        'window': window,
+        'streams': {ip: query(ip, window) for ip in streams},
+        'history': telemetry_history.stats(),
+    })